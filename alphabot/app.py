@@ -16,6 +16,7 @@
 import argparse
 import logging
 import os
+import signal
 import sys
 
 from tornado import ioloop, gen
@@ -41,9 +42,21 @@ parser.add_argument('-S', '--scripts', dest='scripts', metavar='dir',
                     help=('Directory to fetch bot scripts. '
                           'Can be specified multiple times'))
 parser.add_argument('-e', '--engine', dest='engine', action='store',
-                    default='cli', help='What chat engine to use. Slack or cli')
+                    default='cli',
+                    help='What chat engine to use: cli, slack or slack-events')
 parser.add_argument('-m', '--memory', dest='memory', action='store',
-                    default='dict', help='What persistent storage to use.')
+                    default='dict', help=('What persistent storage to use: '
+                                          'dict, file, redis or redis-async'))
+parser.add_argument('--memory-cache', dest='memory_cache', metavar='entries',
+                    action='store', type=int, default=0,
+                    help='Cache up to this many memory values in-process.')
+parser.add_argument('--memory-cache-ttl', dest='memory_cache_ttl', metavar='seconds',
+                    action='store', type=float, default=None,
+                    help='Expire cached memory values after this many seconds.')
+parser.add_argument('--memory-cache-mode', dest='memory_cache_mode',
+                    action='store', default='through', choices=['through', 'behind'],
+                    help=('Write cached values to the memory engine immediately '
+                          '(through) or in periodic batches (behind).'))
 
 # NOTE: Since the variable is start_web_app, it does actually default True.
 parser.add_argument('--no-web-app', dest='start_web_app', action='store_false',
@@ -68,10 +81,20 @@ def start_ioloop():
 def start_alphabot():
     bot = alphabot.bot.get_instance(engine=args.engine, start_web_app=args.start_web_app)
     memory = args.memory
+    memory_cache = None
+    if args.memory_cache:
+        memory_cache = {'max_entries': args.memory_cache,
+                        'ttl': args.memory_cache_ttl,
+                        'write_mode': args.memory_cache_mode}
 
     full_path_scripts = [os.path.abspath(s) for s in args.scripts]
     log.debug('full path scripts: %s' % full_path_scripts)
-    yield bot.setup(memory_type=memory, script_paths=full_path_scripts)
+    yield bot.setup(memory_type=memory, script_paths=full_path_scripts,
+                    memory_cache=memory_cache)
+
+    # `kill -HUP <pid>` reloads the scripts that changed.
+    ioloop.IOLoop.current().asyncio_loop.add_signal_handler(
+        signal.SIGHUP, lambda: alphabot.bot.handle_exceptions(bot.reload_scripts(), None))
     yield bot.start()
 
 if __name__ == '__main__':
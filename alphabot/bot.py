@@ -1,10 +1,7 @@
-from __future__ import print_function
-
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
-
+import contextlib
+import hashlib
+import hmac
+import itertools
 import json
 import logging
 import mock
@@ -14,16 +11,23 @@ import re
 import sys
 import time
 import traceback
-try:
-    from urllib import urlencode
-except ImportError:
-    from urllib.parse import urlencode
+import zlib
+from io import StringIO
+from urllib.parse import urlencode
 
 from apscheduler.schedulers.tornado import TornadoScheduler
-from tornado import websocket, gen, httpclient, ioloop, web
+from tornado import gen, ioloop, queues, web
 
+from alphabot import directory
+from alphabot import dispatch
+from alphabot import executor
 from alphabot import help
 from alphabot import memory
+from alphabot import outbox
+from alphabot import rtm
+from alphabot import slack_client
+from alphabot import stats
+from alphabot.dispatch import dict_subset
 
 DEFAULT_SCRIPT_DIR = 'default-scripts'
 DEBUG_CHANNEL = os.getenv('DEBUG_CHANNEL', 'alphabot')
@@ -31,6 +35,34 @@ DEBUG_CHANNEL = os.getenv('DEBUG_CHANNEL', 'alphabot')
 WEB_PORT = int(os.getenv('WEB_PORT', 8000))
 WEB_PORT_SSL = int(os.getenv('WEB_PORT_SSL', 8443))
 
+# Events waiting for dispatch. Producers block once this many are queued.
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', 1000))
+# Events that Slack delivers again within this many seconds are dispatched
+# once. Up to this many recent events are remembered.
+EVENT_DEDUP_WINDOW = float(os.getenv('EVENT_DEDUP_WINDOW', 600))
+EVENT_DEDUP_SIZE = int(os.getenv('EVENT_DEDUP_SIZE', 10000))
+
+# Seconds between checks for changed scripts, which are then reloaded.
+# 0 disables the checks; scripts are still reloaded on SIGHUP.
+SCRIPTS_RELOAD_INTERVAL = float(os.getenv('SCRIPTS_RELOAD_INTERVAL', 0))
+
+# Seconds between full reloads of the Slack users and channels. Events keep
+# them up to date in between. 0 disables the periodic reload.
+SLACK_RESYNC_INTERVAL = float(os.getenv('SLACK_RESYNC_INTERVAL', 6 * 3600))
+# Items per page when loading users and channels.
+SLACK_PAGE_SIZE = int(os.getenv('SLACK_PAGE_SIZE', 200))
+# Messages per second sent over RTM, and how many may go at once after a
+# pause. Slack allows about one per second, with short bursts.
+SLACK_SEND_RATE = float(os.getenv('SLACK_SEND_RATE', 1))
+SLACK_SEND_BURST = int(os.getenv('SLACK_SEND_BURST', 5))
+# Seconds to wait for Slack to acknowledge a sent message.
+SLACK_ACK_TIMEOUT = float(os.getenv('SLACK_ACK_TIMEOUT', 10))
+
+# Events API engine: the web app path Slack posts events to, and the most
+# seconds a request may take to arrive.
+SLACK_EVENTS_PATH = os.getenv('SLACK_EVENTS_PATH', '/slack/events')
+SLACK_EVENTS_MAX_AGE = int(os.getenv('SLACK_EVENTS_MAX_AGE', 300))
+
 log = logging.getLogger(__name__)
 log_level = logging.getLevelName(os.getenv('LOG_LEVEL', 'INFO'))
 log.setLevel(log_level)
@@ -58,7 +90,7 @@ def get_instance(engine='cli', start_web_app=False):
     """Get an Alphabot instance.
 
     Args:
-        engine (str): Type of Alphabot to create ('cli', 'slack')
+        engine (str): Type of Alphabot to create ('cli', 'slack', 'slack-events')
         start_web_app (bool): Whether to start a web server with the engine.
 
     Returns:
@@ -67,7 +99,8 @@ def get_instance(engine='cli', start_web_app=False):
     if not Bot.instance:
         engine_map = {
             'cli': BotCLI,
-            'slack': BotSlack
+            'slack': BotSlack,
+            'slack-events': BotSlackEvents,
         }
         if not engine_map.get(engine):
             raise InvalidOptions('Bot engine "%s" is not available.' % engine)
@@ -110,11 +143,10 @@ def handle_exceptions(future, chat):
     future.add_done_callback(cb)
 
 
-def dict_subset(big, small):
-    try:
-        return small.viewitems() <= big.viewitems()  # Python 2.7
-    except AttributeError:
-        return small.items() <= big.items()  # Python 3
+def takes_context(function):
+    """Mark an internal listener that wants the event's shared EventContext."""
+    function._takes_context = True
+    return function
 
 
 class MetaString(str):
@@ -127,6 +159,51 @@ class HealthCheck(web.RequestHandler):
         self.write('ok')
 
 
+class StatsHandler(web.RequestHandler):
+    """Runtime counters of the bot as JSON."""
+    def get(self):
+        self.write(stats.snapshot())
+
+
+def _module_version(filename, known=None):
+    """(mtime and size, digest) of a script file. Only read if they changed."""
+    info = os.stat(filename)
+    stamp = (info.st_mtime, info.st_size)
+    if known and known[0] == stamp:
+        return known
+    with open(filename, 'rb') as source:
+        return stamp, hashlib.sha1(source.read()).hexdigest()
+
+
+def slack_signature(secret, timestamp, body):
+    """The X-Slack-Signature of a request `body` sent at `timestamp`."""
+    base = b'v0:' + str(timestamp).encode('utf-8') + b':' + body
+    return 'v0=' + hmac.new(secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+
+
+class SlackEventsHandler(web.RequestHandler):
+    """Receives Slack Events API requests for BotSlackEvents.
+
+    Answers as soon as the request is verified. The event is dispatched
+    later, like every other event.
+    """
+    def initialize(self, bot):
+        self.bot = bot
+
+    def post(self):
+        start = time.time()
+        if not self.bot._verify_request(self.request.headers, self.request.body):
+            stats.incr('slack.events.rejected')
+            raise web.HTTPError(403)
+
+        payload = json.loads(self.request.body)
+        if payload.get('type') == 'url_verification':
+            self.write({'challenge': payload.get('challenge')})
+            return
+        self.bot._receive(payload)
+        stats.observe('slack.events.ack_ms', (time.time() - start) * 1000)
+
+
 class Bot(object):
 
     instance = None
@@ -134,12 +211,32 @@ class Bot(object):
 
     def __init__(self, start_web_app=False):
         self.memory = None
-        self.event_listeners = []
-        self._web_events = []
+        self.event_listeners = dispatch.ListenerIndex()
+        self._commands = dispatch.CommandRouter()
+        self._waiters = dispatch.WaiterRegistry()
+        self._executor = executor.HandlerExecutor(error_handler=handle_exceptions)
+        # Every event source (chat socket, web handlers, stdin) feeds this
+        # FIFO queue, which Bot.start drains.
+        self._events = queues.Queue(maxsize=EVENT_QUEUE_SIZE)
+        stats.gauge('events.queue.depth', self._events.qsize)
+        stats.gauge('events.queue.maxsize', lambda: self._events.maxsize)
+        self._dedup = dispatch.DedupWindow(EVENT_DEDUP_SIZE, EVENT_DEDUP_WINDOW)
+        stats.gauge('events.dedup.size', lambda: len(self._dedup))
         self._on_start = []
+        self._start_modules = {}  # on_start function -> path of its module.
 
         self.help = help.Help()
         self._function_map = {}
+        # The single listener routing messages to the commands.
+        self._commands_listener = ({'type': 'message'}, self._dispatch_commands)
+
+        # Script modules: how to undo what each registered, and the version
+        # of the code it was loaded from (see _module_version).
+        self.module_path = None
+        self._registrations = {}
+        self._modules = {}
+        self._script_dirs = []
+        self._web_rules = {}  # path -> web app rule added by add_web_handler.
         self._web_app = None
         if start_web_app:
             self._web_app = self.make_web_app()
@@ -153,7 +250,8 @@ class Bot(object):
         """
         log.info('Creating a web app')
         return web.Application([
-            (r'/health_check', HealthCheck)
+            (r'/health_check', HealthCheck),
+            (r'/stats', StatsHandler),
         ])
 
     def _start_web_app(self):
@@ -176,6 +274,9 @@ class Bot(object):
     def add_web_handler(self, path, handler):
         """Adds a Handler to a web app.
 
+        Adding a handler for the same `path` again, as a reloaded script
+        does, replaces the previous one.
+
         Args:
             path (string): Path where the handler should be served.
             handler (web.RequestHandler): Handler to use.
@@ -186,50 +287,165 @@ class Bot(object):
         if not self._web_app:
             raise WebApplicationNotAvailable
 
+        # Tornado serves the first matching rule, so drop the old one.
+        rules = self._web_app.default_router.rules
+        previous = self._web_rules.pop(path, None)
+        if previous in rules:
+            rules.remove(previous)
         self._web_app.add_handlers('.*', [(path, handler)])
+        # add_handlers inserts its rule before the last, catch-all one.
+        self._web_rules[path] = rules[-2]
 
     @gen.coroutine
-    def setup(self, memory_type, script_paths):
-        yield self._setup_memory(memory_type=memory_type)
+    def setup(self, memory_type, script_paths, memory_cache=None):
+        """Prepare the bot to start.
+
+        Args:
+            memory_type (str): Memory engine, see `memory.ENGINES`.
+            script_paths (list): Directories of scripts to load.
+            memory_cache (dict): If set, wrap the memory engine in a
+                `memory.MemoryCache` built with these keyword arguments.
+        """
+        yield self._setup_memory(memory_type=memory_type, cache=memory_cache)
         yield self._setup()  # Engine specific setup
         yield self._gather_scripts(script_paths)
 
     @gen.coroutine
-    def _setup_memory(self, memory_type='dict'):
-
-        # TODO: memory module should provide this mapping.
-        memory_map = {
-            'dict': memory.MemoryDict,
-            'redis': memory.MemoryRedis,
-        }
+    def _setup_memory(self, memory_type='dict', cache=None):
 
         # Get associated memory class or default to Dict memory type.
-        MemoryClass = memory_map.get(memory_type)
+        MemoryClass = memory.ENGINES.get(memory_type)
         if not MemoryClass:
             raise InvalidOptions(
                 'Memory type "%s" is not available.' % memory_type)
 
         self.memory = MemoryClass()
+        if cache:
+            log.info('Caching memory: %s' % (cache,))
+            try:
+                self.memory = memory.MemoryCache(self.memory, **cache)
+            except ValueError as e:
+                raise InvalidOptions(e)
         yield self.memory.setup()
 
     def load_all_modules_from_dir(self, dirname):
         log.debug('Loading modules from "%s"' % dirname)
+        if dirname not in self._script_dirs:
+            self._script_dirs.append(dirname)
         for importer, package_name, _ in pkgutil.iter_modules([dirname]):
-            self.module_path = "%s/%s" % (dirname, package_name)
-            log.debug("Importing '%s'" % package_name)
+            self._load_module(importer, dirname, package_name)
+
+    def _load_module(self, importer, dirname, package_name):
+        """Imports a script module. Returns whether it worked."""
+        self.module_path = "%s/%s" % (dirname, package_name)
+        log.debug("Importing '%s'" % package_name)
+        try:
+            loader = importer.find_module(package_name)
+            self._modules[self.module_path] = _module_version(
+                loader.get_filename(package_name))
+            loader.load_module(package_name)
+        except Exception as e:
+            log.critical('Could not load `%s`. Error follows.' % package_name)
+            log.critical(e, exc_info=1)
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback_string = StringIO()
+            traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                      file=traceback_string)
+            self.send(
+                'Could not load `%s` from %s.' % (package_name, dirname),
+                DEBUG_CHANNEL)
+            self.send(traceback_string.getvalue(), DEBUG_CHANNEL)
+            return False
+        finally:
+            self.module_path = None
+        return True
+
+    @gen.coroutine
+    def reload_scripts(self):
+        """Reloads the script modules whose code changed, and loads new ones.
+
+        A changed module's listeners, commands, help, API functions, start
+        functions and scheduled jobs are replaced by those of its new code,
+        without yielding to other events in between. If the new code fails
+        to import, the old registrations stay. Start functions of reloaded
+        modules run again, and web handlers they add replace those of the
+        same path. Connections and caches are kept.
+
+        Returns:
+            list: Paths of the reloaded modules.
+        """
+        reloaded = []
+        started = set(self._on_start)
+        found = set()
+        for dirname in self._script_dirs:
+            for importer, package_name, _ in pkgutil.iter_modules([dirname]):
+                module_path = "%s/%s" % (dirname, package_name)
+                found.add(module_path)
+                known = self._modules.get(module_path)
+                try:
+                    filename = importer.find_module(package_name).get_filename(package_name)
+                    version = _module_version(filename, known)
+                except (IOError, OSError):
+                    continue  # Deleted meanwhile.
+                if known and version[1] == known[1]:
+                    self._modules[module_path] = version  # Touched, not changed.
+                    continue
+                if self._reload_module(importer, dirname, package_name):
+                    reloaded.append(module_path)
+
+        for module_path in set(self._modules) - found:
+            log.info('Script %s was removed. Unregistering it.' % module_path)
+            del self._modules[module_path]
+            self._unregister(self._registrations.pop(module_path, []))
+            reloaded.append(module_path)
+
+        if reloaded:
+            log.info('Reloaded scripts: %s' % ', '.join(reloaded))
+            stats.incr('scripts.reloads', len(reloaded))
+        for function in [f for f in self._on_start if f not in started]:
+            yield self._run_on_start(function)
+        raise gen.Return(reloaded)
+
+    def _reload_module(self, importer, dirname, package_name):
+        module_path = "%s/%s" % (dirname, package_name)
+        old = self._registrations.pop(module_path, [])
+        old_module = sys.modules.pop(package_name, None)
+        # The new code replaces API functions of the same names.
+        function_map = dict(self._function_map)
+        if not self._load_module(importer, dirname, package_name):
+            self._unregister(self._registrations.pop(module_path, []))
+            self._registrations[module_path] = old
+            self._function_map.clear()
+            self._function_map.update(function_map)
+            if old_module is not None:
+                sys.modules[package_name] = old_module
+            return False
+        self._unregister(old)
+        return True
+
+    def _track(self, undo):
+        """Remember how to undo a registration of the module being loaded.
+
+        Registrations made at runtime belong to no module, and stay.
+        """
+        if self.module_path is not None:
+            self._registrations.setdefault(self.module_path, []).append(undo)
+
+    def _run_on_start(self, function):
+        """Calls an `on_start` function, tracking what it registers under its
+        module until its first yield."""
+        self.module_path = self._start_modules.get(function)
+        try:
+            return function()
+        finally:
+            self.module_path = None
+
+    def _unregister(self, registrations):
+        for undo in reversed(registrations):
             try:
-                importer.find_module(package_name).load_module(package_name)
+                undo()
             except Exception as e:
-                log.critical('Could not load `%s`. Error follows.' % package_name)
-                log.critical(e, exc_info=1)
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback_string = StringIO()
-                traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                          file=traceback_string)
-                self.send(
-                    'Could not load `%s` from %s.' % (package_name, dirname),
-                    DEBUG_CHANNEL)
-                self.send(traceback_string.getvalue(), DEBUG_CHANNEL)
+                log.warning('Could not unregister %s: %s' % (undo, e))
 
     @gen.coroutine
     def _gather_scripts(self, script_paths=[]):
@@ -247,9 +463,43 @@ class Bot(object):
         self.load_all_modules_from_dir(
             "{path}/{default}".format(path=pwd, default=DEFAULT_SCRIPT_DIR))
 
+    @gen.coroutine
+    def put_event(self, event):
+        """Queue an event for dispatch. Waits while the queue is full."""
+        if self._events.full():
+            log.warning('Event queue is full (%s). Waiting for room.' % self._events.maxsize)
+            stats.incr('events.queue.blocked')
+        yield self._events.put(event)
+        stats.incr('events.queue.put')
+
     def _event(self, payload):
-        log.info('Adding an event on top of the stack: %s' % payload)
-        self._web_events.append(payload)
+        log.info('Adding an event to the queue: %s' % payload)
+        return self.put_event(payload)
+
+    @gen.coroutine
+    def _get_next_event(self):
+        event = yield self._events.get()
+        stats.incr('events.queue.get')
+        raise gen.Return(event)
+
+    def _start_ingest(self):
+        """Start the engine's event producers. Called by `start`."""
+
+    # Event types the engine needs in `_update_state`, listened to or not.
+    _state_types = frozenset()
+
+    def _accepts(self, event_type):
+        """Whether events of `event_type` need dispatching. Counts them either way.
+
+        Engines check it before decoding or queueing an event, to drop the
+        events no listener, waiter or engine state update wants.
+        """
+        if (event_type in self._state_types or self.event_listeners.wants_type(event_type) or
+                self._waiters.wants_type(event_type)):
+            stats.incr('events.ingest.%s' % event_type)
+            return True
+        stats.incr('events.dropped.%s' % event_type)
+        return False
 
     @gen.coroutine
     def start(self):
@@ -257,89 +507,94 @@ class Bot(object):
             log.info('Starting web app.')
             self._start_web_app()
 
+        # Ingest first: start scripts may send messages and wait for replies.
+        # Events queue up until the scripts are done.
+        log.info('Listening to events.')
+        self._start_ingest()
+
         log.info('Executing the start scripts.')
         for function in self._on_start:
             log.debug('On Start: %s' % function.__name__)
-            yield function()
+            yield self._run_on_start(function)
 
-        log.info('Bot started! Listening to events.')
+        log.info('Bot started!')
+        if SCRIPTS_RELOAD_INTERVAL:
+            self._reload_callback = ioloop.PeriodicCallback(
+                self.reload_scripts, SCRIPTS_RELOAD_INTERVAL * 1000)
+            self._reload_callback.start()
 
         while True:
             event = yield self._get_next_event()
-
-            log.debug('Received event: %s' % event)
-            log.debug('Checking against %s listeners' % len(self.event_listeners))
-
-            event_matched = False
-
-            # Note: Copying the event_listeners list here to prevent
-            # mid-loop modification of the list.
-            for kwargs, function in list(self.event_listeners):
-                match = self._check_event_kwargs(event, kwargs)
-                log.debug('Function %s requires %s. Match: %s' % (
-                    function.__name__, kwargs, match))
-                if match:
-                    event_matched = True
-                    # XXX Rethink creating a chat object. Only using it for error handling
-                    chat = yield self.event_to_chat(event)
-                    future = function(event=event)
-                    handle_exceptions(future, chat)
-
-                # Figure out why this was added
-                yield gen.moment
-
-            if not event_matched:
-                # Add no-match handler. Mainly for Fallbakc like API.AI
-                # Maybe add @bot.fallback() ?
-                # But there should be only one fallback handler
-                pass
+            if self._is_duplicate(event):
+                continue
+            yield self._dispatch(event)
+
+    def _is_duplicate(self, event):
+        """Whether `event` was dispatched already, e.g. delivered again by Slack."""
+        key = dispatch.event_key(event)
+        if key is None or not self._dedup.seen(key):
+            return False
+        log.debug('Dropping duplicate event %s', key)
+        stats.incr('events.duplicates')
+        return True
 
     @gen.coroutine
-    def wait_for_event(self, **event_args):
-        # Demented python scope.
-        # http://stackoverflow.com/questions/4851463/python-closure-write-to-variable-in-parent-scope
-        # This variable could be an object, but instead it's a single-element list.
-        event_matched = []
-
-        @gen.coroutine
-        def mark_true(event):
-            event_matched.append(event)
-
-        log.info('Creating a temporary listener for %s' % (event_args,))
-        self.event_listeners.append((event_args, mark_true))
-
-        while not event_matched:
-            yield gen.moment
-
-        log.info('Deleting the temporary listener for %s' % (event_args,))
-        self.event_listeners.remove((event_args, mark_true))
-
-        raise gen.Return(event_matched[0])
+    def _dispatch(self, event):
+        """Invoke every listener that matches `event`."""
+        log.debug('Received event: %s', event)
+        try:
+            self._update_state(event)
+        except Exception as e:
+            # A malformed event must not stop the bot; its listeners still run.
+            log.error('Could not update state from %s: %s', event, e, exc_info=1)
+            stats.incr('slack.directory.update_errors')
+        resolved = self._waiters.dispatch(event)
+        matches = self.event_listeners.match(event)
+        log.debug('Resolved %s waiters. Matched %s of %s listeners',
+                  resolved, len(matches), len(self.event_listeners))
+
+        event_matched = bool(resolved or matches)
+
+        # Built once and shared by every handler of this event.
+        context = EventContext(self, event)
+
+        # Note: `match` returns a new list, so listeners may add or remove
+        # themselves mid-loop.
+        for kwargs, function in matches:
+            log.debug('Function %s requires %s', function.__name__, kwargs)
+            if getattr(function, '_takes_context', False):
+                # Internal listeners only fan out, so they skip the executor.
+                future = function(event=event, context=context)
+                handle_exceptions(future, context.chat)
+            else:
+                self._executor.submit(function, {'event': event}, context.chat)
 
-    def _add_listener(self, chat, **kwargs):
-        log.info('Adding chat listener...')
+        # Give the handlers started above a chance to run before reading
+        # the next event.
+        yield gen.moment
 
-        @gen.coroutine
-        def cmd(event):
-            message = yield self.event_to_chat(event)
-            chat.hear(message)
+        if not event_matched:
+            # Add no-match handler. Mainly for Fallbakc like API.AI
+            # Maybe add @bot.fallback() ?
+            # But there should be only one fallback handler
+            pass
 
-        # Uniquely identify this `cmd` to delete later.
-        cmd._listener_chat_id = id(chat)
+    def wait_for_event(self, timeout=None, **event_args):
+        """Returns a Future resolved with the next event matching `event_args`.
 
-        if 'type' not in kwargs:
-            kwargs['type'] = 'message'
+        Args:
+            timeout (float): Seconds to wait before the Future fails with
+                gen.TimeoutError. Waits forever by default.
 
-        self._register_function(kwargs, cmd)
+        Use `bot.cancel_wait(future)` to stop waiting early. A handler frees
+        its concurrency slot while it waits.
+        """
+        log.info('Waiting for an event matching %s' % (event_args,))
+        return self._executor.waiting(self._waiters.wait(event_args, timeout=timeout))
 
-    def _remove_listener(self, chat):
-        match = None
-        # Have to search all the event_listeners here
-        for kw, function in self.event_listeners:
-            if (hasattr(function, '_listener_chat_id') and
-                    function._listener_chat_id == id(chat)):
-                match = (kw, function)
-        self.event_listeners.remove(match)
+    def cancel_wait(self, future):
+        """Stop waiting for an event. See `wait_for_event`."""
+        self._waiters.cancel(future)
 
     def _check_event_kwargs(self, event, kwargs):
         """Check that all expected kwargs were satisfied by the event."""
@@ -349,17 +604,31 @@ class Bot(object):
 
     def on_start(self, function):
         self._on_start.append(function)
+        self._start_modules[function] = self.module_path
+
+        def undo():
+            self._on_start.remove(function)
+            self._start_modules.pop(function, None)
+        self._track(undo)
         return function
 
     def _register_function(self, kwargs, function):
         log.debug('New Listener: %s => %s()' % (kwargs, function.__name__))
-        self.event_listeners.append((kwargs, function))
+        listener = (kwargs, function)
+        self.event_listeners.append(listener)
+        self._track(lambda: self.event_listeners.remove(listener))
 
     def _register_api_call(self, function):
         function_api_name = "alphabot:%s:%s" % (self.module_path, function.__name__)
         log.debug('Registering api: %s' % function_api_name)
         self._function_map.update({function_api_name: function})
 
+        def undo():
+            # The module's new code may have registered the same name.
+            if self._function_map.get(function_api_name) is function:
+                del self._function_map[function_api_name]
+        self._track(undo)
+
     def on(self, **kwargs):
         """This decorator will invoke your function with the raw event."""
         def decorator(function):
@@ -374,38 +643,97 @@ class Bot(object):
         def decorator(function):
             # Register some basic help using the regex.
             self.help.update(function, regex)
+            self._track(lambda: self.help.remove(function))
 
-            @gen.coroutine
-            def cmd(event):
-                message = yield self.event_to_chat(event)
-                matches_regex = message.matches_regex(regex)
-                log.debug('Command %s should match the regex %s' % (function.__name__, regex))
-                if not direct and not matches_regex:
-                    return
-
-                if direct:
-                    # TODO maybe make it better...
-                    # TODO definitely refactor this garbage: message.is_direct()
-                    # or better yet: message.matches(regex, direct)
-                    # Here's how Hubot did it:
-                    # https://github.com/github/hubot/blob/master/src/robot.coffee#L116
-                    is_direct = False
-                    # is_direct = (message.channel.startswith('D') or
-                    #             message.matches_regex("^@?%s:?\s" % self._user_id, save=False))
-                    if not is_direct:
-                        return
-                yield function(message=message, **message.regex_group_dict)
-            cmd.__name__ = 'wrapped:%s' % function.__name__
-
-            self._register_function({'type': 'message'}, cmd)
+            if not len(self._commands):
+                # A single listener routes every message to the commands.
+                self.event_listeners.append(self._commands_listener)
+            command = self._commands.add(regex, function, direct)
+            self._track(lambda: self._remove_command(command))
             self._register_api_call(function)
             return function
 
         return decorator
 
+    def _remove_command(self, command):
+        self._commands.remove(command)
+        if not len(self._commands):
+            self.event_listeners.remove(self._commands_listener)
+
+    @takes_context
+    @gen.coroutine
+    def _dispatch_commands(self, event, context):
+        """Invoke every command whose regex matches the message text."""
+        for command, match in self._commands.route(event.get('text')):
+            log.debug('Command %s matches the regex %s' % (
+                command.function.__name__, command.regex))
+
+            if command.direct:
+                # TODO maybe make it better...
+                # TODO definitely refactor this garbage: message.is_direct()
+                # or better yet: message.matches(regex, direct)
+                # Here's how Hubot did it:
+                # https://github.com/github/hubot/blob/master/src/robot.coffee#L116
+                is_direct = False
+                # is_direct = (message.channel.startswith('D') or
+                #             message.matches_regex("^@?%s:?\s" % self._user_id, save=False))
+                if not is_direct:
+                    continue
+
+            # Each command gets its own Chat for its regex groups, but they all
+            # share the context's channel and user lookups.
+            message = self._make_chat(context)
+            message.regex_groups = match.groups()
+            message.regex_group_dict = match.groupdict()
+            kwargs = dict(message.regex_group_dict, message=message)
+            self._executor.submit(command.function, kwargs, message)
+
+    def limit(self, concurrency=None, policy=executor.QUEUE, queue_size=None):
+        """Limit how many copies of a handler may run at once.
+
+        Apply it next to `on` or `add_command`:
+
+            @bot.add_command('report')
+            @bot.limit(concurrency=2, policy='reject')
+            @gen.coroutine
+            def report(message):
+                ...
+
+        Args:
+            concurrency (int): Maximum running copies of the handler.
+            policy (str): What to do with new calls while the handler is at
+                its limit: 'queue' them (default), 'drop_oldest' queued call
+                to make room, or 'reject' them with a "too busy" reply.
+            queue_size (int): Maximum queued calls of the handler.
+        """
+        return self._executor.limit(concurrency, policy, queue_size)
+
+    def blocking(self, function):
+        """Decorator for functions that block, e.g. synchronous HTTP clients.
+
+        Calls run on a bounded thread pool (BLOCKING_THREADS threads) and
+        return a Future, so the IOLoop keeps serving other chats:
+
+            @bot.blocking
+            def fetch_report(url):
+                return requests.get(url).json()
+
+            report = yield fetch_report(url)
+        """
+        return executor.get_blocking_pool().blocking(function)
+
+    def run_in_executor(self, function, *args, **kwargs):
+        """Run a blocking `function(*args, **kwargs)` on the thread pool.
+
+        Returns:
+            Future: Resolves with the function's result.
+        """
+        return executor.get_blocking_pool().submit(function, *args, **kwargs)
+
     def add_help(self, desc=None, usage=None, tags=None):
         def decorator(function):
             self.help.update(function, usage=usage, desc=desc, tags=tags)
+            self._track(lambda: self.help.remove(function))
             return function
         return decorator
 
@@ -436,14 +764,40 @@ class Bot(object):
         def decorator(function):
             log.info('New Schedule: cron[%s] => %s()' % (schedule_keywords,
                                                          function.__name__))
-            scheduler.add_job(ioloop.IOLoop.instance().add_callback,
+            job = scheduler.add_job(ioloop.IOLoop.instance().add_callback,
                     'cron', args=[function], **schedule_keywords)
+            self._track(job.remove)
             return function
 
         return decorator
 
     # Functions that scripts can tell bot to execute.
 
+    @gen.coroutine
+    def event_to_chat(self, event):
+        raise gen.Return(EventContext(self, event).chat)
+
+    def _make_chat(self, context):
+        event = context.event
+        return Chat(text=event.get('text'),
+                    user=event.get('user'),
+                    channel=None,
+                    raw=event,
+                    bot=self,
+                    context=context)
+
+    def _update_state(self, event):
+        """Engine hook: update cached users, channels etc. from `event`.
+
+        Called before the event reaches any listener.
+        """
+
+    def _channel_for_event(self, event):
+        return self.get_channel(id=event.get('channel'))
+
+    def _get_user(self, uid):
+        return None
+
     @gen.coroutine
     def send(self, text, to):
         raise CoreException('Chat engine "%s" is missing send(...)' % (
@@ -471,7 +825,6 @@ class BotCLI(Bot):
         ioloop.IOLoop.instance().add_handler(
             sys.stdin, self.capture_input, ioloop.IOLoop.READ)
 
-        self.input_line = None
         self._user_id = 'U123'
         self._user_name = 'alphabot'
         self._token = ''
@@ -482,28 +835,14 @@ class BotCLI(Bot):
         print('\033[4mAlphabot\033[0m> ', end='')
 
     def capture_input(self, fd, events):
-        self.input_line = fd.readline().strip()
-        if self.input_line is None or self.input_line == '':
-            self.input_line = None
+        user_input = fd.readline().strip()
+        if user_input:
+            event = {'type': 'message',
+                     'user': 'User',
+                     'text': user_input}
+            ioloop.IOLoop.current().spawn_callback(self.put_event, event)
         self.print_prompt()
 
-    @gen.coroutine
-    def _get_next_event(self):
-        if len(self._web_events):
-            event = self._web_events.pop()
-            raise gen.Return(event)
-
-        while not self.input_line:
-            yield gen.moment
-
-        user_input = self.input_line
-        self.input_line = None
-
-        event = {'type': 'message',
-                 'text': user_input}
-
-        raise gen.Return(event)
-
     @gen.coroutine
     def api(self, method, params=None):
         if not params:
@@ -518,14 +857,8 @@ class BotCLI(Bot):
         }
         raise gen.Return(response)
 
-    @gen.coroutine
-    def event_to_chat(self, event):
-        return Chat(
-            text=event['text'],
-            user='User',
-            channel=Channel(self, {'id': 'CLI'}),
-            raw=event,
-            bot=self)
+    def _channel_for_event(self, event):
+        return Channel(self, {'id': 'CLI'})
 
     @gen.coroutine
     def send(self, text, to):
@@ -571,6 +904,15 @@ class BotCLI(Bot):
 class BotSlack(Bot):
 
     engine = 'slack'
+    transport = 'rtm'
+
+    _users = None
+    _channels = None
+    _acks = None
+
+    def __init__(self, *args, **kwargs):
+        super(BotSlack, self).__init__(*args, **kwargs)
+        self._state_buffers = []  # See _buffer_state.
 
     @gen.coroutine
     def _setup(self):
@@ -578,8 +920,24 @@ class BotSlack(Bot):
 
         if not self._token:
             raise InvalidOptions('SLACK_TOKEN required for slack engine.')
+        self._web_api = slack_client.SlackClient(self._token)
+        self._message_ids = itertools.count(1)
+        self._rtm = rtm.RTMSession(self._rtm_start, self._ingest, on_reconnect=self._resync,
+                                   ids=self._message_ids, accepts=self._accepts)
 
         log.info('Authenticating...')
+        yield self._rtm.connect()
+
+        yield self._update_channels()
+        yield self._update_users()
+
+        self._outbox = outbox.Outbox(self._write, rate=SLACK_SEND_RATE,
+                                     burst=SLACK_SEND_BURST, name='slack.send')
+        self._acks = outbox.AckTable(SLACK_ACK_TIMEOUT, name='slack.send')
+
+    @gen.coroutine
+    def _rtm_start(self):
+        """Logs in with `rtm.start`. Returns the websocket URL."""
         try:
             response = yield self.api('rtm.start')
         except Exception as e:
@@ -592,97 +950,195 @@ class BotSlack(Bot):
                 response.get('error', 'No error specified'), response))
             raise InvalidOptions('Login failed')
 
-        self.socket_url = response['url']
-        self.connection = yield websocket.websocket_connect(self.socket_url)
-
         self._user_id = response['self']['id']
         self._user_name = response['self']['name']
-
-        yield self._update_channels()
-        yield self._update_users()
-
-        self._too_fast_warning = False
+        self.socket_url = response['url']
+        raise gen.Return(self.socket_url)
 
     def _get_user(self, uid):
-        match = [u for u in self._users if u['id'] == uid]
-        if match:
-            return User(match[0])
-
-        # TODO: handle this better?
-        return None
+        # TODO: handle unknown users better?
+        return self._users.get(uid)
 
     @gen.coroutine
-    def _update_users(self):
-        response = yield self.api('users.list')
-        self._users = response['members']
+    def _load_pages(self, method, key, add, params=None):
+        """Calls `add` with every item of a cursor-paginated list method.
 
-    @gen.coroutine
-    def _update_channels(self):
-        response = yield self.api('channels.list')
-        self._channels = response['channels']
-        response = yield self.api('groups.list')
-        self._channels.extend(response['groups'])
+        Items are handed over page by page, so the whole list is never
+        parsed or held in memory at once.
+        """
+        params = dict(params or {}, limit=SLACK_PAGE_SIZE)
+        while True:
+            response = yield self.api(method, dict(params))
+            if not response.get('ok', True):
+                raise CoreException('API call "%s" to Slack failed: %s' % (
+                    method, response.get('error')))
+            stats.incr('slack.api.pages')
+            for item in response.get(key, []):
+                add(item)
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+            params['cursor'] = cursor
 
     @gen.coroutine
-    def event_to_chat(self, message):
-        channel = self.get_channel(id=message.get('channel'))
-        chat = Chat(text=message.get('text'),
-                    user=message.get('user'),
-                    channel=channel,
-                    raw=message,
-                    bot=self)
-        raise gen.Return(chat)
+    def _update_users(self):
+        # Filled separately, so lookups see the old users until it is done.
+        users = directory.Directory()
+        with self._buffer_state() as events:
+            yield self._load_pages('users.list', 'members', lambda info: users.add(User(info)))
+        self._users = users
+        self._replay_state(events)
 
     @gen.coroutine
-    def _get_next_event(self):
-        """Slack-specific message reader.
-
-        Returns a web event from the API listener if available, otherwise
-        waits for the slack streaming event.
+    def _update_channels(self):
+        channels = directory.Directory()
+        with self._buffer_state() as events:
+            yield self._load_pages('conversations.list', 'channels', channels.add,
+                                   {'types': 'public_channel,private_channel'})
+        self._channels = channels
+        self._replay_state(events)
+
+    @contextlib.contextmanager
+    def _buffer_state(self):
+        """Collects the state events applied meanwhile, to replay them.
+
+        A resync may take minutes. The events it would otherwise lose are
+        applied again to the fresh directory, which may predate them.
         """
+        events = []
+        self._state_buffers.append(events)
+        try:
+            yield events
+        finally:
+            self._state_buffers.remove(events)
 
-        if len(self._web_events):
-            event = self._web_events.pop()
-            raise gen.Return(event)
-
-        # TODO: rewrite this logic to use `on_message` feature of the socket
-        # FIXME: At the moment if there are 0 socket messages then web_events
-        #        will never be handled.
-        message = yield self.connection.read_message()
-        log.debug('Slack message: "%s"' % message)
-        message = json.loads(message)
+    def _replay_state(self, events):
+        for event in events:
+            try:
+                self._update_state(event, replay=True)
+            except Exception as e:
+                log.error('Could not replay %s: %s', event, e)
 
-        raise gen.Return(message)
+    @gen.coroutine
+    def _resync(self):
+        """Reload every user and channel from the API."""
+        log.info('Reloading Slack users and channels.')
+        stats.incr('slack.directory.resyncs')
+        yield [self._update_channels(), self._update_users()]
 
     @gen.coroutine
-    def api(self, method, params=None):
-        client = httpclient.AsyncHTTPClient()
-        if not params:
-            params = {}
-        params.update({'token': self._token})
-        api_url = 'https://slack.com/api/%s' % method
+    def _ingest(self, event):
+        """Queue an event read from the websocket.
 
-        request = '%s?%s' % (api_url, urlencode(params))
-        response = yield client.fetch(request=request)
-        raise gen.Return(json.loads(response.body))
+        Replies to sent messages are handled right away, rather than behind
+        the queue, or before the dispatch loop is even running.
+        """
+        if 'reply_to' in event and self._acks is not None:
+            self._acks.resolve(event)
+            if event.get('ok') is False and (event.get('error') or {}).get('code') == -1:
+                # "slow down, too many messages..."
+                self._outbox.slow_down()
+        yield self.put_event(event)
+
+    def _update_state(self, event, replay=False):
+        update = self._state_updates.get(event.get('type'))
+        if update and self._channels is not None:
+            if not replay:
+                stats.incr('slack.directory.updates')
+                for events in self._state_buffers:
+                    events.append(event)
+            update(self, event)
+
+    def _channel_upsert(self, event):
+        info = event['channel']
+        current = self._channels.get(info['id'])
+        self._channels.add(dict(current, **info) if current else info)
+
+    def _channel_archive(self, event, archived=True):
+        self._channels.update(event['channel'], is_archived=archived)
+
+    def _channel_unarchive(self, event):
+        self._channel_archive(event, archived=False)
+
+    def _channel_deleted(self, event):
+        self._channels.remove(event['channel'])
+
+    # conversations.list has no channel members, so only the bot's own
+    # membership is kept.
+    def _member_joined_channel(self, event, is_member=True):
+        if event['user'] == self._user_id:
+            self._channels.update(event['channel'], is_member=is_member)
+
+    def _member_left_channel(self, event):
+        self._member_joined_channel(event, is_member=False)
+
+    def _user_upsert(self, event):
+        self._users.add(User(event['user']))
+
+    # RTM events applied to the users and channels as they arrive.
+    _state_updates = {
+        'channel_created': _channel_upsert,
+        'channel_joined': _channel_upsert,
+        'channel_rename': _channel_upsert,
+        'group_joined': _channel_upsert,
+        'group_rename': _channel_upsert,
+        'channel_archive': _channel_archive,
+        'group_archive': _channel_archive,
+        'channel_unarchive': _channel_unarchive,
+        'group_unarchive': _channel_unarchive,
+        'channel_deleted': _channel_deleted,
+        'member_joined_channel': _member_joined_channel,
+        'member_left_channel': _member_left_channel,
+        'team_join': _user_upsert,
+        'user_change': _user_upsert,
+    }
+    _state_types = frozenset(_state_updates)
+
+    def _start_ingest(self):
+        handle_exceptions(self._rtm.run(), None)
+        self._start_resync()
+
+    def _start_resync(self):
+        if SLACK_RESYNC_INTERVAL:
+            self._resync_callback = ioloop.PeriodicCallback(
+                self._resync, SLACK_RESYNC_INTERVAL * 1000)
+            self._resync_callback.start()
+
+    def api(self, method, params=None, json_body=False):
+        """Calls a Slack Web API method. See `slack_client.SlackClient.call`."""
+        return self._web_api.call(method, params, json_body)
 
     @gen.coroutine
     def send(self, text, to):
+        """Sends `text` to channel `to` over RTM.
+
+        Returns:
+            dict: Slack's reply, e.g. {'ok': True, 'reply_to': 1, 'ts': ...},
+                or {'ok': False, 'error': {...}} if it failed or there was no
+                reply within SLACK_ACK_TIMEOUT seconds.
+        """
+        message_id = next(self._message_ids)
         payload = json.dumps({
-            "id": 1,
+            "id": message_id,
             "type": "message",
             "channel": to,
             "text": text
         })
-        log.debug('Sending payload: %s' % payload)
-        if self._too_fast_warning:
-            yield gen.sleep(2)
-            self._too_fast_warning = False
-        yield self.connection.write_message(payload)
-        yield gen.sleep(0.1)  # A small sleep here to allow Slack to respond
+        log.debug('Queueing payload: %s' % payload)
+        reply = self._acks.expect(message_id)
+        try:
+            yield self._outbox.send(to, payload)
+        except Exception:
+            self._acks.discard(message_id)
+            raise
+        self._acks.written(message_id)
+        raise gen.Return((yield reply))
+
+    def _write(self, payload):
+        return self._rtm.write(payload)
 
     def get_channel(self, **kwargs):
-        match = [c for c in self._channels if dict_subset(c, kwargs)]
+        match = self._channels.find(**kwargs)
         if len(match) == 1:
             channel = Channel(bot=self, info=match[0])
             return channel
@@ -696,6 +1152,94 @@ class BotSlack(Bot):
         log.warning('Channel match for %s length %s' % (kwargs, len(match)))
 
 
+class BotSlackEvents(BotSlack):
+    """Slack engine receiving events from the Events API instead of RTM.
+
+    Slack posts events to SLACK_EVENTS_PATH of the web app, so the web app
+    must run and be reachable by Slack. Messages are sent with
+    chat.postMessage.
+    """
+
+    # Still Slack to scripts: only the way events arrive differs.
+    transport = 'events'
+
+    @gen.coroutine
+    def _setup(self):
+        self._token = os.getenv('SLACK_TOKEN')
+        self._signing_secret = os.getenv('SLACK_SIGNING_SECRET')
+        if not self._token:
+            raise InvalidOptions('SLACK_TOKEN required for slack-events engine.')
+        if not self._signing_secret:
+            raise InvalidOptions('SLACK_SIGNING_SECRET required for slack-events engine.')
+        if not self._web_app:
+            raise InvalidOptions('The slack-events engine requires the web app.')
+        self._web_api = slack_client.SlackClient(self._token)
+
+        log.info('Authenticating...')
+        response = yield self.api('auth.test')
+        if not response['ok']:
+            log.error('Login failed. Reason: "%s"' % response.get('error'))
+            raise InvalidOptions('Login failed')
+        log.info('Logged in!')
+        self._user_id = response['user_id']
+        self._user_name = response['user']
+
+        yield self._update_channels()
+        yield self._update_users()
+
+        self._outbox = outbox.Outbox(self._post_message, rate=SLACK_SEND_RATE,
+                                     burst=SLACK_SEND_BURST, name='slack.send')
+        self._web_app.add_handlers('.*', [
+            (SLACK_EVENTS_PATH, SlackEventsHandler, {'bot': self})])
+
+    def _start_ingest(self):
+        self._start_resync()
+
+    def _verify_request(self, headers, body):
+        """Whether a request was signed by Slack, recently."""
+        timestamp = headers.get('X-Slack-Request-Timestamp', '')
+        try:
+            if abs(time.time() - int(timestamp)) > SLACK_EVENTS_MAX_AGE:
+                return False
+        except ValueError:
+            return False
+        expected = slack_signature(self._signing_secret, timestamp, body)
+        signature = headers.get('X-Slack-Signature', '')
+        return hmac.compare_digest(expected.encode('utf-8'), signature.encode('utf-8'))
+
+    def _receive(self, payload):
+        """Queues the event of an Events API request, unless seen already."""
+        if payload.get('type') != 'event_callback':
+            stats.incr('slack.events.ignored')
+            return
+        # Retries carry the event_id, which the event itself lacks.
+        event_id = payload.get('event_id')
+        if event_id and self._dedup.seen(event_id):
+            stats.incr('slack.events.duplicates')
+            return
+
+        stats.incr('slack.events.received')
+        if not self._accepts(payload['event'].get('type')):
+            return
+        handle_exceptions(self.put_event(payload['event']), None)
+
+    @gen.coroutine
+    def send(self, text, to):
+        """Sends `text` to channel `to` with chat.postMessage.
+
+        Returns:
+            dict: The API response, e.g. {'ok': True, 'ts': ...}.
+        """
+        response = yield self._outbox.send(to, {'channel': to, 'text': text})
+        raise gen.Return(response)
+
+    def _post_message(self, params):
+        return self.api('chat.postMessage', params)
+
+
+_prompt_ids = itertools.count()
+
+
 class Channel(object):
 
     def __init__(self, bot, info):
@@ -705,10 +1249,11 @@ class Channel(object):
     @gen.coroutine
     def send(self, text):
         # TODO: Help make this slack-specfic...
-        yield self.bot.send(text, self.info.get('id'))
+        reply = yield self.bot.send(text, self.info.get('id'))
+        raise gen.Return(reply)
 
     @gen.coroutine
-    def button_prompt(self, text, buttons):
+    def button_prompt(self, text, buttons, timeout=None):
         button_actions = []
         for b in buttons:
             if type(b) == dict:
@@ -722,11 +1267,14 @@ class Channel(object):
                     "value": b
                 })
 
+        # Unique per prompt: a Channel object is shared by every handler of
+        # an event, and one handler may prompt more than once.
+        callback_id = '%s.%s' % (id(self), next(_prompt_ids))
         attachment = {
             "color": "#1E9E5E",
             "text": text,
             "actions": button_actions,
-            "callback_id": str(id(self)),
+            "callback_id": callback_id,
             "fallback": text,
             "attachment_type": "default"
         }
@@ -736,7 +1284,8 @@ class Channel(object):
             'channel': self.info.get('id')})
 
         event = yield self.bot.wait_for_event(type='message-action',
-                                              callback_id=str(id(self)))
+                                              callback_id=callback_id,
+                                              timeout=timeout)
         action_value = MetaString(event['payload']['actions'][0]['value'])
         action_value._meta = {
             'event': event['payload']
@@ -755,34 +1304,143 @@ class Channel(object):
         raise gen.Return(action_value)
 
 
+# Preset zlib dictionary for User payloads: the fields of a typical
+# users.list entry. Small payloads compress several times better with it.
+_USER_ZDICT = json.dumps({
+    'id': '', 'team_id': '', 'name': '', 'deleted': False, 'color': '', 'real_name': '',
+    'tz': 'America/Los_Angeles', 'tz_label': 'Pacific Standard Time', 'tz_offset': -28800,
+    'profile': {
+        'title': '', 'phone': '', 'skype': '', 'real_name': '', 'real_name_normalized': '',
+        'display_name': '', 'display_name_normalized': '', 'fields': None,
+        'status_text': '', 'status_emoji': '', 'status_expiration': 0, 'avatar_hash': '',
+        'email': '', 'first_name': '', 'last_name': '',
+        'image_24': 'https://avatars.slack-edge.com/', 'image_32': '', 'image_48': '',
+        'image_72': '', 'image_192': '', 'image_512': '', 'team': ''},
+    'is_admin': False, 'is_owner': False, 'is_primary_owner': False,
+    'is_restricted': False, 'is_ultra_restricted': False, 'is_bot': False,
+    'is_app_user': False, 'updated': 0, 'has_2fa': False}).encode('utf-8')
+
+
 class User(object):
-    """Wrapper for a User with helpful functions."""
+    """Wrapper for a User with helpful functions.
+
+    The commonly used fields are kept in slots. The full payload is kept
+    zlib-compressed and decoded whenever another field is read, so that
+    large workspaces take little memory. Like the payload, profile fields
+    (e.g. `real_name`, `email`) are available as attributes, and `get`,
+    `[]` and `items` work like on a dict.
+    """
+
+    FIELDS = ('id', 'name', 'real_name', 'display_name', 'email', 'tz',
+              'is_admin', 'is_bot', 'deleted')
+    __slots__ = FIELDS + ('_payload',)
 
     def __init__(self, payload):
         assert type(payload) == dict
-        self.__dict__ = payload
-        self.__dict__.update(payload['profile'])
+        profile = payload.get('profile', {})
+        for field in self.FIELDS:
+            setattr(self, field, profile.get(field, payload.get(field)))
+        compressor = zlib.compressobj(zdict=_USER_ZDICT)
+        data = json.dumps(payload).encode('utf-8')
+        self._payload = compressor.compress(data) + compressor.flush()
+
+    def _fields(self):
+        """Every field of the payload. Profile fields take precedence."""
+        data = zlib.decompressobj(zdict=_USER_ZDICT).decompress(self._payload)
+        fields = json.loads(data.decode('utf-8'))
+        fields.update(fields.get('profile', {}))
+        return fields
+
+    def __getattr__(self, name):
+        # Only called for fields that are not in a slot.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._fields()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return self._fields()[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return self._fields().items()
 
     def __unicode__(self):
         return self.id
 
 
+class EventContext(object):
+    """Per-event state shared by every handler of that event.
+
+    The channel, user and Chat are looked up lazily and at most once, no
+    matter how many listeners and commands match the event.
+    """
+
+    _UNSET = object()
+
+    def __init__(self, bot, event):
+        self.bot = bot
+        self.event = event
+        self._channel = self._UNSET
+        self._user = self._UNSET
+        self._chat = None
+
+    @property
+    def channel(self):
+        if self._channel is self._UNSET:
+            self._channel = self.bot._channel_for_event(self.event)
+        return self._channel
+
+    @property
+    def user(self):
+        """The User object of the event's author, if the engine knows it."""
+        if self._user is self._UNSET:
+            self._user = self.bot._get_user(self.event.get('user'))
+        return self._user
+
+    @property
+    def chat(self):
+        if self._chat is None:
+            self._chat = self.bot._make_chat(self)
+        return self._chat
+
+
 class Chat(object):
     """Wrapper for Message, Bot and helpful functions.
 
     This gets passed to the receiving script's function.
     """
 
-    def __init__(self, text, user, channel, raw, bot):
+    def __init__(self, text, user, channel, raw, bot, context=None):
         self.text = text
         self.user = user  # TODO: Create a User() object
-        self.channel = channel
+        self._channel = channel
+        self._context = context
         self.bot = bot
         self.raw = raw
         self.listening = False
         self.regex_groups = None
         self.regex_group_dict = {}
 
+    @property
+    def channel(self):
+        if self._channel is None and self._context is not None:
+            self._channel = self._context.channel
+        return self._channel
+
+    @channel.setter
+    def channel(self, channel):
+        self._channel = channel
+
     def matches_regex(self, regex, save=True):
         """Check if this message matches the regex.
 
@@ -806,7 +1464,8 @@ class Chat(object):
         """Reply to the original channel of the message."""
         # help hacks
         # help fix direct messages
-        yield self.bot.send(text, to=self.channel.info.get('id'))
+        reply = yield self.bot.send(text, to=self.channel.info.get('id'))
+        raise gen.Return(reply)
 
     @gen.coroutine
     def react(self, reaction):
@@ -817,34 +1476,36 @@ class Chat(object):
             'channel': self.channel.info.get('id')})
 
     @gen.coroutine
-    def button_prompt(self, text, buttons):
-        action = yield self.channel.button_prompt(text, buttons)
+    def button_prompt(self, text, buttons, timeout=None):
+        action = yield self.channel.button_prompt(text, buttons, timeout=timeout)
         raise gen.Return(action)
 
-    # TODO: Add a timeout here. Don't want to hang forever.
     @gen.coroutine
-    def listen_for(self, regex):
-        self.listening = regex
+    def listen_for(self, regex, timeout=None):
+        """Wait for the author of this message to say something matching `regex`.
 
-        # Hang until self.hear() sets this to False
-        self.bot._add_listener(self)
-        while self.listening:
-            yield gen.moment
-        self.bot._remove_listener(self)
+        Args:
+            regex (str): Pattern the new message must start with.
+            timeout (float): Seconds to wait before raising gen.TimeoutError.
+                Waits forever by default.
+        """
+        self.listening = regex
+        try:
+            event = yield self.bot._executor.waiting(self.bot._waiters.wait(
+                {'type': 'message'}, predicate=self._hears, timeout=timeout))
+        finally:
+            self.listening = False
 
+        self.heard_message = yield self.bot.event_to_chat(event)
         raise gen.Return(self.heard_message)
 
-    @gen.coroutine
-    def hear(self, new_message):
-        """Invoked by the Bot class to note that `message` was heard."""
+    def _hears(self, event):
+        """Whether a new message event is the reply listen_for waits for."""
 
         # TODO: some flag should control this filter
-        if new_message.user != self.user:
+        if event.get('user') != self.user:
             log.debug('Heard this from a wrong user.')
-            return
+            return False
 
-        match = re.match(self.listening, new_message.text)
-        if match:
-            self.listening = False
-            self.heard_message = new_message
-            raise gen.Return()
+        text = event.get('text')
+        return text is not None and bool(re.match(self.listening, text))
@@ -0,0 +1,99 @@
+"""Serialization of memory values.
+
+Encoded values are self-describing. Uncompressed JSON is stored as plain JSON
+text, exactly as older versions stored every value, so existing databases
+keep working. Anything else starts with a 3 byte header that JSON text never
+starts with: a NUL byte, the codec ('j', 'p' or 'm') and the compression
+('-' for none, 'z' for zlib). Every codec can read values written by any
+other, so changing MEMORY_CODEC on an existing database is safe.
+"""
+
+import json
+import logging
+import marshal
+import os
+import pickle
+import zlib
+
+from alphabot import stats
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'\x00'
+UNCOMPRESSED = b'-'
+ZLIB = b'z'
+
+CODECS = {
+    # name: (tag, dumps, loads)
+    'json': (b'j', lambda v: json.dumps(v).encode('utf-8'), json.loads),
+    'pickle': (b'p', lambda v: pickle.dumps(v, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    'marshal': (b'm', marshal.dumps, marshal.loads),
+}
+_LOADS = dict((tag, loads) for tag, _, loads in CODECS.values())
+
+
+class Codec(object):
+    """Encodes values to bytes and back.
+
+    'json' is portable and the default. 'pickle' handles any Python object,
+    but must only be used with a trusted store, as unpickling runs code.
+    'marshal' is the fastest, for builtin types only, and its format may
+    change between Python versions.
+
+    Integers are always stored as plain JSON, so that engines can increment
+    them natively (e.g. with redis' INCRBY) whatever the codec.
+    """
+
+    def __init__(self, name=None, compress_threshold=None, level=6):
+        """
+        Args:
+            name (str): 'json', 'pickle' or 'marshal'. Defaults to the
+                MEMORY_CODEC environment variable, or 'json'.
+            compress_threshold (int): zlib-compress encoded values of at
+                least this many bytes. 0 disables compression. Defaults to
+                MEMORY_COMPRESS_THRESHOLD, or 4096.
+            level (int): zlib compression level.
+        """
+        self.name = name or os.getenv('MEMORY_CODEC', 'json')
+        if self.name not in CODECS:
+            raise ValueError('Unknown memory codec "%s". Use one of %s' % (
+                self.name, sorted(CODECS)))
+        if compress_threshold is None:
+            compress_threshold = int(os.getenv('MEMORY_COMPRESS_THRESHOLD', 4096))
+        self.compress_threshold = compress_threshold
+        self.level = level
+        self.tag, self._dumps, _ = CODECS[self.name]
+
+    def encode(self, value):
+        if self.name == 'json' or (isinstance(value, int) and not isinstance(value, bool)):
+            tag, data = CODECS['json'][0], json.dumps(value).encode('utf-8')
+        else:
+            tag, data = self.tag, self._dumps(value)
+
+        if self.compress_threshold and len(data) >= self.compress_threshold:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                stats.incr('memory.codec.compressed')
+                return MAGIC + tag + ZLIB + compressed
+
+        if tag == CODECS['json'][0]:
+            return data
+        return MAGIC + tag + UNCOMPRESSED + data
+
+    def decode(self, raw, default=None):
+        """Decodes a stored value. Returns `default` if `raw` is None.
+
+        Values that cannot be decoded are returned as is.
+        """
+        if raw is None:
+            return default
+        try:
+            if isinstance(raw, str) or raw[:1] != MAGIC:
+                return json.loads(raw)
+            data = raw[3:]
+            if raw[2:3] == ZLIB:
+                data = zlib.decompress(data)
+            return _LOADS[raw[1:2]](data)
+        except Exception as e:
+            log.critical('Could not decode memory value! %s' % e)
+            return raw
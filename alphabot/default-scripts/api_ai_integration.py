@@ -13,6 +13,15 @@ log = logging.getLogger(__name__)
 API_AI_KEY = os.getenv('API_AI_KEY')
 
 
+@bot.blocking
+def query_apiai(text):
+    """Synchronous api.ai request. Runs on the bot's thread pool."""
+    ai = apiai.ApiAI(API_AI_KEY)
+    request = ai.text_request()
+    request.query = text
+    return json.loads(request.getresponse().read())
+
+
 @gen.coroutine
 def fetch_from_apiai(message):
     just_text = (
@@ -21,12 +30,8 @@ def fetch_from_apiai(message):
                .replace('<@%s>' % bot._user_id, '')
     )
 
-    ai = apiai.ApiAI(API_AI_KEY)
-
     log.info('Requesting action from api.ai...')
-    request = ai.text_request()
-    request.query = just_text
-    response = json.loads(request.getresponse().read())
+    response = yield query_apiai(just_text)
 
     result = response.get('result', {})
     action = result.get('action', {})
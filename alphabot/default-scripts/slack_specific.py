@@ -10,26 +10,19 @@ bot = alphabot.bot.get_instance()
 log = logging.getLogger(__name__)
 
 
-@bot.on(ok=False, error={"code": -1,
-                         "msg": "slow down, too many messages..."})
-@gen.coroutine
-def slack_throttle(event):
-    log.warning('Detected a slow-down warning!')
-    bot._too_fast_warning = True
-
-
 class SlackButtonAction(web.RequestHandler):
 
     def get(self):
         self.write('get')
 
+    @gen.coroutine
     def post(self):
         # https://api.slack.com/docs/message-buttons#responding_to_message_actions
         payload = self.get_body_argument('payload')
         payload = json.loads(payload)
 
-        log.info('Received a button action. Adding to web events.')
-        bot._web_events.append({
+        log.info('Received a button action. Adding to the event queue.')
+        yield bot.put_event({
             # For Chat class
             'text': '',
             'user': payload['user']['id'],
@@ -43,11 +36,6 @@ class SlackButtonAction(web.RequestHandler):
             'payload': payload
         })
 
-        # Slightly hacky: ping slack so that it responds with pong.
-        # This will cause the get_next_message to notice the web event above.
-        # Correct solution requires a lot more code.
-        bot.connection.write_message(json.dumps({"id": 0, "type": "ping"}))
-
 
 @bot.on_start
 @gen.coroutine
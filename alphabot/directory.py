@@ -0,0 +1,85 @@
+"""Directory of chat objects, such as Slack users and channels."""
+
+from alphabot.dispatch import dict_subset
+
+
+class Directory(object):
+    """Chat objects (dicts with an 'id') indexed by id and other fields.
+
+    Lookups by id, or by one of the indexed fields, are O(1). `find` with
+    other fields narrows the candidates down with an indexed field when one
+    is given, and only scans every entry when none is.
+    """
+
+    def __init__(self, items=(), indexes=('name',)):
+        self.indexes = tuple(indexes)
+        self._by_id = {}
+        # field -> value -> ids. Tuples, as most values are unique and they are small.
+        self._indexes = dict((field, {}) for field in self.indexes)
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def add(self, item):
+        """Adds `item`, replacing the entry with the same id if any."""
+        self.remove(item['id'])
+        self._by_id[item['id']] = item
+        for field, index in self._indexes.items():
+            value = item.get(field)
+            try:
+                index[value] = index.get(value, ()) + (item['id'],)
+            except TypeError:
+                pass  # Unhashable, so only found by scanning.
+
+    def update(self, id, **fields):
+        """Sets `fields` on the entry with this id. Returns it, or None."""
+        item = self._by_id.get(id)
+        if item is None:
+            return None
+        item = dict(item, **fields)
+        self.add(item)
+        return item
+
+    def remove(self, id):
+        """Removes and returns the entry with this id, or None."""
+        item = self._by_id.pop(id, None)
+        if item is None:
+            return None
+        for field, index in self._indexes.items():
+            value = item.get(field)
+            try:
+                ids = tuple(i for i in index.get(value, ()) if i != id)
+            except TypeError:
+                continue
+            if ids:
+                index[value] = ids
+            else:
+                index.pop(value, None)
+        return item
+
+    def get(self, id, default=None):
+        return self._by_id.get(id, default)
+
+    def find(self, **kwargs):
+        """Returns every entry whose fields include all of `kwargs`."""
+        return [item for item in self._candidates(kwargs) if dict_subset(item, kwargs)]
+
+    def _candidates(self, kwargs):
+        if 'id' in kwargs:
+            item = self._by_id.get(kwargs['id'])
+            return [] if item is None else [item]
+        for field in self.indexes:
+            if field in kwargs:
+                try:
+                    return [self._by_id[i] for i in self._indexes[field].get(kwargs[field], ())]
+                except TypeError:
+                    break
+        return self._by_id.values()
@@ -0,0 +1,409 @@
+"""Event dispatch structures used by the Bot core."""
+
+import collections
+import heapq
+import itertools
+import logging
+import re
+import time
+
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+log = logging.getLogger(__name__)
+
+# Listener kwargs that are worth indexing on, most selective first. A listener
+# is filed under the first of these keys it constrains; everything else is
+# still checked with a full subset comparison.
+INDEX_KEYS = ('callback_id', 'channel', 'subtype', 'type')
+
+
+def dict_subset(big, small):
+    return small.items() <= big.items()
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class ListenerIndex(object):
+    """Registry of (kwargs, function) listeners indexed by constant keys.
+
+    Behaves like the list it replaces (append, remove, len, iteration in
+    registration order), but `match(event)` only compares the event against
+    listeners that could possibly match it. `wants_type` tells whether any
+    listener could match events of a type at all.
+    """
+
+    def __init__(self):
+        self._seq = itertools.count()
+        self._entries = {}  # seq -> (kwargs, function)
+        self._index = dict((key, {}) for key in INDEX_KEYS)
+        self._unindexed = {}  # seq -> (kwargs, function)
+        self._by_function = {}  # id(function) -> [seq, ...]
+        self._types = {}  # Event type -> listeners requiring it.
+        self._untyped = 0  # Listeners matching events of any type.
+
+    def _count_type(self, kwargs, step):
+        event_type = kwargs.get('type')
+        if 'type' not in kwargs or not _hashable(event_type):
+            self._untyped += step
+            return
+        count = self._types.get(event_type, 0) + step
+        if count:
+            self._types[event_type] = count
+        else:
+            del self._types[event_type]
+
+    def wants_type(self, event_type):
+        """Whether some listener may match an event of `event_type`."""
+        return bool(self._untyped) or event_type in self._types
+
+    def _bucket_for(self, kwargs):
+        for key in INDEX_KEYS:
+            if key in kwargs and _hashable(kwargs[key]):
+                return self._index[key].setdefault(kwargs[key], {})
+        return self._unindexed
+
+    def append(self, listener):
+        kwargs, function = listener
+        seq = next(self._seq)
+        self._entries[seq] = listener
+        self._bucket_for(kwargs)[seq] = listener
+        self._by_function.setdefault(id(function), []).append(seq)
+        self._count_type(kwargs, 1)
+
+    def remove(self, listener):
+        kwargs, function = listener
+        seqs = self._by_function.get(id(function), [])
+        for seq in seqs:
+            if self._entries[seq] == listener:
+                break
+        else:
+            raise ValueError('Listener %s is not registered' % (listener,))
+
+        seqs.remove(seq)
+        if not seqs:
+            del self._by_function[id(function)]
+        del self._entries[seq]
+        self._count_type(kwargs, -1)
+        bucket = self._bucket_for(kwargs)
+        del bucket[seq]
+        if not bucket and bucket is not self._unindexed:
+            for key in INDEX_KEYS:
+                if key in kwargs and _hashable(kwargs[key]):
+                    del self._index[key][kwargs[key]]
+                    break
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter([self._entries[seq] for seq in sorted(self._entries)])
+
+    def candidates(self, event):
+        """Listeners that share an indexed value with `event`, in order."""
+        buckets = [self._unindexed]
+        for key in INDEX_KEYS:
+            if key not in event or not _hashable(event[key]):
+                continue
+            bucket = self._index[key].get(event[key])
+            if bucket:
+                buckets.append(bucket)
+
+        if len(buckets) == 1:
+            return [buckets[0][seq] for seq in sorted(buckets[0])]
+
+        seqs = heapq.merge(*[sorted(b) for b in buckets])
+        return [self._entries[seq] for seq in seqs]
+
+    def match(self, event):
+        """Listeners whose kwargs are fully satisfied by `event`, in order."""
+        return [(kwargs, function) for kwargs, function in self.candidates(event)
+                if dict_subset(event, kwargs)]
+
+
+def event_key(event):
+    """Identity of an event that Slack may deliver twice, or None.
+
+    A message's `client_msg_id`, else the event's type, channel and `ts`,
+    else its Events API `event_id`.
+    """
+    key = event.get('client_msg_id')
+    if key:
+        return key
+    if 'ts' in event and 'channel' in event:
+        key = (event.get('type'), event['channel'], event['ts'])
+        if _hashable(key):
+            return key
+    return event.get('event_id')
+
+
+class DedupWindow(object):
+    """Keys seen within the last `window` seconds, at most `size` of them.
+
+    Keys are kept in arrival order, so expired ones are dropped from the
+    front as new ones come in. Once full, the oldest key is forgotten early.
+    """
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self._seen = collections.OrderedDict()  # key -> time seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key, now=None):
+        """Whether `key` was seen within the window. Remembers it if not."""
+        now = now or time.time()
+        seen = self._seen
+        while seen:
+            oldest, seen_at = next(iter(seen.items()))
+            if now - seen_at < self.window:
+                break
+            del seen[oldest]
+
+        if key in seen:
+            return True
+        seen[key] = now
+        if len(seen) > self.size:
+            seen.popitem(last=False)
+        return False
+
+
+# Characters that end a literal run in a regular expression.
+_REGEX_META = frozenset('.^$*+?{}[]\\|()')
+
+
+def _has_top_level_alternation(regex):
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\':
+            i += 2
+            continue
+        if in_class:
+            if char == ']':
+                in_class = False
+        elif char == '[':
+            in_class = True
+            # A leading ']' (optionally after '^') is part of the class.
+            if regex[i + 1:i + 2] == '^':
+                i += 1
+            if regex[i + 1:i + 2] == ']':
+                i += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def literal_prefix(regex):
+    """Longest literal string that every match of `regex` must start with.
+
+    Conservative: returns '' whenever the start of the pattern is not a plain
+    run of literal characters.
+    """
+    if _has_top_level_alternation(regex):
+        return ''
+
+    prefix = []
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\':
+            escaped = regex[i + 1:i + 2]
+            if not escaped or escaped.isalnum():
+                break  # Character classes (\d, \w, ...) and back references.
+            literal, step = escaped, 2
+        elif char in _REGEX_META:
+            break
+        else:
+            literal, step = char, 1
+
+        following = regex[i + step:i + step + 1]
+        if following and following in '*?{':
+            break  # The literal is optional or repeated a variable number of times.
+        prefix.append(literal)
+        if following == '+':
+            break
+        i += step
+    return ''.join(prefix)
+
+
+class Command(object):
+    """A registered add_command pattern, compiled once."""
+
+    def __init__(self, regex, function, direct=False):
+        self.regex = regex
+        self.function = function
+        self.direct = direct
+        # Same semantics as Chat.matches_regex: the whole text must match.
+        self.pattern = re.compile('^' + regex + '$')
+        self.prefix = literal_prefix(regex)
+        self.seq = None  # Set by the router on registration.
+
+
+class CommandRouter(object):
+    """Matches message text against every registered command.
+
+    Commands with a literal prefix are bucketed by its first character and
+    rejected with a cheap `startswith` before the full regex is evaluated.
+    """
+
+    def __init__(self):
+        self._seq = itertools.count()
+        self._commands = {}  # seq -> Command
+        self._by_first_char = {}  # char -> {seq: Command}
+        self._no_prefix = {}  # seq -> Command
+
+    def _bucket_for(self, command):
+        if command.prefix:
+            return self._by_first_char.setdefault(command.prefix[0], {})
+        return self._no_prefix
+
+    def add(self, regex, function, direct=False):
+        command = Command(regex, function, direct)
+        command.seq = next(self._seq)
+        self._commands[command.seq] = command
+        self._bucket_for(command)[command.seq] = command
+        log.debug('New command: %r (prefix %r) => %s()' % (
+            regex, command.prefix, function.__name__))
+        return command
+
+    def remove(self, command):
+        if self._commands.get(command.seq) is not command:
+            raise ValueError('Command %r is not registered' % command.regex)
+
+        del self._commands[command.seq]
+        bucket = self._bucket_for(command)
+        del bucket[command.seq]
+        if not bucket and command.prefix:
+            del self._by_first_char[command.prefix[0]]
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __iter__(self):
+        return iter([self._commands[seq] for seq in sorted(self._commands)])
+
+    def route(self, text):
+        """Returns [(command, match), ...] for `text` in registration order."""
+        if not text:
+            return []
+
+        candidates = list(self._no_prefix.items())
+        bucket = self._by_first_char.get(text[0])
+        if bucket:
+            candidates.extend((seq, command) for seq, command in bucket.items()
+                              if text.startswith(command.prefix))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        results = []
+        for _, command in candidates:
+            match = command.pattern.match(text)
+            if match:
+                results.append((command, match))
+        return results
+
+
+class Waiter(object):
+    """A pending wait_for_event: resolved by the first matching event."""
+
+    def __init__(self, kwargs, predicate, future):
+        self.kwargs = kwargs
+        self.predicate = predicate
+        self.future = future
+        self.timeout_handle = None
+        self.__name__ = 'waiter:%s' % (kwargs,)
+
+
+class WaiterRegistry(object):
+    """Futures waiting for events, resolved directly by the dispatcher.
+
+    Waiters live in a ListenerIndex, so a waiter keyed on a unique value
+    (e.g. a button's callback_id) is found with a dict lookup.
+    """
+
+    def __init__(self):
+        self._waiters = ListenerIndex()
+        self._by_future = {}  # id(future) -> Waiter
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def wants_type(self, event_type):
+        return self._waiters.wants_type(event_type)
+
+    def wait(self, kwargs, predicate=None, timeout=None):
+        """Returns a Future resolved with the next event matching `kwargs`.
+
+        Args:
+            kwargs (dict): Key/values the event must contain.
+            predicate (callable): Optional extra check, called with the event.
+            timeout (float): Seconds until the Future fails with
+                gen.TimeoutError. Waits forever if None.
+        """
+        future = Future()
+        waiter = Waiter(kwargs, predicate, future)
+        self._waiters.append((kwargs, waiter))
+        self._by_future[id(future)] = waiter
+        log.debug('Waiting for %s' % (kwargs,))
+
+        if timeout is not None:
+            def expire():
+                if not future.done():
+                    future.set_exception(
+                        gen.TimeoutError('Timed out waiting for %s' % (kwargs,)))
+            waiter.timeout_handle = ioloop.IOLoop.current().call_later(timeout, expire)
+
+        # However the future ends (event, timeout or cancel) stop tracking it.
+        future.add_done_callback(lambda _: self._discard(waiter))
+        return future
+
+    def cancel(self, future):
+        """Stop waiting. The Future is cancelled if it is still pending."""
+        waiter = self._by_future.get(id(future))
+        if waiter is not None:
+            self._discard(waiter)
+        if not future.done():
+            future.cancel()
+
+    def _discard(self, waiter):
+        if waiter.timeout_handle is not None:
+            ioloop.IOLoop.current().remove_timeout(waiter.timeout_handle)
+            waiter.timeout_handle = None
+        self._by_future.pop(id(waiter.future), None)
+        try:
+            self._waiters.remove((waiter.kwargs, waiter))
+        except ValueError:
+            pass  # Already discarded.
+
+    def dispatch(self, event):
+        """Resolve every waiter that `event` satisfies. Returns their count."""
+        resolved = 0
+        for kwargs, waiter in self._waiters.match(event):
+            if waiter.future.done():
+                continue
+            if waiter.predicate:
+                try:
+                    if not waiter.predicate(event):
+                        continue
+                except Exception as e:
+                    log.error('Waiter predicate for %s failed: %s' % (kwargs, e))
+                    continue
+            self._discard(waiter)
+            waiter.future.set_result(event)
+            resolved += 1
+        return resolved
@@ -0,0 +1,291 @@
+"""Execution of script handlers with bounded concurrency."""
+
+import collections
+import contextvars
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent import futures
+
+from tornado import ioloop
+from tornado.concurrent import Future
+
+from alphabot import stats
+
+log = logging.getLogger(__name__)
+
+# Handlers allowed to run at once across the whole bot.
+MAX_HANDLERS = int(os.getenv('MAX_HANDLERS', 200))
+# Handlers allowed to wait for a free slot before new ones are dropped.
+HANDLER_QUEUE_SIZE = int(os.getenv('HANDLER_QUEUE_SIZE', 1000))
+
+# Threads available to blocking code. See `BlockingPool`.
+BLOCKING_THREADS = int(os.getenv('BLOCKING_THREADS', 10))
+
+# What to do with a handler that cannot start because a cap is reached.
+QUEUE = 'queue'  # Wait for a free slot. Drop the new handler if the queue is full.
+DROP_OLDEST = 'drop_oldest'  # Wait, making room by dropping the oldest waiting one.
+REJECT = 'reject'  # Do not wait. Tell the chat the bot is busy.
+POLICIES = (QUEUE, DROP_OLDEST, REJECT)
+
+BUSY_REPLY = 'Too busy to run `%s` right now. Please try again later.'
+
+# The job of the handler running, as seen from inside that handler.
+_current_job = contextvars.ContextVar('alphabot_job', default=None)
+
+
+class Limit(object):
+    """Concurrency limit of a single handler. See `HandlerExecutor.limit`."""
+
+    def __init__(self, concurrency=None, policy=QUEUE, queue_size=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy "%s". Use one of %s' % (policy, POLICIES))
+        self.concurrency = concurrency
+        self.policy = policy
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.queued = 0
+
+
+class Job(object):
+
+    def __init__(self, function, kwargs, chat, limit):
+        self.function = function
+        self.kwargs = kwargs
+        self.chat = chat
+        self.limit = limit
+        self.waits = 0  # Pending `HandlerExecutor.waiting` futures.
+        self.finished = False
+
+
+class HandlerExecutor(object):
+    """Runs handlers, capping how many are in flight at once.
+
+    Handlers beyond the global cap (or their own `limit`) wait in a FIFO
+    queue and start as running handlers finish, or wait for a user.
+    """
+
+    def __init__(self, error_handler, max_concurrency=MAX_HANDLERS,
+                 queue_size=HANDLER_QUEUE_SIZE, policy=QUEUE):
+        """
+        Args:
+            error_handler (callable): Called with (future, chat) for every
+                started handler, e.g. `bot.handle_exceptions`.
+            max_concurrency (int): Global cap of running handlers.
+            queue_size (int): Global cap of waiting handlers.
+            policy (str): Policy of handlers without their own `limit`.
+        """
+        self.error_handler = error_handler
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.default_limit = Limit(policy=policy)
+        self.in_flight = 0
+        self._seq = itertools.count()
+        self._pending = collections.OrderedDict()  # seq -> Job
+
+        stats.gauge('handlers.in_flight', lambda: self.in_flight)
+        stats.gauge('handlers.queued', lambda: len(self._pending))
+
+    @staticmethod
+    def limit(concurrency=None, policy=QUEUE, queue_size=None):
+        """Decorator limiting how many copies of a handler run at once.
+
+        Args:
+            concurrency (int): Maximum running copies of this handler.
+            policy (str): 'queue', 'drop_oldest' or 'reject'.
+            queue_size (int): Maximum waiting copies of this handler.
+        """
+        def decorator(function):
+            function._alphabot_limit = Limit(concurrency, policy, queue_size)
+            return function
+        return decorator
+
+    @property
+    def queued(self):
+        return len(self._pending)
+
+    def _limit_of(self, function):
+        return getattr(function, '_alphabot_limit', None) or self.default_limit
+
+    def _can_start(self, limit):
+        if self.in_flight >= self.max_concurrency:
+            return False
+        return limit.concurrency is None or limit.in_flight < limit.concurrency
+
+    def submit(self, function, kwargs, chat=None):
+        """Start `function(**kwargs)` now, or queue it per its policy."""
+        job = Job(function, kwargs, chat, self._limit_of(function))
+        if self._can_start(job.limit):
+            self._start(job)
+            return
+
+        name = function.__name__
+        if job.limit.policy == REJECT:
+            log.warning('Rejecting %s: concurrency limit reached.' % name)
+            stats.incr('handlers.rejected')
+            if chat:
+                self.error_handler(chat.reply(BUSY_REPLY % name), None)
+            return
+
+        if job.limit.policy == DROP_OLDEST and self._is_full(job.limit):
+            self._drop_oldest(job.limit)
+
+        if self._is_full(job.limit):
+            log.warning('Dropping %s: handler queue is full.' % name)
+            stats.incr('handlers.dropped')
+            return
+
+        log.debug('Queueing %s: concurrency limit reached.' % name)
+        job.limit.queued += 1
+        self._pending[next(self._seq)] = job
+
+    def _is_full(self, limit):
+        if len(self._pending) >= self.queue_size:
+            return True
+        return limit.queue_size is not None and limit.queued >= limit.queue_size
+
+    def _drop_oldest(self, limit):
+        """Drop the oldest waiting job with `limit` (or any job if global)."""
+        for seq, job in self._pending.items():
+            if job.limit is limit or len(self._pending) >= self.queue_size:
+                del self._pending[seq]
+                job.limit.queued -= 1
+                log.warning('Dropping oldest queued %s.' % job.function.__name__)
+                stats.incr('handlers.dropped')
+                return
+
+    def waiting(self, future):
+        """Frees the global slot of the calling handler until `future` is done.
+
+        For waits on users, which may last for long or forever: other handlers
+        should not queue behind them. The handler's own `limit` still counts
+        it. Once `future` is done the handler takes its slot back, even if
+        that briefly goes over the cap.
+
+        Returns:
+            Future: `future` itself.
+        """
+        job = _current_job.get()
+        if job is None or job.finished:
+            return future  # Not called from a handler.
+
+        job.waits += 1
+        if job.waits == 1:
+            self.in_flight -= 1
+            stats.incr('handlers.waits')
+            self._drain()
+
+        def resume(_):
+            job.waits -= 1
+            if job.waits == 0 and not job.finished:
+                self.in_flight += 1
+        future.add_done_callback(resume)
+        return future
+
+    def _start(self, job):
+        self.in_flight += 1
+        job.limit.in_flight += 1
+        stats.incr('handlers.started')
+        token = _current_job.set(job)
+        try:
+            future = job.function(**job.kwargs)
+        except Exception as e:
+            # Report synchronous failures the same way as failed coroutines.
+            future = Future()
+            future.set_exception(e)
+        finally:
+            _current_job.reset(token)
+
+        self.error_handler(future, job.chat)
+        if hasattr(future, 'add_done_callback'):
+            future.add_done_callback(lambda _: self._finish(job))
+        else:
+            self._finish(job)
+
+    def _finish(self, job):
+        job.finished = True
+        if not job.waits:
+            self.in_flight -= 1  # Otherwise freed by `waiting` already.
+        job.limit.in_flight -= 1
+        stats.incr('handlers.completed')
+        self._drain()
+
+    def _drain(self):
+        """Start waiting jobs, oldest first, while there are free slots."""
+        for seq, job in list(self._pending.items()):
+            if self.in_flight >= self.max_concurrency:
+                return
+            if seq in self._pending and self._can_start(job.limit):
+                del self._pending[seq]
+                job.limit.queued -= 1
+                self._start(job)
+
+
+class BlockingPool(object):
+    """A bounded thread pool for code that would otherwise block the IOLoop.
+
+    Use it for synchronous network clients (redis, HTTP SDKs) and other slow
+    calls. Calls beyond `max_workers` wait for a free thread.
+    """
+
+    def __init__(self, max_workers=BLOCKING_THREADS, name='blocking'):
+        self.max_workers = max_workers
+        self.name = name
+        self.active = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._pool = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+        stats.gauge('%s.active' % name, lambda: self.active)
+        stats.gauge('%s.queued' % name, lambda: self.queued)
+        stats.gauge('%s.max_workers' % name, lambda: self.max_workers)
+        stats.gauge('%s.utilization' % name, self.utilization)
+
+    def utilization(self):
+        """Fraction of threads busy right now."""
+        return float(self.active) / self.max_workers
+
+    def submit(self, function, *args, **kwargs):
+        """Run `function(*args, **kwargs)` on the pool.
+
+        Returns:
+            Future: Resolves with the function's result on the IOLoop.
+        """
+        submitted = time.time()
+        with self._lock:
+            self.queued += 1
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            stats.observe('%s.wait_ms' % self.name, (time.time() - submitted) * 1000)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+        stats.incr('%s.calls' % self.name)
+        return ioloop.IOLoop.current().run_in_executor(self._pool, run)
+
+    def blocking(self, function):
+        """Decorator: calls to `function` run on the pool and return a Future."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.submit(function, *args, **kwargs)
+        return wrapper
+
+
+_blocking_pool = None
+
+
+def get_blocking_pool():
+    """The process-wide BlockingPool, created on first use."""
+    global _blocking_pool
+    if _blocking_pool is None:
+        _blocking_pool = BlockingPool()
+    return _blocking_pool
@@ -1,5 +1,3 @@
-from __future__ import print_function
-
 import logging
 
 log = logging.getLogger(__name__)
@@ -37,10 +35,13 @@ class Help(object):
                 'desc': desc
             }
 
+    def remove(self, function):
+        self._func_map.pop(function, None)
+
     def list(self, filter=None):
         results = []
         if filter:
-            for _, help in self._func_map.iteritems():
+            for _, help in self._func_map.items():
                 for tag in help['tags']:
                     if type(tag) is not str:
                         log.warning('Tag %s is not a str' % tag)
@@ -51,6 +52,6 @@ class Help(object):
         else:
             results = [
                     (help['usage'], help['desc'].split("\n")[0])
-                    for _, help in self._func_map.iteritems()]
+                    for _, help in self._func_map.items()]
         # Sort by 'usage' string.
         return sorted(results, key=lambda x: x[0])
@@ -1,13 +1,60 @@
+import collections
 import logging
 import os
-import json
+import sqlite3
+import sys
+import time
 
-from tornado import gen
+from tornado import gen, ioloop
+from tornado.concurrent import Future
 
 import redis
 
+from alphabot import codec
+from alphabot import executor
+from alphabot import redis_client
+from alphabot import stats
+
 log = logging.getLogger(__name__)
 
+_MISSING = object()
+
+# Atomically SET KEYS[1] to ARGV[3] if it still holds ARGV[2] (when ARGV[1]
+# is '1') or does not exist (when ARGV[1] is '0'). Returns 1 if it was set.
+# Sets KEYS[1] to ARGV[3] if it is missing (ARGV[1] == '0') or holds exactly
+# ARGV[2]. Returns 1 if it did, else the current value (nil if missing).
+REDIS_CAS_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if (ARGV[1] == '0' and current == false) or (ARGV[1] == '1' and current == ARGV[2]) then
+    redis.call('SET', KEYS[1], ARGV[3])
+    return 1
+end
+return current
+"""
+
+
+@gen.coroutine
+def _redis_compare_and_set(codec, run_script, key, expected, value):
+    """compare_and_set of the redis engines, in one round trip.
+
+    `run_script(key, *argv)` runs REDIS_CAS_SCRIPT. The script compares
+    encoded values, which may differ for equal ones (e.g. written with
+    another codec). Then it is run once more, against the exact bytes stored.
+    """
+    if expected is None:
+        argv = ['0', '']
+    else:
+        argv = ['1', codec.encode(expected)]
+    encoded = codec.encode(value)
+    for _ in range(2):
+        reply = yield run_script(key, argv[0], argv[1], encoded)
+        if reply == 1:
+            raise gen.Return(True)
+        if reply is None or codec.decode(reply) != expected:
+            raise gen.Return(False)
+        argv = ['1', reply]
+    raise gen.Return(False)  # Changed again in between.
+
 
 class Memory(object):
     """Memory interface to Alphabot."""
@@ -22,6 +69,45 @@ class Memory(object):
         value = yield self._get(key, default)
         raise gen.Return(value)
 
+    @gen.coroutine
+    def get_many(self, keys, default=None):
+        """Returns {key: value} for every key, using `default` for missing ones."""
+        values = yield self._get_many(list(keys), default)
+        raise gen.Return(values)
+
+    @gen.coroutine
+    def save_many(self, values):
+        """Saves every key/value of the `values` dict."""
+        yield self._save_many(dict(values))
+
+    @gen.coroutine
+    def delete(self, key):
+        """Removes a key. Returns whether it existed."""
+        existed = yield self._delete(key)
+        raise gen.Return(existed)
+
+    @gen.coroutine
+    def incr(self, key, amount=1):
+        """Atomically adds `amount` to an integer value (missing is 0).
+
+        Returns:
+            int: The new value.
+        """
+        value = yield self._incr(key, amount)
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def compare_and_set(self, key, expected, value):
+        """Atomically saves `value` if the key currently holds `expected`.
+
+        Use `expected=None` to only save if the key does not exist yet.
+
+        Returns:
+            bool: Whether the value was saved.
+        """
+        swapped = yield self._compare_and_set(key, expected, value)
+        raise gen.Return(swapped)
+
     @gen.coroutine
     def setup(self):
         yield self._setup()
@@ -31,45 +117,698 @@ class Memory(object):
         log.debug('Memory engine %s does not require any setup.' % (
             self.__class__.__name__))
 
+    # Engines should override these with native batch and atomic commands.
+    # The fallbacks below cost one call per key and are not atomic.
+
+    @gen.coroutine
+    def _get_many(self, keys, default):
+        values = yield [self._get(key, default) for key in keys]
+        raise gen.Return(dict(zip(keys, values)))
+
+    @gen.coroutine
+    def _save_many(self, values):
+        yield [self._save(key, value) for key, value in values.items()]
+
+    @gen.coroutine
+    def _delete(self, key):
+        raise NotImplementedError('%s does not support delete' % self.__class__.__name__)
+
+    @gen.coroutine
+    def _incr(self, key, amount):
+        value = yield self._get(key, 0)
+        value += amount
+        yield self._save(key, value)
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def _compare_and_set(self, key, expected, value):
+        current = yield self._get(key, None)
+        if current != expected:
+            raise gen.Return(False)
+        yield self._save(key, value)
+        raise gen.Return(True)
+
+
+def _approximate_size(value):
+    """Rough number of bytes held by `value`, following containers."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_approximate_size(k) + _approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_approximate_size(v) for v in value)
+    return size
+
+
+def _getenv_number(name, cast):
+    value = os.getenv(name)
+    return cast(value) if value else None
+
+
+class TimerWheel(object):
+    """Hashed timer wheel of key deadlines.
+
+    Each key sits in one of `slots` buckets, picked by its deadline with
+    `resolution` seconds per bucket. `expired` only visits the buckets that
+    came due since its previous call, so it costs O(keys due) rather than
+    O(keys scheduled).
+    """
+
+    def __init__(self, resolution=1.0, slots=512):
+        self.resolution = resolution
+        self.deadlines = {}  # key -> deadline
+        self._slots = [set() for _ in range(slots)]
+        self._tick = int(time.time() / resolution)
+
+    def _slot(self, deadline):
+        return self._slots[int(deadline / self.resolution) % len(self._slots)]
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        self.deadlines[key] = deadline
+        self._slot(deadline).add(key)
+
+    def cancel(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self._slot(deadline).discard(key)
+
+    def expired(self, now):
+        """Unschedules and returns the keys with a deadline <= `now`."""
+        tick = int(now / self.resolution)
+        # One full turn visits every bucket, so never go around twice.
+        first = max(self._tick, tick - len(self._slots) + 1)
+        due = []
+        for t in range(first, tick + 1):
+            slot = self._slots[t % len(self._slots)]
+            for key in [k for k in slot if self.deadlines[k] <= now]:
+                slot.discard(key)
+                del self.deadlines[key]
+                due.append(key)
+        # The current bucket may hold later deadlines, so it is visited again.
+        self._tick = tick
+        return due
+
 
 class MemoryDict(Memory):
-    """Ephemeral in-memory storage."""
+    """Ephemeral in-memory storage.
 
-    def __init__(self):
-        self.values = {}
+    Unbounded by default. With `max_entries` and/or `max_bytes` (a rough
+    estimate of the values' size) set, the least recently ('lru') or least
+    frequently ('lfu') used keys are evicted to stay within the limits. With
+    `ttl` set, keys expire that many seconds after they were last saved.
+    Every argument defaults to an environment variable: MEMORY_MAX_ENTRIES,
+    MEMORY_MAX_BYTES, MEMORY_TTL and MEMORY_EVICTION.
+    """
+
+    LRU = 'lru'
+    LFU = 'lfu'
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, eviction=None):
+        self.max_entries = max_entries or _getenv_number('MEMORY_MAX_ENTRIES', int)
+        self.max_bytes = max_bytes or _getenv_number('MEMORY_MAX_BYTES', int)
+        self.ttl = ttl or _getenv_number('MEMORY_TTL', float)
+        self.eviction = eviction or os.getenv('MEMORY_EVICTION', self.LRU)
+        if self.eviction not in (self.LRU, self.LFU):
+            raise ValueError('Unknown eviction policy "%s"' % self.eviction)
+
+        self.values = collections.OrderedDict()  # Least recently used first.
+        self.bytes = 0
+        self._sizes = {}  # key -> approximate size
+        self._counts = {}  # key -> uses, for LFU.
+        self._by_count = {}  # uses -> OrderedDict of keys, for LFU.
+        self._wheel = TimerWheel()
+        self._sweeper = None
+
+        self.evictions = 0
+        self.expirations = 0
+        stats.gauge('memory.dict.entries', lambda: len(self.values))
+        stats.gauge('memory.dict.bytes', lambda: self.bytes)
+        stats.gauge('memory.dict.evictions', lambda: self.evictions)
+        stats.gauge('memory.dict.expirations', lambda: self.expirations)
+
+    def expire(self, key, ttl):
+        """Expires `key` in `ttl` seconds, or never if `ttl` is None.
+
+        Like in redis, saving the key again resets this to the default ttl.
+
+        Returns:
+            bool: Whether the key exists.
+        """
+        if self._read(key, _MISSING) is _MISSING:
+            return False
+        self._set_ttl(key, ttl)
+        return True
+
+    def _set_ttl(self, key, ttl):
+        if ttl is None:
+            self._wheel.cancel(key)
+            return
+        self._wheel.schedule(key, time.time() + ttl)
+        if self._sweeper is None:
+            self._sweeper = ioloop.PeriodicCallback(
+                self._expire_due, self._wheel.resolution * 1000)
+            self._sweeper.start()
+
+    def _expire_due(self):
+        for key in self._wheel.expired(time.time()):
+            self._forget(key)
+            self.expirations += 1
+
+    def _read(self, key, default):
+        value = self.values.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        deadline = self._wheel.deadlines.get(key)
+        if deadline is not None and deadline <= time.time():
+            self._forget(key)
+            self.expirations += 1
+            return default
+        self._touch(key)
+        return value
+
+    def _write(self, key, value):
+        size = _approximate_size(key) + _approximate_size(value)
+        self.bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self.values[key] = value
+        self._touch(key)
+        self._set_ttl(key, self.ttl)
+        self._evict(keep=key)
+
+    def _touch(self, key):
+        if not (self.max_entries or self.max_bytes):
+            return
+        if self.eviction == self.LRU:
+            self.values.move_to_end(key)
+            return
+        count = self._counts.get(key, 0)
+        if count:
+            self._unlink_count(key, count)
+        self._counts[key] = count + 1
+        self._by_count.setdefault(count + 1, collections.OrderedDict())[key] = None
+
+    def _unlink_count(self, key, count):
+        keys = self._by_count[count]
+        del keys[key]
+        if not keys:
+            del self._by_count[count]
+
+    def _forget(self, key):
+        """Drops `key` and its bookkeeping. Returns whether it existed."""
+        if self.values.pop(key, _MISSING) is _MISSING:
+            return False
+        self.bytes -= self._sizes.pop(key)
+        self._wheel.cancel(key)
+        count = self._counts.pop(key, None)
+        if count:
+            self._unlink_count(key, count)
+        return True
+
+    def _over_limits(self):
+        return ((self.max_entries and len(self.values) > self.max_entries) or
+                (self.max_bytes and self.bytes > self.max_bytes))
+
+    def _evict(self, keep):
+        """Evicts keys until within limits, never the just written `keep`."""
+        while self._over_limits() and len(self.values) > 1:
+            if self.eviction == self.LFU:
+                key = next(k for count in sorted(self._by_count)
+                           for k in self._by_count[count] if k != keep)
+            else:
+                key = next(k for k in self.values if k != keep)
+            self._forget(key)
+            self.evictions += 1
 
     @gen.coroutine
     def _save(self, key, value):
-        self.values[key] = value
+        self._write(key, value)
 
     @gen.coroutine
     def _get(self, key, default):
-        raise gen.Return(self.values.get(key, default))
+        raise gen.Return(self._read(key, default))
+
+    # Everything below runs on the IOLoop thread, so it is atomic as is.
+
+    @gen.coroutine
+    def _get_many(self, keys, default):
+        raise gen.Return(dict((key, self._read(key, default)) for key in keys))
+
+    @gen.coroutine
+    def _save_many(self, values):
+        for key, value in values.items():
+            self._write(key, value)
+
+    @gen.coroutine
+    def _delete(self, key):
+        existed = self._read(key, _MISSING) is not _MISSING
+        self._forget(key)
+        raise gen.Return(existed)
+
+    @gen.coroutine
+    def _incr(self, key, amount):
+        value = self._read(key, 0) + amount
+        self._write(key, value)
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def _compare_and_set(self, key, expected, value):
+        if self._read(key, None) != expected:
+            raise gen.Return(False)
+        self._write(key, value)
+        raise gen.Return(True)
 
 
 class MemoryRedis(Memory):
-    """Redis storage."""
+    """Redis storage.
+
+    The redis client is synchronous, so every call runs on the shared
+    blocking thread pool instead of the IOLoop.
+    """
 
     def __init__(self):
         host = os.getenv('REDIS_HOST', 'localhost')
         port = os.getenv('REDIS_PORT', 6379)
         db = os.getenv('REDIS_DB', 0)
         self.r = redis.StrictRedis(host, port, db)
+        self.codec = codec.Codec()
+        self.pool = executor.get_blocking_pool()
+
+    @gen.coroutine
+    def _setup(self):
         # Test connection. Raises redis.exceptions.ConnectionError.
-        self.r.ping()
+        yield self.pool.submit(self.r.ping)
+
+    @gen.coroutine
+    def _save(self, key, value):
+        yield self.pool.submit(self.r.set, key, self.codec.encode(value))
+
+    @gen.coroutine
+    def _get(self, key, default=None):
+        raw_data = yield self.pool.submit(self.r.get, key)
+        raise gen.Return(self.codec.decode(raw_data, default))
+
+    @gen.coroutine
+    def _get_many(self, keys, default):
+        raw_values = yield self.pool.submit(self.r.mget, keys) if keys else []
+        raise gen.Return(dict((key, self.codec.decode(raw, default))
+                              for key, raw in zip(keys, raw_values)))
+
+    @gen.coroutine
+    def _save_many(self, values):
+        if values:
+            yield self.pool.submit(
+                self.r.mset, dict((k, self.codec.encode(v)) for k, v in values.items()))
+
+    @gen.coroutine
+    def _delete(self, key):
+        deleted = yield self.pool.submit(self.r.delete, key)
+        raise gen.Return(bool(deleted))
+
+    @gen.coroutine
+    def _incr(self, key, amount):
+        value = yield self.pool.submit(self.r.incrby, key, amount)
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def _compare_and_set(self, key, expected, value):
+        swapped = yield _redis_compare_and_set(
+            self.codec, lambda *args: self.pool.submit(self.r.eval, REDIS_CAS_SCRIPT, 1, *args),
+            key, expected, value)
+        raise gen.Return(swapped)
+
+
+class MemoryRedisAsync(Memory):
+    """Redis storage over a non-blocking, pooled and pipelined connection.
+
+    Encodes values like MemoryRedis, so the two can be swapped
+    on an existing database.
+    """
+
+    def __init__(self):
+        host = os.getenv('REDIS_HOST', 'localhost')
+        port = os.getenv('REDIS_PORT', 6379)
+        db = os.getenv('REDIS_DB', 0)
+        pool_size = int(os.getenv('REDIS_POOL_SIZE', 4))
+        self.r = redis_client.AsyncRedis(host, port, db, pool_size=pool_size)
+        self.codec = codec.Codec()
+
+    @gen.coroutine
+    def _setup(self):
+        # Test connection. Raises if redis is not reachable.
+        yield self.r.connect()
+        yield self.r.execute('PING')
 
     @gen.coroutine
     def _save(self, key, value):
-        json_data = json.dumps(value)
-        self.r.set(key, json_data)
+        yield self.r.execute('SET', key, self.codec.encode(value))
 
     @gen.coroutine
     def _get(self, key, default=None):
-        raw_data = self.r.get(key) or default
+        raw_data = yield self.r.execute('GET', key)
+        raise gen.Return(self.codec.decode(raw_data, default))
+
+    @gen.coroutine
+    def _get_many(self, keys, default):
+        raw_values = yield self.r.execute('MGET', *keys) if keys else []
+        raise gen.Return(dict((key, self.codec.decode(raw, default))
+                              for key, raw in zip(keys, raw_values)))
+
+    @gen.coroutine
+    def _save_many(self, values):
+        if values:
+            args = []
+            for key, value in values.items():
+                args.extend((key, self.codec.encode(value)))
+            yield self.r.execute('MSET', *args)
+
+    @gen.coroutine
+    def _delete(self, key):
+        deleted = yield self.r.execute('DEL', key)
+        raise gen.Return(bool(deleted))
+
+    @gen.coroutine
+    def _incr(self, key, amount):
+        value = yield self.r.execute('INCRBY', key, amount)
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def _compare_and_set(self, key, expected, value):
+        swapped = yield _redis_compare_and_set(
+            self.codec, lambda *args: self.r.execute('EVAL', REDIS_CAS_SCRIPT, 1, *args),
+            key, expected, value)
+        raise gen.Return(swapped)
+
+
+class MemoryFile(Memory):
+    """Durable local storage in a SQLite database (WAL mode).
+
+    Every value is loaded into memory at startup and served from there.
+    Writes update memory at once and are persisted in group commits: all
+    writes made within `MEMORY_FILE_COMMIT_DELAY` seconds share a single
+    transaction, run on a dedicated writer thread. `save` returns once its
+    write is committed.
+    """
+
+    def __init__(self):
+        self.path = os.getenv('MEMORY_FILE', 'alphabot.db')
+        self.commit_delay = float(os.getenv('MEMORY_FILE_COMMIT_DELAY', 0.005))
+        self.codec = codec.Codec()
+        self.values = {}
+        self._pending = {}  # key -> value, or _MISSING to delete it.
+        self._commit_future = None
+        self._db = None
+        # SQLite connections are not shareable, so all I/O uses one thread.
+        self._writer = executor.BlockingPool(max_workers=1, name='memory.file')
+        stats.gauge('memory.file.pending', lambda: len(self._pending))
+
+    @gen.coroutine
+    def _setup(self):
+        rows = yield self._writer.submit(self._open)
+        self.values = dict((key, self.codec.decode(value)) for key, value in rows)
+        log.info('Loaded %s values from %s' % (len(self.values), self.path))
+
+    def _open(self):
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS memory '
+                   '(key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self._db = db
+        return db.execute('SELECT key, value FROM memory').fetchall()
+
+    def _write(self, key, value):
+        """Queue a write for the next group commit. Returns its Future."""
+        self._pending[key] = value
+        if self._commit_future is None:
+            self._commit_future = Future()
+            ioloop.IOLoop.current().call_later(self.commit_delay, self._commit)
+        return self._commit_future
+
+    @gen.coroutine
+    def _commit(self):
+        pending, self._pending = self._pending, {}
+        future, self._commit_future = self._commit_future, None
+
+        upserts = [(key, self.codec.encode(value)) for key, value in pending.items()
+                   if value is not _MISSING]
+        deletes = [(key,) for key, value in pending.items() if value is _MISSING]
+        try:
+            yield self._writer.submit(self._write_rows, upserts, deletes)
+        except Exception as e:
+            log.critical('Could not write %s values to %s: %s' % (len(pending), self.path, e))
+            future.set_exception(e)
+        else:
+            stats.incr('memory.file.commits')
+            stats.incr('memory.file.writes', len(pending))
+            future.set_result(None)
+
+    def _write_rows(self, upserts, deletes):
+        self._db.execute('BEGIN')
+        try:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO memory (key, value) VALUES (?, ?)', upserts)
+            self._db.executemany('DELETE FROM memory WHERE key = ?', deletes)
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    @gen.coroutine
+    def _save(self, key, value):
+        self.values[key] = value
+        yield self._write(key, value)
+
+    @gen.coroutine
+    def _get(self, key, default):
+        raise gen.Return(self.values.get(key, default))
+
+    @gen.coroutine
+    def _get_many(self, keys, default):
+        raise gen.Return(dict((key, self.values.get(key, default)) for key in keys))
+
+    @gen.coroutine
+    def _save_many(self, values):
+        self.values.update(values)
+        for key, value in values.items():
+            future = self._write(key, value)
+        if values:
+            yield future
+
+    @gen.coroutine
+    def _delete(self, key):
+        existed = self.values.pop(key, _MISSING) is not _MISSING
+        yield self._write(key, _MISSING)
+        raise gen.Return(existed)
+
+    # Values change on the IOLoop thread only, so these are atomic.
+
+    @gen.coroutine
+    def _incr(self, key, amount):
+        value = self.values[key] = self.values.get(key, 0) + amount
+        yield self._write(key, value)
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def _compare_and_set(self, key, expected, value):
+        if self.values.get(key) != expected:
+            raise gen.Return(False)
+        self.values[key] = value
+        yield self._write(key, value)
+        raise gen.Return(True)
+
+
+class MemoryCache(Memory):
+    """Read-through LRU cache in front of any other Memory engine.
+
+    Holds up to `max_entries` values. Each entry expires `ttl` seconds after
+    it was cached, if a ttl is set. Writes go to the backend right away
+    ('through'), or are batched and flushed every `flush_interval` seconds
+    ('behind'). Write-behind values evicted before they are written are saved
+    right away, and stay pending, and readable, until the backend has them.
+    """
+
+    WRITE_THROUGH = 'through'
+    WRITE_BEHIND = 'behind'
+
+    def __init__(self, backend, max_entries=10000, ttl=None,
+                 write_mode=WRITE_THROUGH, flush_interval=1.0):
+        if write_mode not in (self.WRITE_THROUGH, self.WRITE_BEHIND):
+            raise ValueError('Unknown cache write mode "%s"' % write_mode)
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.write_mode = write_mode
+        self.flush_interval = flush_interval
+        self._entries = collections.OrderedDict()  # key -> (value, expires_at)
+        self._dirty = {}  # key -> value not yet written to the backend.
+        self._flusher = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        stats.gauge('memory.cache.size', lambda: len(self._entries))
+        stats.gauge('memory.cache.dirty', lambda: len(self._dirty))
+        stats.gauge('memory.cache.hits', lambda: self.hits)
+        stats.gauge('memory.cache.misses', lambda: self.misses)
+        stats.gauge('memory.cache.evictions', lambda: self.evictions)
+
+    @gen.coroutine
+    def _setup(self):
+        yield self.backend.setup()
+        if self.write_mode == self.WRITE_BEHIND:
+            self._flusher = ioloop.PeriodicCallback(
+                self.flush, self.flush_interval * 1000)
+            self._flusher.start()
+
+    def _cache(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            old_key, (old_value, _) = self._entries.popitem(last=False)
+            self.evictions += 1
+            if old_key in self._dirty:
+                # Never lose a write-behind value to eviction.
+                ioloop.IOLoop.current().spawn_callback(self._save_evicted, old_key, old_value)
+
+    @gen.coroutine
+    def _save_evicted(self, key, value):
         try:
-            json_data = json.loads(raw_data)
+            yield self.backend.save(key, value)
         except Exception as e:
-            log.critical('Could not load json data! %s' % e)
-            raise gen.Return(raw_data)
+            log.error('Could not save evicted key %s, will retry at the next flush: %s' % (
+                key, e))
+            return
+        self._written(key, value)
+
+    def _get_cached(self, key):
+        """The cached value of `key`, or _MISSING. Counts hits."""
+        entry = self._entries.get(key)
+        if entry is None:
+            if key in self._dirty:
+                # Evicted, but not written yet: the backend's value is stale.
+                self.hits += 1
+                return self._dirty[key]
+            return _MISSING
+        value, expires_at = entry
+        if expires_at is None or expires_at > time.time() or key in self._dirty:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+        del self._entries[key]
+        return _MISSING
+
+    @gen.coroutine
+    def _get(self, key, default):
+        value = self._get_cached(key)
+        if value is not _MISSING:
+            raise gen.Return(default if value is None else value)
+
+        self.misses += 1
+        # Missing keys are cached as None too, so they don't hit the backend.
+        value = yield self.backend.get(key)
+        if key in self._entries:
+            # Saved while we were loading. The saved value is newer.
+            value = self._entries[key][0]
+        else:
+            self._cache(key, value)
+        raise gen.Return(default if value is None else value)
+
+    @gen.coroutine
+    def _save(self, key, value):
+        self._cache(key, value)
+        if self.write_mode == self.WRITE_BEHIND:
+            self._dirty[key] = value
+        else:
+            yield self.backend.save(key, value)
+
+    @gen.coroutine
+    def _get_many(self, keys, default):
+        values = {}
+        missing = []
+        for key in keys:
+            cached = self._get_cached(key)
+            if cached is _MISSING:
+                missing.append(key)
+            else:
+                values[key] = cached
+
+        if missing:
+            self.misses += len(missing)
+            loaded = yield self.backend.get_many(missing)
+            for key, value in loaded.items():
+                if key not in self._entries:
+                    self._cache(key, value)
+                values[key] = self._entries[key][0]
+        raise gen.Return(dict((key, default if values[key] is None else values[key])
+                              for key in keys))
+
+    @gen.coroutine
+    def _save_many(self, values):
+        for key, value in values.items():
+            self._cache(key, value)
+        if self.write_mode == self.WRITE_BEHIND:
+            self._dirty.update(values)
+        else:
+            yield self.backend.save_many(values)
+
+    @gen.coroutine
+    def _delete(self, key):
+        self._entries.pop(key, None)
+        unflushed = self._dirty.pop(key, _MISSING) is not _MISSING
+        existed = yield self.backend.delete(key)
+        raise gen.Return(existed or unflushed)
+
+    @gen.coroutine
+    def _flush_key(self, key):
+        """Atomic operations run on the backend, so it needs our latest value."""
+        if key in self._dirty:
+            value = self._dirty[key]
+            yield self.backend.save(key, value)
+            self._written(key, value)
+
+    @gen.coroutine
+    def _incr(self, key, amount):
+        yield self._flush_key(key)
+        value = yield self.backend.incr(key, amount)
+        self._cache(key, value)
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def _compare_and_set(self, key, expected, value):
+        yield self._flush_key(key)
+        swapped = yield self.backend.compare_and_set(key, expected, value)
+        if swapped:
+            self._cache(key, value)
+        else:
+            # Someone else changed it. Reload on the next read.
+            self._entries.pop(key, None)
+        raise gen.Return(swapped)
+
+    def _written(self, key, value):
+        """Stop tracking `key` as dirty, unless it changed during the write."""
+        if self._dirty.get(key, _MISSING) is value:
+            del self._dirty[key]
+
+    @gen.coroutine
+    def flush(self):
+        """Write every pending write-behind value to the backend.
+
+        Values stay pending until written, so a failed flush loses nothing:
+        the next one retries them.
+        """
+        if not self._dirty:
+            return
+        dirty = dict(self._dirty)
+        yield self.backend.save_many(dirty)
+        for key, value in dirty.items():
+            self._written(key, value)
+
 
-        raise gen.Return(json_data)
+# Memory engines selectable with `--memory`.
+ENGINES = {
+    'dict': MemoryDict,
+    'redis': MemoryRedis,
+    'redis-async': MemoryRedisAsync,
+    'file': MemoryFile,
+}
@@ -0,0 +1,175 @@
+"""Outbound message queue, and tracking of the replies to sent messages."""
+
+import collections
+import logging
+import time
+
+from tornado import gen, ioloop, locks
+from tornado.concurrent import Future
+
+from alphabot import stats
+from alphabot.slack_client import TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """Writes messages in order per channel, within a global rate.
+
+    Messages of a channel are written one after the other, in the order they
+    were sent. Channels with pending messages take turns, so one busy channel
+    does not hold up the others. `slow_down` halves the rate; it then climbs
+    back to `rate` as messages go through.
+    """
+
+    def __init__(self, write, rate, burst, name='outbox'):
+        """
+        Args:
+            write (callable): Coroutine writing one payload.
+            rate (float): Messages per second, at most.
+            burst (int): Messages that may be written at once after a pause.
+            name (str): Prefix of its stats.
+        """
+        self.write = write
+        self.name = name
+        self.max_rate = rate
+        self.min_rate = rate / 16.0
+        self.bucket = TokenBucket(name, per_minute=rate * 60, burst=burst)
+        self.queued = 0
+        self._channels = {}  # channel -> deque of (payload, future, queued_at)
+        self._turns = collections.deque()  # Channels with messages, next first.
+        self._wakeup = locks.Event()
+        self._running = False
+
+        stats.gauge('%s.queued' % name, lambda: self.queued)
+        stats.gauge('%s.rate' % name, lambda: self.bucket.rate)
+
+    def send(self, channel, payload):
+        """Queue `payload` for `channel`.
+
+        Returns:
+            Future: The result of `write`, once written.
+        """
+        future = Future()
+        messages = self._channels.get(channel)
+        if messages is None:
+            messages = self._channels[channel] = collections.deque()
+            self._turns.append(channel)
+        messages.append((payload, future, time.time()))
+        self.queued += 1
+        self._wakeup.set()
+        if not self._running:
+            self._running = True
+            ioloop.IOLoop.current().add_callback(self._run)
+        return future
+
+    def slow_down(self):
+        """Halve the rate, e.g. after being told we send too fast."""
+        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+        self.bucket.tokens = 0
+        stats.incr('%s.throttled' % self.name)
+        log.warning('Sending too fast. Slowing down to %.2f messages/s.' % self.bucket.rate)
+
+    def _next(self):
+        channel = self._turns.popleft()
+        messages = self._channels[channel]
+        message = messages.popleft()
+        if messages:
+            self._turns.append(channel)
+        else:
+            del self._channels[channel]
+        self.queued -= 1
+        return message
+
+    @gen.coroutine
+    def _run(self):
+        while True:
+            if not self._turns:
+                self._wakeup.clear()
+                yield self._wakeup.wait()
+                continue
+
+            yield self.bucket.acquire()
+            payload, future, queued_at = self._next()
+            try:
+                result = yield self.write(payload)
+            except Exception as e:
+                log.error('Could not send message: %s' % e)
+                stats.incr('%s.errors' % self.name)
+                future.set_exception(e)
+                continue
+
+            stats.observe('%s.latency_ms' % self.name, (time.time() - queued_at) * 1000)
+            future.set_result(result)
+            # Recover from `slow_down` gradually: about 20 messages to full rate.
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 20)
+
+
+class _Pending(object):
+    __slots__ = ('future', 'written_at', 'timeout')
+
+    def __init__(self):
+        self.future = Future()
+        self.written_at = None
+        self.timeout = None
+
+
+class AckTable(object):
+    """Messages waiting for the reply that acknowledges them, by message id.
+
+    `expect` a message before sending it, mark it `written` once it is on the
+    wire, and `resolve` it with the reply. A message without a reply within
+    `timeout` seconds of being written resolves with `{'ok': False}`.
+    """
+
+    def __init__(self, timeout, name='acks'):
+        self.timeout = timeout
+        self.name = name
+        self._pending = {}  # message id -> _Pending
+
+        stats.gauge('%s.awaiting_ack' % name, lambda: len(self._pending))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def expect(self, message_id):
+        """Returns a Future of the reply to message `message_id`."""
+        pending = self._pending[message_id] = _Pending()
+        return pending.future
+
+    def written(self, message_id):
+        """Start the timeout of a message, now that it was written."""
+        pending = self._pending.get(message_id)
+        if pending is None:
+            return  # Already acknowledged.
+        pending.written_at = time.time()
+        pending.timeout = ioloop.IOLoop.current().call_later(
+            self.timeout, self._expire, message_id)
+
+    def discard(self, message_id):
+        """Stop waiting for a message, e.g. because it could not be written."""
+        pending = self._pending.pop(message_id, None)
+        if pending is not None and pending.timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(pending.timeout)
+
+    def resolve(self, reply):
+        """Resolve the message `reply` acknowledges. Returns False if none."""
+        pending = self._pending.pop(reply.get('reply_to'), None)
+        if pending is None:
+            return False
+        if pending.timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(pending.timeout)
+        if pending.written_at is not None:
+            stats.observe('%s.rtt_ms' % self.name, (time.time() - pending.written_at) * 1000)
+        stats.incr('%s.%s' % (self.name, 'acked' if reply.get('ok') else 'ack_errors'))
+        pending.future.set_result(reply)
+        return True
+
+    def _expire(self, message_id):
+        pending = self._pending.pop(message_id, None)
+        if pending is None:
+            return
+        log.warning('No reply to message %s within %ss.' % (message_id, self.timeout))
+        stats.incr('%s.ack_timeouts' % self.name)
+        pending.future.set_result({'ok': False, 'reply_to': message_id, 'error': {
+            'msg': 'No reply within %ss' % self.timeout}})
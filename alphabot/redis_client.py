@@ -0,0 +1,186 @@
+"""A minimal non-blocking Redis client for the IOLoop.
+
+Speaks RESP over tornado IOStreams. Commands issued during the same IOLoop
+iteration are written to the server in a single batch (automatic
+pipelining), and replies are matched to callers in order.
+"""
+
+import collections
+import logging
+
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+from alphabot import stats
+
+log = logging.getLogger(__name__)
+
+CRLF = b'\r\n'
+
+
+class RedisError(Exception):
+    """Error reply from the Redis server, or a broken connection."""
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+def encode_command(args):
+    """Encodes a command as a RESP array of bulk strings."""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        arg = _to_bytes(arg)
+        parts.append(b'$%d\r\n' % len(arg))
+        parts.append(arg)
+        parts.append(CRLF)
+    return b''.join(parts)
+
+
+class Connection(object):
+    """One connection to Redis. Replies are read in a background loop."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.waiting = collections.deque()  # Futures, in command order.
+        self.closed = False
+
+    def send(self, payload, futures):
+        self.waiting.extend(futures)
+        return self.stream.write(payload)
+
+    @gen.coroutine
+    def read_loop(self):
+        try:
+            while True:
+                reply = yield self._read_reply()
+                future = self.waiting.popleft()
+                if isinstance(reply, RedisError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except StreamClosedError as e:
+            self.close(RedisError('Connection to redis lost: %s' % (e.real_error or e)))
+        except Exception as e:
+            # Out of step with the server: no later reply can be trusted.
+            log.error('Closing the connection to redis: %s' % e)
+            self.close(RedisError('Bad reply from redis: %s' % e))
+
+    def close(self, error=None):
+        self.closed = True
+        self.stream.close()
+        error = error or RedisError('Connection to redis closed.')
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    @gen.coroutine
+    def _read_reply(self):
+        line = yield self.stream.read_until(CRLF)
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            raise gen.Return(body.decode('utf-8'))
+        if kind == b'-':
+            raise gen.Return(RedisError(body.decode('utf-8')))
+        if kind == b':':
+            raise gen.Return(int(body))
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                raise gen.Return(None)
+            data = yield self.stream.read_bytes(length + 2)
+            raise gen.Return(data[:-2])
+        if kind == b'*':
+            length = int(body)
+            if length < 0:
+                raise gen.Return(None)
+            items = []
+            for _ in range(length):
+                item = yield self._read_reply()
+                items.append(item)
+            raise gen.Return(items)
+        raise RedisError('Unexpected reply from redis: %r' % line)
+
+
+class AsyncRedis(object):
+    """Pooled, auto-pipelining Redis client.
+
+    `execute` never blocks: it queues the command and returns a Future. Once
+    per IOLoop iteration the queued commands are flushed in one write to the
+    connection with the fewest outstanding replies.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, pool_size=4):
+        self.host = host
+        self.port = int(port)
+        self.db = int(db)
+        self.pool_size = pool_size
+        self._connections = []
+        self._batch = []  # [(payload, future), ...] waiting for the next flush.
+        self._connecting = None
+
+    @gen.coroutine
+    def connect(self):
+        """Open the connection pool. Raises if redis is not reachable."""
+        self._connections = [c for c in self._connections if not c.closed]
+        while len(self._connections) < self.pool_size:
+            stream = yield TCPClient().connect(self.host, self.port)
+            connection = Connection(stream)
+            ioloop.IOLoop.current().add_future(connection.read_loop(), lambda f: f.result())
+            self._connections.append(connection)
+            if self.db:
+                future = Future()
+                connection.send(encode_command(('SELECT', self.db)), [future])
+                yield future
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+
+    def execute(self, *args):
+        """Queue a command. Returns a Future of its reply."""
+        future = Future()
+        if not self._batch:
+            ioloop.IOLoop.current().add_callback(self._flush)
+        self._batch.append((encode_command(args), future))
+        return future
+
+    def execute_many(self, commands):
+        """Queue several commands. Returns a list of Futures of their replies."""
+        return [self.execute(*command) for command in commands]
+
+    @gen.coroutine
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        try:
+            if len([c for c in self._connections if not c.closed]) < self.pool_size:
+                if self._connecting is None:
+                    self._connecting = self.connect()
+                try:
+                    yield self._connecting
+                finally:
+                    self._connecting = None
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(RedisError('Could not connect to redis: %s' % e))
+            return
+
+        open_connections = [c for c in self._connections if not c.closed]
+        connection = min(open_connections, key=lambda c: len(c.waiting))
+        stats.incr('redis.batches')
+        stats.incr('redis.commands', len(batch))
+        try:
+            yield connection.send(b''.join(p for p, _ in batch), [f for _, f in batch])
+        except StreamClosedError:
+            connection.close()
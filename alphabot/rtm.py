@@ -0,0 +1,232 @@
+"""Slack RTM websocket session.
+
+The session keeps one websocket to Slack open. It pings Slack, and treats a
+ping without a pong as a dead connection, which catches half-open sockets a
+read would wait on forever. A lost connection is replaced with a fresh
+`rtm.start`, after a jittered backoff when that fails. Events sent while the
+bot was away are lost, so the caller is told to resync its state.
+"""
+
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import time
+
+from tornado import gen, ioloop, locks, websocket
+from tornado.concurrent import Future
+
+from alphabot import stats
+
+log = logging.getLogger(__name__)
+
+# Seconds between pings, and to wait for the pong before reconnecting.
+SLACK_RTM_PING_INTERVAL = float(os.getenv('SLACK_RTM_PING_INTERVAL', 30))
+SLACK_RTM_PONG_TIMEOUT = float(os.getenv('SLACK_RTM_PONG_TIMEOUT', 10))
+# Most seconds to wait between two failed attempts to reconnect.
+SLACK_RTM_MAX_BACKOFF = float(os.getenv('SLACK_RTM_MAX_BACKOFF', 60))
+# Most seconds a slow delivery, e.g. to a full event queue, excuses missed pongs.
+SLACK_RTM_MAX_BUSY = float(os.getenv('SLACK_RTM_MAX_BUSY', 60))
+
+# A frame's "type", when it is the first key, as Slack sends events.
+_FRAME_TYPE = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+
+
+def frame_type(message):
+    """The type of a raw frame, found without decoding it. None if unclear."""
+    match = _FRAME_TYPE.match(message)
+    return match.group(1) if match else None
+
+
+class RTMSession(object):
+    """A websocket to the Slack RTM API that reconnects when lost.
+
+    Stats are prefixed with 'slack.rtm'.
+    """
+
+    def __init__(self, start, on_event, on_reconnect=None, ids=None, accepts=None,
+                 ping_interval=None, pong_timeout=None, max_backoff=None, max_busy=None):
+        """
+        Args:
+            start (callable): Coroutine calling `rtm.start`. Returns the
+                websocket URL.
+            on_event (callable): Coroutine called with every decoded event.
+            on_reconnect (callable): Coroutine called after a reconnect. It
+                runs in the background, while events are read again.
+            ids (iterator): Ids of the pings. Share it with the messages
+                sent on the socket, so replies can not be mixed up.
+            accepts (callable): Called with the type of every event. Events
+                it returns False for are dropped before being decoded.
+        """
+        self.start = start
+        self.on_event = on_event
+        self.on_reconnect = on_reconnect
+        self.ids = ids or itertools.count(1)
+        self.accepts = accepts
+        self.ping_interval = ping_interval or SLACK_RTM_PING_INTERVAL
+        self.pong_timeout = pong_timeout or SLACK_RTM_PONG_TIMEOUT
+        self.max_backoff = max_backoff or SLACK_RTM_MAX_BACKOFF
+        self.max_busy = max_busy or SLACK_RTM_MAX_BUSY
+        self.backoff = 1.0  # Seconds before the second attempt to reconnect.
+        self.connection = None
+        self.disconnected_at = None
+        self._connected = locks.Event()
+        self._pong = None  # (ping id, Future) of the ping waiting for its pong.
+        self._delivering_since = None  # When delivering the current event began.
+        self._closed = False
+
+        stats.gauge('slack.rtm.connected', lambda: int(self._connected.is_set()))
+
+    @gen.coroutine
+    def connect(self):
+        """Opens a websocket with a fresh `rtm.start`."""
+        url = yield self.start()
+        self.connection = yield websocket.websocket_connect(url)
+        self._connected.set()
+        stats.incr('slack.rtm.connects')
+
+    @gen.coroutine
+    def write(self, payload):
+        """Writes `payload`, waiting for the websocket if it is reconnecting."""
+        yield self._connected.wait()
+        yield self.connection.write_message(payload)
+
+    @gen.coroutine
+    def run(self):
+        """Reads events until `close`, reconnecting whenever needed."""
+        while not self._closed:
+            if self.connection is None:
+                yield self._reconnect()
+                continue
+            connection = self.connection
+            lost = Future()
+            self._heartbeat(connection, lost)
+            self._read(connection, lost)
+            reason = yield lost
+            if self._closed:
+                break
+            self._disconnect(connection, reason)
+
+    def close(self):
+        self._closed = True
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self._connected.clear()
+
+    def _disconnect(self, connection, reason):
+        log.warning('Slack websocket lost: %s. Reconnecting.' % reason)
+        stats.incr('slack.rtm.disconnects')
+        self.disconnected_at = time.time()
+        self._connected.clear()
+        self.connection = None
+        connection.close()
+
+    @gen.coroutine
+    def _reconnect(self):
+        for attempt in itertools.count():
+            try:
+                yield self.connect()
+                break
+            except Exception as e:
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.5)
+                log.error('Could not reconnect to Slack, retrying in %.1fs: %s' % (delay, e))
+                stats.incr('slack.rtm.reconnect_errors')
+                yield gen.sleep(delay)
+
+        log.info('Reconnected to Slack.')
+        if self.disconnected_at is not None:
+            stats.observe('slack.rtm.recovery_ms', (time.time() - self.disconnected_at) * 1000)
+        if self.on_reconnect:
+            # Catching up can take minutes on a big workspace: read meanwhile.
+            ioloop.IOLoop.current().spawn_callback(self._catch_up)
+
+    @gen.coroutine
+    def _catch_up(self):
+        try:
+            yield self.on_reconnect()
+        except Exception as e:
+            log.error('Could not catch up after reconnecting: %s' % e)
+
+    @gen.coroutine
+    def _read(self, connection, lost):
+        try:
+            while not lost.done():
+                message = yield connection.read_message()
+                if lost.done():
+                    break  # Replaced by a new connection meanwhile.
+                if message is None:
+                    lost.set_result('closed by Slack')
+                    break
+                event_type = frame_type(message)
+                if event_type not in (None, 'pong') and self.accepts and \
+                        not self.accepts(event_type):
+                    continue
+                log.debug('Slack message: "%s"', message)
+                yield self._deliver(json.loads(message))
+        except Exception as e:
+            if not lost.done():
+                lost.set_result('read failed: %s' % e)
+
+    @gen.coroutine
+    def _deliver(self, event):
+        if event.get('type') == 'pong':
+            pong = self._pong
+            if pong and pong[0] == event.get('reply_to') and not pong[1].done():
+                pong[1].set_result(None)
+            return
+        self._delivering_since = time.time()
+        try:
+            yield self.on_event(event)
+        finally:
+            self._delivering_since = None
+
+    @gen.coroutine
+    def _heartbeat(self, connection, lost):
+        try:
+            yield self._ping(connection, lost)
+        except Exception as e:
+            log.error('Slack websocket heartbeat failed: %s' % e, exc_info=1)
+            stats.incr('slack.rtm.heartbeat_errors')
+            if not lost.done():
+                lost.set_result('heartbeat failed: %s' % e)
+
+    def _busy(self):
+        """Whether an event is being delivered, for no longer than `max_busy`."""
+        since = self._delivering_since
+        return since is not None and time.time() - since < self.max_busy
+
+    @gen.coroutine
+    def _ping(self, connection, lost):
+        while True:
+            yield gen.sleep(self.ping_interval)
+            if lost.done():
+                break
+
+            ping_id = next(self.ids)
+            pong = Future()
+            self._pong = (ping_id, pong)
+            sent_at = time.time()
+            try:
+                yield connection.write_message(json.dumps({'id': ping_id, 'type': 'ping'}))
+            except websocket.WebSocketClosedError:
+                pass  # The read loop notices the close.
+
+            timeout = ioloop.IOLoop.current().call_later(
+                self.pong_timeout, lambda: pong.done() or pong.set_result('missed'))
+            missed = yield pong
+            ioloop.IOLoop.current().remove_timeout(timeout)
+            self._pong = None
+            if lost.done():
+                break
+            if not missed:
+                stats.observe('slack.rtm.ping_ms', (time.time() - sent_at) * 1000)
+            elif self._busy():
+                # The bot is busy with an earlier event; the pong may be queued.
+                log.debug('No pong while delivering an event, not a dead socket.')
+            else:
+                stats.incr('slack.rtm.missed_pongs')
+                lost.set_result('no pong within %ss' % self.pong_timeout)
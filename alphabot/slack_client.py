@@ -0,0 +1,245 @@
+"""Client of the Slack Web API.
+
+One client is shared by the whole bot. Calls are POSTs with a form (or JSON)
+body and the token in the Authorization header, so large parameters such as
+`attachments` never end up in a URL. Identical read calls that are in flight
+at the same time are sent once.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+from urllib.parse import urlencode
+
+from tornado import gen, httpclient, locks
+try:
+    # Reuses connections (keep-alive), unlike tornado's simple client.
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as HTTPClient
+    KEEP_ALIVE = True
+except ImportError:
+    # pycurl is a requirement, but may fail to install on some platforms.
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as HTTPClient
+    KEEP_ALIVE = False
+
+from alphabot import stats
+
+log = logging.getLogger(__name__)
+
+SLACK_API_URL = os.getenv('SLACK_API_URL', 'https://slack.com/api/')
+# Seconds before a call fails: to connect, and in total.
+SLACK_API_CONNECT_TIMEOUT = float(os.getenv('SLACK_API_CONNECT_TIMEOUT', 10))
+SLACK_API_TIMEOUT = float(os.getenv('SLACK_API_TIMEOUT', 30))
+# Calls allowed in flight at once. The rest wait for a free connection.
+SLACK_API_CONNECTIONS = int(os.getenv('SLACK_API_CONNECTIONS', 10))
+
+# Times a call is retried after a 429, or (reads only) a server or network error.
+SLACK_API_RETRIES = int(os.getenv('SLACK_API_RETRIES', 3))
+
+# Read-only methods, by suffix or name. Identical calls in flight are shared.
+READ_SUFFIXES = ('.info', '.list', '.history', '.replies', '.getPresence')
+READ_METHODS = ('auth.test', 'team.info')
+
+# Slack's rate tiers: (calls per minute, burst).
+TIERS = {
+    1: (1, 1),
+    2: (20, 5),
+    3: (50, 10),
+    4: (100, 20),
+    'post': (60, 10),  # chat.postMessage: about one per second.
+    'connect': (1, 3),  # Tier 1, with room to reconnect right after starting.
+}
+DEFAULT_TIER = 3
+METHOD_TIERS = {
+    'rtm.start': 'connect',
+    'rtm.connect': 'connect',
+    'users.list': 2,
+    'conversations.list': 2,
+    'channels.list': 2,
+    'groups.list': 2,
+    'chat.postMessage': 'post',
+    'chat.update': 3,
+    'chat.delete': 3,
+    'reactions.add': 3,
+    'reactions.remove': 3,
+    'conversations.history': 3,
+    'users.info': 4,
+    'conversations.info': 4,
+    'auth.test': 4,
+}
+
+
+def is_read(method):
+    return method in READ_METHODS or method.endswith(READ_SUFFIXES)
+
+
+class TokenBucket(object):
+    """Rate limit of one API method. Callers wait their turn, FIFO.
+
+    `name` prefixes its stats, e.g. 'slack.api.chat.update'.
+    """
+
+    def __init__(self, name, per_minute, burst):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.queued = 0
+        self._updated = time.time()
+        self._paused_until = 0
+        self._lock = locks.Lock()
+
+    def _take(self, now):
+        """Takes a token if there is one. Returns 0, or seconds to wait for one."""
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """Stop calls for `seconds`, e.g. as told by a Retry-After header."""
+        self._paused_until = max(self._paused_until, time.time() + seconds)
+        self.tokens = 0
+
+    @gen.coroutine
+    def acquire(self):
+        self.queued += 1
+        try:
+            with (yield self._lock.acquire()):
+                wait = self._take(time.time())
+                if wait:
+                    stats.incr('%s.delayed' % self.name)
+                while wait:
+                    yield gen.sleep(wait)
+                    wait = self._take(time.time())
+        finally:
+            self.queued -= 1
+
+
+class SlackClient(object):
+    """Pooled, coalescing Slack Web API client.
+
+    Every call returns a Future of the decoded response. Responses with
+    `"ok": false` are returned like any other; HTTP and network errors
+    raise. Coalesced callers receive the same response dict, so they must
+    not modify it.
+    """
+
+    def __init__(self, token, url=None, connect_timeout=None, timeout=None,
+                 max_connections=None):
+        self.token = token
+        self.url = (url or SLACK_API_URL).rstrip('/') + '/'
+        self.connect_timeout = connect_timeout or SLACK_API_CONNECT_TIMEOUT
+        self.timeout = timeout or SLACK_API_TIMEOUT
+        if not KEEP_ALIVE:
+            log.warning('pycurl is not installed: every Slack API call opens a new connection.')
+        self._http = HTTPClient(force_instance=True,
+                                max_clients=max_connections or SLACK_API_CONNECTIONS)
+        self._in_flight = {}  # (method, params) -> Future
+        self._buckets = {}  # method -> TokenBucket
+        self.retries = SLACK_API_RETRIES
+        self.backoff = 1.0  # Seconds before the first retry of an error.
+
+    def close(self):
+        self._http.close()
+
+    def call(self, method, params=None, json_body=False):
+        """Calls an API method.
+
+        Args:
+            method (str): e.g. 'chat.postMessage'.
+            params (dict): Arguments of the method.
+            json_body (bool): Send `params` as JSON rather than as a form.
+                Only methods that write accept JSON.
+
+        Returns:
+            Future: The decoded response.
+        """
+        params = params or {}
+        if json_body or not is_read(method):
+            return self._fetch(method, params, json_body)
+
+        key = (method, tuple(sorted((k, str(v)) for k, v in params.items())))
+        future = self._in_flight.get(key)
+        if future is not None:
+            stats.incr('slack.api.coalesced')
+            return future
+        future = self._in_flight[key] = self._fetch(method, params, json_body)
+        future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return future
+
+    def bucket(self, method):
+        """The TokenBucket of `method`, sized by its tier in METHOD_TIERS."""
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            per_minute, burst = TIERS[METHOD_TIERS.get(method, DEFAULT_TIER)]
+            bucket = self._buckets[method] = TokenBucket(
+                'slack.api.%s' % method, per_minute, burst)
+            stats.gauge('slack.api.%s.queued' % method, lambda: bucket.queued)
+        return bucket
+
+    @gen.coroutine
+    def _fetch(self, method, params, json_body):
+        """Calls `method` within its rate limit, retrying when possible."""
+        bucket = self.bucket(method)
+        for attempt in range(self.retries + 1):
+            yield bucket.acquire()
+            try:
+                response = yield self._post(method, params, json_body)
+            except (httpclient.HTTPClientError, IOError) as e:
+                code = getattr(e, 'code', None)
+                if code == 429:
+                    response = e.response
+                elif not is_read(method) or (code and code < 500) or attempt == self.retries:
+                    raise
+                else:
+                    delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    log.warning('Retrying %s in %.1fs: %s' % (method, delay, e))
+                    stats.incr('slack.api.retries')
+                    yield gen.sleep(delay)
+                    continue
+
+            if response.code == 429:
+                body = {'ok': False, 'error': 'ratelimited'}
+            else:
+                body = json.loads(response.body)
+            if body.get('error') != 'ratelimited':
+                raise gen.Return(body)
+
+            retry_after = float(response.headers.get('Retry-After', 1))
+            log.warning('Slack rate limited %s for %ss.' % (method, retry_after))
+            stats.incr('slack.api.%s.throttled' % method)
+            bucket.pause(retry_after * random.uniform(1, 1.2))
+            if attempt == self.retries:
+                raise gen.Return(body)
+            stats.incr('slack.api.retries')
+
+    @gen.coroutine
+    def _post(self, method, params, json_body):
+        headers = {'Authorization': 'Bearer %s' % self.token}
+        if json_body:
+            headers['Content-Type'] = 'application/json; charset=utf-8'
+            body = json.dumps(params)
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = urlencode(params)
+        request = httpclient.HTTPRequest(
+            self.url + method, method='POST', headers=headers, body=body,
+            connect_timeout=self.connect_timeout, request_timeout=self.timeout)
+
+        stats.incr('slack.api.calls')
+        start = time.time()
+        try:
+            response = yield self._http.fetch(request)
+        except Exception as e:
+            stats.incr('slack.api.errors')
+            log.error('Slack API call %s failed: %s' % (method, e))
+            raise
+        finally:
+            stats.observe('slack.api.%s.ms' % method, (time.time() - start) * 1000)
+        raise gen.Return(response)
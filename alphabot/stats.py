@@ -0,0 +1,107 @@
+"""Runtime counters, gauges and histograms.
+
+Everything registered here is served as JSON by the web app on /stats.
+"""
+
+import bisect
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (in the unit being observed, usually milliseconds).
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram. Cheap enough to update on every call."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of values."""
+        if not self.count:
+            return 0
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Stats(object):
+    """A registry of named counters, gauges and histograms."""
+
+    def __init__(self):
+        # Counters may be bumped from thread pool workers.
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def get(self, name):
+        return self._counters.get(name, 0)
+
+    def gauge(self, name, function):
+        """Report `function()` as the value of `name` on every snapshot."""
+        self._gauges[name] = function
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def histogram(self, name):
+        return self._histograms.get(name)
+
+    def snapshot(self):
+        values = dict(self._counters)
+        for name, function in list(self._gauges.items()):
+            try:
+                values[name] = function()
+            except Exception as e:
+                log.error('Gauge %s failed: %s' % (name, e))
+        for name, histogram in list(self._histograms.items()):
+            values[name] = histogram.snapshot()
+        return values
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+registry = Stats()
+incr = registry.incr
+gauge = registry.gauge
+observe = registry.observe
+snapshot = registry.snapshot
@@ -1,5 +1,13 @@
+import json
+
 import mock
+from tornado import escape
 from tornado import gen
+from tornado import iostream
+from tornado import tcpserver
+from tornado import testing
+from tornado import web
+from tornado import websocket
 
 __author__ = 'Mikhail Simin <mikhail@nextdoor.com>'
 
@@ -9,3 +17,192 @@ def mock_tornado(*args, **kwargs):
     if not len(args) and not kwargs.get('return_value'):
         m.return_value = gen.maybe_future(mock_tornado)
     return m
+
+
+class FakeRedisServer(tcpserver.TCPServer):
+    """In-process stand-in for redis-server, speaking enough RESP for tests.
+
+    Usage:
+        server = FakeRedisServer()
+        port = server.listen_any()
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FakeRedisServer, self).__init__(*args, **kwargs)
+        self.data = {}
+        self.commands = []
+        # Lua is not available: EVAL looks up a python stand-in for the
+        # script, called as function(data, keys, argv).
+        self.scripts = {}
+
+    def listen_any(self):
+        sock, port = testing.bind_unused_port()
+        self.add_socket(sock)
+        return port
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        resp3 = False
+        try:
+            while True:
+                args = yield self._read_command(stream)
+                self.commands.append(args)
+                if args[0].upper() == b'HELLO':
+                    resp3 = args[1] == b'3'
+                yield stream.write(self._reply(self.execute(args), resp3))
+        except iostream.StreamClosedError:
+            pass
+
+    @gen.coroutine
+    def _read_command(self, stream):
+        header = yield stream.read_until(b'\r\n')
+        args = []
+        for _ in range(int(header[1:-2])):
+            length = yield stream.read_until(b'\r\n')
+            arg = yield stream.read_bytes(int(length[1:-2]) + 2)
+            args.append(arg[:-2])
+        raise gen.Return(args)
+
+    def execute(self, args):
+        command = args[0].upper()
+        if command == b'PING':
+            return 'PONG'
+        if command in (b'SELECT', b'CLIENT'):
+            return 'OK'
+        if command == b'HELLO':
+            # Newer redis-py clients negotiate RESP3 and expect a map back.
+            return {b'server': b'fake-redis', b'proto': int(args[1])}
+        if command == b'GET':
+            return self.data.get(args[1])
+        if command == b'SET':
+            self.data[args[1]] = args[2]
+            return 'OK'
+        if command == b'MGET':
+            return [self.data.get(key) for key in args[1:]]
+        if command == b'MSET':
+            self.data.update(zip(args[1::2], args[2::2]))
+            return 'OK'
+        if command == b'DEL':
+            return len([self.data.pop(key) for key in args[1:] if key in self.data])
+        if command in (b'INCR', b'INCRBY'):
+            amount = int(args[2]) if len(args) > 2 else 1
+            try:
+                value = int(self.data.get(args[1], b'0')) + amount
+            except ValueError:
+                return Exception('ERR value is not an integer or out of range')
+            self.data[args[1]] = str(value).encode('utf-8')
+            return value
+        if command == b'EVAL':
+            num_keys = int(args[2])
+            keys, argv = args[3:3 + num_keys], args[3 + num_keys:]
+            return self.scripts[args[1].decode('utf-8')](self.data, keys, argv)
+        return Exception('ERR unknown command %r' % command)
+
+    def _reply(self, value, resp3=False):
+        if value is None:
+            return b'_\r\n' if resp3 else b'$-1\r\n'
+        if isinstance(value, Exception):
+            return b'-' + str(value).encode('utf-8') + b'\r\n'
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, dict):
+            return b'%%%d\r\n' % len(value) + b''.join(
+                self._reply(k, resp3) + self._reply(v, resp3) for k, v in value.items())
+        if isinstance(value, list):
+            return b'*%d\r\n' % len(value) + b''.join(self._reply(v, resp3) for v in value)
+        if isinstance(value, str):
+            return b'+' + value.encode('utf-8') + b'\r\n'
+        return b'$%d\r\n' % len(value) + value + b'\r\n'
+
+
+class FakeSlack(object):
+    """In-process stand-in for the Slack Web API.
+
+    Usage (in a testing.AsyncHTTPTestCase):
+        def get_app(self):
+            self.slack = FakeSlack()
+            return self.slack.make_app()
+
+        client = SlackClient('token', url=self.get_url('/api/'))
+
+    `responses` maps method names to a response dict, or to a function
+    called with the params that returns one (or a Future of one). A response
+    may also be a (status, headers, dict) tuple. Methods without a response
+    return {"ok": true}. Every call is recorded in `calls` as (method,
+    params, headers), and the connections they came on in `connections`.
+
+    It also serves an RTM websocket at /rtm. Open sockets are in `sockets`,
+    `emit` sends an event to all of them, and every message the bot sends is
+    recorded in `received`. Pings get a pong while `pongs` is true, and
+    messages are acknowledged.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.calls = []
+        self.connections = set()
+        self.sockets = []
+        self.received = []
+        self.pongs = True
+
+    def make_app(self):
+        return web.Application([
+            (r'/api/(.+)', FakeSlackHandler, {'slack': self}),
+            (r'/rtm', FakeRTMHandler, {'slack': self}),
+        ])
+
+    def emit(self, event):
+        for socket in self.sockets:
+            socket.write_message(json.dumps(event))
+
+
+class FakeSlackHandler(web.RequestHandler):
+
+    def initialize(self, slack):
+        self.slack = slack
+
+    @gen.coroutine
+    def post(self, method):
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(self.request.body)
+        else:
+            params = dict((k, escape.to_unicode(v[-1]))
+                          for k, v in self.request.body_arguments.items())
+        self.slack.calls.append((method, params, self.request.headers))
+        self.slack.connections.add(self.request.connection.stream)
+
+        response = self.slack.responses.get(method, {'ok': True})
+        if callable(response):
+            response = yield gen.maybe_future(response(params))
+        if isinstance(response, tuple):
+            status, headers, response = response
+            self.set_status(status)
+            for name, value in headers.items():
+                self.set_header(name, value)
+        self.write(response)
+
+
+class FakeRTMHandler(websocket.WebSocketHandler):
+
+    def initialize(self, slack):
+        self.slack = slack
+
+    def open(self):
+        self.slack.sockets.append(self)
+        self.write_message(json.dumps({'type': 'hello'}))
+
+    def on_message(self, message):
+        event = json.loads(message)
+        self.slack.received.append(event)
+        if event.get('type') == 'ping':
+            if self.slack.pongs:
+                self.write_message(json.dumps({'type': 'pong', 'reply_to': event['id']}))
+        elif event.get('type') == 'message':
+            self.write_message(json.dumps({
+                'ok': True, 'reply_to': event['id'], 'ts': '%d.000' % event['id'],
+                'text': event.get('text')}))
+
+    def on_close(self):
+        self.slack.sockets.remove(self)
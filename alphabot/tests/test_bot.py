@@ -1,7 +1,24 @@
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+from tornado import httputil
+from tornado import queues
 from tornado import testing
 from tornado import gen
+from tornado import web
+from tornado.concurrent import Future
 
 from alphabot import bot as AB
+from alphabot import directory
+from alphabot import outbox
+from alphabot import rtm
+from alphabot import stats
 from alphabot.tests.helper import mock_tornado
 
 import logging
@@ -22,6 +39,32 @@ class TestWebApp(testing.AsyncHTTPTestCase):
         self.assertEqual(response.code, 200)
         self.assertEqual(response.body.decode(), 'ok')
 
+    @testing.gen_test
+    def test_add_web_handler_replaces_the_path(self):
+        bot = AB.Bot(start_web_app=True)
+        rules = len(bot._web_app.default_router.rules)
+
+        class Old(web.RequestHandler):
+            def get(self):
+                self.write('old')
+
+        class New(web.RequestHandler):
+            def get(self):
+                self.write('new')
+
+        yield bot.add_web_handler(r'/button', Old)
+        yield bot.add_web_handler(r'/button', New)
+        self.assertEqual(len(bot._web_app.default_router.rules), rules + 1)
+
+        request = httputil.HTTPServerRequest(method='GET', uri='/button')
+        delegate = bot._web_app.find_handler(request)
+        self.assertIs(delegate.handler_class, New)
+
+    def test_stats(self):
+        response = self.fetch('/stats')
+        self.assertEqual(response.code, 200)
+        self.assertIn('events.queue.depth', json.loads(response.body.decode()))
+
 
 class TestBot(testing.AsyncTestCase):
 
@@ -60,6 +103,38 @@ class TestBot(testing.AsyncTestCase):
         kwargs = {'test': 'test', 'foobar': ['one', 'two']}
         self.assertFalse(bot._check_event_kwargs(event, kwargs))
 
+    @testing.gen_test
+    def test_duplicate_events_are_dispatched_once(self):
+        bot = AB.Bot()
+        seen = []
+        bot._dispatch = mock_tornado(side_effect=lambda event: seen.append(event))
+        message = {'type': 'message', 'channel': 'C1', 'ts': '1.2', 'text': 'hi'}
+        typing = {'type': 'user_typing', 'channel': 'C1'}
+        events = [message, typing, dict(message), typing, dict(message, ts='1.3')]
+        bot._get_next_event = mock_tornado(
+            side_effect=[gen.maybe_future(e) for e in events] + [TestException])
+        duplicates = stats.registry.get('events.duplicates')
+
+        with self.assertRaises(TestException):
+            yield bot.start()
+        self.assertEqual(seen, [message, typing, typing, dict(message, ts='1.3')])
+        self.assertEqual(stats.registry.get('events.duplicates'), duplicates + 1)
+
+    def test_accepts(self):
+        bot = AB.Bot()
+        bot._register_function({'type': 'message'}, lambda event: None)
+        dropped = stats.registry.get('events.dropped.user_typing')
+
+        self.assertTrue(bot._accepts('message'))
+        self.assertFalse(bot._accepts('user_typing'))
+        self.assertEqual(stats.registry.get('events.dropped.user_typing'), dropped + 1)
+
+        waiter = bot.wait_for_event(type='user_typing')
+        self.assertTrue(bot._accepts('user_typing'))
+        bot.cancel_wait(waiter)
+        self.assertFalse(bot._accepts('user_typing'))
+        self.assertTrue(AB.BotSlack()._accepts('channel_rename'))
+
     @testing.gen_test
     def test_wait_event(self):
         bot = AB.Bot()
@@ -75,3 +150,498 @@ class TestBot(testing.AsyncTestCase):
 
         event = yield waiter
         self.assertEquals(event, test_event)
+
+    @testing.gen_test
+    def test_add_command(self):
+        bot = AB.BotCLI()
+        bot.module_path = 'unit-scripts/commands'
+        heard = []
+
+        @bot.add_command('echo (?P<word>.*)')
+        @gen.coroutine
+        def echo(message, word):
+            heard.append((word, message.regex_groups))
+
+        @bot.add_command('ping')
+        @gen.coroutine
+        def ping(message):
+            heard.append('ping')
+
+        self.assertEqual(len(bot.event_listeners), 1)
+
+        yield bot._dispatch({'type': 'message', 'text': 'echo hi'})
+        yield bot._dispatch({'type': 'message', 'text': 'pong'})
+        self.assertEqual(heard, [('hi', ('hi',))])
+
+    @testing.gen_test
+    def test_event_context_is_shared(self):
+        bot = AB.BotCLI()
+        bot.module_path = 'unit-scripts/context'
+        bot._channel_for_event = mock.Mock(return_value='channel')
+        chats = []
+
+        @bot.on(type='message')
+        @gen.coroutine
+        def raw(event):
+            chats.append(event)
+
+        @bot.add_command('.*')
+        @gen.coroutine
+        def first(message):
+            chats.append(message)
+
+        @bot.add_command('hello')
+        @gen.coroutine
+        def second(message):
+            chats.append(message)
+
+        yield bot._dispatch({'type': 'message', 'text': 'hello', 'user': 'U1'})
+
+        event, first_chat, second_chat = chats
+        self.assertEqual(event['text'], 'hello')
+        self.assertEqual(first_chat.channel, 'channel')
+        self.assertEqual(second_chat.channel, 'channel')
+        self.assertEqual(second_chat.user, 'U1')
+        self.assertEqual(bot._channel_for_event.call_count, 1)
+
+    @testing.gen_test
+    def test_listen_for(self):
+        bot = AB.BotCLI()
+        chat = AB.Chat('hi', 'U1', None, {}, bot)
+        reply = chat.listen_for('(yes|no)', timeout=1)
+
+        yield bot._dispatch({'type': 'message', 'user': 'U2', 'text': 'yes'})
+        yield bot._dispatch({'type': 'message', 'user': 'U1', 'text': 'maybe'})
+        yield bot._dispatch({'type': 'message', 'user': 'U1', 'text': 'no'})
+
+        heard = yield reply
+        self.assertEqual(heard.text, 'no')
+        self.assertFalse(chat.listening)
+        self.assertEqual(len(bot._waiters), 0)
+
+    @testing.gen_test
+    def test_waiting_handlers_free_their_slot(self):
+        bot = AB.BotCLI()
+        bot.module_path = 'unit-scripts/waiting'
+        bot._executor.max_concurrency = 2
+        heard = []
+
+        @bot.add_command('ask')
+        @gen.coroutine
+        def ask(message):
+            yield message.listen_for('never')
+
+        @bot.add_command('ping')
+        @gen.coroutine
+        def ping(message):
+            heard.append('pong')
+
+        yield bot._dispatch({'type': 'message', 'user': 'U1', 'text': 'ask'})
+        yield bot._dispatch({'type': 'message', 'user': 'U2', 'text': 'ask'})
+        yield bot._dispatch({'type': 'message', 'user': 'U3', 'text': 'ping'})
+        yield gen.moment
+
+        self.assertEqual(heard, ['pong'])
+        self.assertEqual(bot._executor.in_flight, 0)
+        self.assertEqual(bot._executor.queued, 0)
+
+    @testing.gen_test
+    def test_event_queue_is_fifo(self):
+        bot = AB.Bot()
+        for n in range(3):
+            yield bot.put_event({'n': n})
+
+        received = []
+        for n in range(3):
+            event = yield bot._get_next_event()
+            received.append(event['n'])
+        self.assertEqual(received, [0, 1, 2])
+
+    @testing.gen_test
+    def test_event_queue_backpressure(self):
+        bot = AB.Bot()
+        bot._events = queues.Queue(maxsize=1)
+        yield bot.put_event({'n': 0})
+
+        blocked = bot.put_event({'n': 1})
+        yield gen.moment
+        self.assertFalse(blocked.done())
+
+        event = yield bot._get_next_event()
+        self.assertEqual(event['n'], 0)
+        yield blocked
+        self.assertEqual(bot._events.qsize(), 1)
+
+
+class TestBotSlack(testing.AsyncTestCase):
+
+    def make_bot(self):
+        bot = AB.BotSlack()
+        bot._user_id = 'UBOT'
+        bot._channels = directory.Directory([
+            {'id': 'C1', 'name': 'general', 'is_archived': False, 'is_member': False}])
+        bot._users = directory.Directory([
+            AB.User({'id': 'U1', 'name': 'alice', 'profile': {'real_name': 'Alice'}})])
+        return bot
+
+    @testing.gen_test
+    def test_channel_events_update_the_directory(self):
+        bot = self.make_bot()
+        events = [
+            {'type': 'channel_created', 'channel': {'id': 'C2', 'name': 'new'}},
+            {'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'renamed'}},
+            {'type': 'channel_archive', 'channel': 'C2', 'user': 'U1'},
+            {'type': 'member_joined_channel', 'channel': 'C2', 'user': 'UBOT'},
+            {'type': 'member_joined_channel', 'channel': 'C1', 'user': 'UBOT'},
+            {'type': 'member_left_channel', 'channel': 'C2', 'user': 'UBOT'},
+            {'type': 'member_left_channel', 'channel': 'C1', 'user': 'U1'},
+        ]
+        for event in events:
+            yield bot._dispatch(event)
+
+        self.assertEqual(bot.get_channel(name='renamed').info['id'], 'C1')
+        self.assertEqual(bot.get_channel(name='general'), None)
+        self.assertNotIn('members', bot.get_channel(id='C1').info)
+        self.assertTrue(bot.get_channel(id='C1').info['is_member'])
+        self.assertFalse(bot.get_channel(id='C2').info['is_member'])
+        self.assertTrue(bot.get_channel(name='new').info['is_archived'])
+
+    @testing.gen_test
+    def test_malformed_state_event_is_logged(self):
+        bot = self.make_bot()
+        seen = []
+
+        @gen.coroutine
+        def renamed(event):
+            seen.append(event)
+        bot._register_function({'type': 'channel_rename'}, renamed)
+        errors = stats.registry.get('slack.directory.update_errors')
+
+        yield bot._dispatch({'type': 'channel_rename'})
+        yield gen.moment
+        self.assertEqual(stats.registry.get('slack.directory.update_errors'), errors + 1)
+        self.assertEqual(len(seen), 1)
+
+    @testing.gen_test
+    def test_user_events_update_the_directory(self):
+        bot = self.make_bot()
+        yield bot._dispatch({'type': 'team_join', 'user': {
+            'id': 'U2', 'name': 'bob', 'profile': {'real_name': 'Bob'}}})
+        yield bot._dispatch({'type': 'user_change', 'user': {
+            'id': 'U1', 'name': 'alice', 'profile': {'real_name': 'Alice Smith'}}})
+
+        self.assertEqual(bot._get_user('U2').real_name, 'Bob')
+        self.assertEqual(bot._get_user('U1').real_name, 'Alice Smith')
+
+    @testing.gen_test
+    def test_resync(self):
+        bot = self.make_bot()
+        pages = {
+            ('conversations.list', None): {'channels': [{'id': 'C9', 'name': 'fresh'}]},
+            ('users.list', None): {
+                'members': [{'id': 'U1', 'name': 'alice', 'profile': {}}],
+                'response_metadata': {'next_cursor': 'page2'}},
+            ('users.list', 'page2'): {
+                'members': [{'id': 'U2', 'name': 'bob', 'profile': {}}],
+                'response_metadata': {'next_cursor': ''}},
+        }
+
+        @gen.coroutine
+        def api(method, params):
+            self.assertEqual(params['limit'], AB.SLACK_PAGE_SIZE)
+            raise gen.Return(pages[(method, params.get('cursor'))])
+        bot.api = api
+        yield bot._resync()
+
+        self.assertEqual([c['id'] for c in bot._channels], ['C9'])
+        self.assertEqual([u.name for u in bot._users], ['alice', 'bob'])
+
+    @testing.gen_test
+    def test_events_during_a_resync_are_replayed(self):
+        bot = self.make_bot()
+        loading = Future()
+
+        @gen.coroutine
+        def api(method, params):
+            yield loading
+            raise gen.Return({
+                'conversations.list': {'channels': [{'id': 'C1', 'name': 'general'}]},
+                'users.list': {'members': [{'id': 'U1', 'name': 'alice', 'profile': {}}]},
+            }[method])
+        bot.api = api
+        resync = bot._resync()
+
+        yield bot._dispatch({'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'new'}})
+        yield bot._dispatch({'type': 'team_join', 'user': {
+            'id': 'U2', 'name': 'bob', 'profile': {}}})
+        loading.set_result(None)
+        yield resync
+
+        self.assertEqual(bot.get_channel(id='C1').info['name'], 'new')
+        self.assertEqual(bot._get_user('U2').name, 'bob')
+        self.assertEqual(bot._state_buffers, [])
+
+    def test_user(self):
+        user = AB.User({'id': 'U1', 'name': 'alice', 'color': '9f69e7', 'profile': {
+            'real_name': 'Alice Smith', 'email': 'alice@example.com', 'title': 'Ops'}})
+
+        self.assertEqual((user.id, user.name, user.real_name), ('U1', 'alice', 'Alice Smith'))
+        self.assertEqual((user.color, user.title), ('9f69e7', 'Ops'))
+        self.assertEqual(user.profile['email'], 'alice@example.com')
+        self.assertEqual(user.get('title'), 'Ops')
+        self.assertEqual(user.get('missing', 'default'), 'default')
+        self.assertRaises(AttributeError, getattr, user, 'missing')
+        self.assertRaises(AttributeError, setattr, user, 'extra', 1)
+
+        users = directory.Directory([user])
+        self.assertEqual(users.find(title='Ops'), [user])
+        self.assertEqual(users.find(name='alice'), [user])
+
+    def connect(self, bot):
+        bot._message_ids = itertools.count(1)
+        bot._rtm = rtm.RTMSession(None, bot.put_event, ids=bot._message_ids)
+        bot._rtm.connection = bot.connection = mock.Mock()
+        bot._rtm._connected.set()
+        bot.connection.write_message = mock_tornado()
+        bot._outbox = outbox.Outbox(bot._write, rate=100.0, burst=10)
+        bot._acks = outbox.AckTable(timeout=0.05, name='test.send')
+
+    def written(self, bot):
+        return [json.loads(call[0][0]) for call in bot.connection.write_message.call_args_list]
+
+    @testing.gen_test
+    def test_send_resolves_with_the_ack(self):
+        bot = self.make_bot()
+        self.connect(bot)
+
+        first = bot.send('hello', 'C1')
+        second = bot.send('again', 'C1')
+        while len(bot.connection.write_message.call_args_list) < 2:
+            yield gen.moment
+        payloads = self.written(bot)
+        self.assertEqual([(p['id'], p['channel'], p['text']) for p in payloads],
+                         [(1, 'C1', 'hello'), (2, 'C1', 'again')])
+
+        yield bot._ingest({'ok': True, 'reply_to': 2, 'ts': '2.0', 'text': 'again'})
+        yield bot._ingest({'ok': True, 'reply_to': 1, 'ts': '1.0', 'text': 'hello'})
+        self.assertEqual((yield first)['ts'], '1.0')
+        self.assertEqual((yield second)['ts'], '2.0')
+        self.assertEqual(len(bot._acks), 0)
+
+    @testing.gen_test
+    def test_send_ack_timeout(self):
+        bot = self.make_bot()
+        self.connect(bot)
+        timeouts = stats.registry.get('test.send.ack_timeouts')
+
+        reply = yield bot.send('hello', 'C1')
+        self.assertEqual((reply['ok'], reply['reply_to']), (False, 1))
+        self.assertEqual(stats.registry.get('test.send.ack_timeouts'), timeouts + 1)
+
+    @testing.gen_test
+    def test_send_and_slow_down(self):
+        bot = self.make_bot()
+        self.connect(bot)
+
+        sent = bot.send('hello', 'C1')
+        while not bot.connection.write_message.called:
+            yield gen.moment
+
+        yield bot._ingest({'ok': False, 'reply_to': 1, 'error': {
+            'code': -1, 'msg': 'slow down, too many messages...'}})
+        self.assertEqual(bot._outbox.bucket.rate, 50.0)
+        self.assertEqual((yield sent)['error']['code'], -1)
+
+
+class TestBotSlackEvents(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.bot = AB.BotSlackEvents(start_web_app=True)
+        self.calls = []
+
+        @gen.coroutine
+        def api(method, params=None, json_body=False):
+            self.calls.append((method, params))
+            raise gen.Return({
+                'auth.test': {'ok': True, 'user_id': 'UBOT', 'user': 'alphabot'},
+                'users.list': {'ok': True, 'members': [{'id': 'U1', 'name': 'alice'}]},
+                'conversations.list': {'ok': True, 'channels': [{'id': 'C1', 'name': 'general'}]},
+            }.get(method, {'ok': True, 'ts': '1.2'}))
+        self.bot.api = api
+
+        env = {'SLACK_TOKEN': 'xoxb-token', 'SLACK_SIGNING_SECRET': 'secret'}
+        with mock.patch.dict('os.environ', env):
+            self.io_loop.run_sync(self.bot._setup)
+        return self.bot._web_app
+
+    def post_event(self, payload, secret='secret', timestamp=None):
+        body = json.dumps(payload).encode('utf-8')
+        timestamp = str(int(timestamp or time.time()))
+        return self.fetch(AB.SLACK_EVENTS_PATH, method='POST', body=body, headers={
+            'X-Slack-Request-Timestamp': timestamp,
+            'X-Slack-Signature': AB.slack_signature(secret, timestamp, body)})
+
+    def test_setup(self):
+        self.assertEqual(self.bot._user_id, 'UBOT')
+        self.assertEqual(self.bot.get_channel(name='general').info['id'], 'C1')
+        # Scripts checking for Slack keep working.
+        self.assertEqual((self.bot.engine, self.bot.transport), ('slack', 'events'))
+
+    def test_url_verification(self):
+        response = self.post_event({'type': 'url_verification', 'challenge': 'abc'})
+        self.assertEqual(json.loads(response.body), {'challenge': 'abc'})
+
+    def test_bad_signatures_are_rejected(self):
+        rejected = stats.registry.get('slack.events.rejected')
+        event = {'type': 'event_callback', 'event_id': 'Ev1', 'event': {'type': 'message'}}
+
+        self.assertEqual(self.post_event(event, secret='wrong').code, 403)
+        self.assertEqual(self.post_event(event, timestamp=time.time() - 3600).code, 403)
+        self.assertEqual(self.bot._events.qsize(), 0)
+        self.assertEqual(stats.registry.get('slack.events.rejected'), rejected + 2)
+
+    def test_events_are_queued_once(self):
+        self.bot._register_function({'type': 'message'}, lambda event: None)
+        duplicates = stats.registry.get('slack.events.duplicates')
+        dropped = stats.registry.get('events.dropped.user_typing')
+        message = {'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'hi'}
+        for event_id in ('Ev1', 'Ev2', 'Ev1'):
+            response = self.post_event(
+                {'type': 'event_callback', 'event_id': event_id, 'event': message})
+            self.assertEqual(response.code, 200)
+        self.post_event({'type': 'event_callback', 'event_id': 'Ev3',
+                         'event': {'type': 'user_typing'}})
+
+        self.assertEqual(stats.registry.get('events.dropped.user_typing'), dropped + 1)
+        self.assertEqual(self.bot._events.qsize(), 2)
+        self.assertEqual(self.io_loop.run_sync(self.bot._get_next_event), message)
+        self.assertEqual(stats.registry.get('slack.events.duplicates'), duplicates + 1)
+
+    @testing.gen_test
+    def test_send_posts_messages(self):
+        response = yield self.bot.send('hello', 'C1')
+
+        self.assertEqual(response, {'ok': True, 'ts': '1.2'})
+        self.assertEqual(self.calls[-1], ('chat.postMessage', {'channel': 'C1', 'text': 'hello'}))
+
+
+SCRIPT = '''
+import alphabot.bot
+bot = alphabot.bot.get_instance()
+
+
+@bot.on(type='%(name)s')
+def listener(event):
+    pass
+
+
+@bot.add_command('%(name)s')
+@bot.add_help('Says %(name)s')
+def command(message):
+    pass
+
+
+@bot.on_start
+def started():
+    bot.started.append('%(name)s')
+
+
+@bot.on_schedule(minute='0')
+def scheduled():
+    pass
+'''
+
+
+class TestReloadScripts(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestReloadScripts, self).setUp()
+        self.bot = AB.Bot()
+        self.bot.started = []
+        self.bot.send = mock.Mock()
+        patcher = mock.patch.object(AB.Bot, 'instance', self.bot)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+        self.module = 'reload_script_%d' % id(self)
+        self.addCleanup(sys.modules.pop, self.module, None)
+        self.jobs = len(AB.scheduler.get_jobs())
+
+    def write(self, source, name=None):
+        filename = os.path.join(self.dirname, (name or self.module) + '.py')
+        # Far enough from the previous mtime to defeat cached bytecode.
+        mtime = os.path.getmtime(filename) + 10 if os.path.exists(filename) else None
+        with open(filename, 'w') as script:
+            script.write(source)
+        if mtime:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def registrations(self):
+        return (sorted(kwargs.get('type') for kwargs, _ in self.bot.event_listeners),
+                [c.regex for c in self.bot._commands],
+                sorted(h['desc'] for h in self.bot.help._func_map.values()),
+                len(self.bot._function_map), len(AB.scheduler.get_jobs()) - self.jobs)
+
+    @testing.gen_test
+    def test_changed_module_is_replaced(self):
+        self.write(SCRIPT % {'name': 'old'})
+        self.bot.load_all_modules_from_dir(self.dirname)
+        self.assertEqual(self.registrations(),
+                         (['message', 'old'], ['old'], ['Says old'], 2, 1))
+
+        reloaded = yield self.bot.reload_scripts()
+        self.assertEqual(reloaded, [])
+
+        self.write(SCRIPT % {'name': 'new'})
+        reloaded = yield self.bot.reload_scripts()
+        self.assertEqual(reloaded, ['%s/%s' % (self.dirname, self.module)])
+        self.assertEqual(self.registrations(),
+                         (['message', 'new'], ['new'], ['Says new'], 2, 1))
+        self.assertEqual(self.bot.started, ['new'])
+        self.assertEqual(len(self.bot._on_start), 1)
+        self.assertEqual(self.bot.help.list(), [('new', 'Says new')])
+
+    @testing.gen_test
+    def test_broken_module_keeps_the_old_code(self):
+        self.write(SCRIPT % {'name': 'old'})
+        self.bot.load_all_modules_from_dir(self.dirname)
+        before = self.registrations()
+
+        self.write(SCRIPT % {'name': 'new'} + '\nraise ValueError("typo")\n')
+        reloaded = yield self.bot.reload_scripts()
+        self.assertEqual(reloaded, [])
+        self.assertEqual(self.registrations(), before)
+        self.assertTrue(self.bot.send.called)
+        # Not retried until it changes again.
+        self.bot.send.reset_mock()
+        yield self.bot.reload_scripts()
+        self.assertFalse(self.bot.send.called)
+
+    @testing.gen_test
+    def test_runtime_registrations_are_not_reloaded(self):
+        listens = '''
+
+@bot.on_start
+def listen():
+    bot.on(type='start_%(name)s')(listener)
+'''
+        self.write((SCRIPT + listens) % {'name': 'old'})
+        self.bot.load_all_modules_from_dir(self.dirname)
+        for function in list(self.bot._on_start):
+            yield self.bot._run_on_start(function)
+        self.bot.on(type='runtime')(lambda event: None)
+
+        self.write((SCRIPT + listens) % {'name': 'new'})
+        yield self.bot.reload_scripts()
+        self.assertEqual(self.registrations()[0], ['message', 'new', 'runtime', 'start_new'])
+
+    @testing.gen_test
+    def test_removed_module_is_unregistered(self):
+        filename = self.write(SCRIPT % {'name': 'old'})
+        self.bot.load_all_modules_from_dir(self.dirname)
+
+        os.remove(filename)
+        yield self.bot.reload_scripts()
+        self.assertEqual(self.registrations(), ([], [], [], 0, 0))
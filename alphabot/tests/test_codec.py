@@ -0,0 +1,59 @@
+import json
+import unittest
+
+import mock
+
+from alphabot import codec
+
+
+class TestCodec(unittest.TestCase):
+
+    values = [None, True, 7, 1.5, 'text', [1, 'two'], {'nested': {'list': [1, 2]}}]
+
+    def test_round_trip(self):
+        for name in codec.CODECS:
+            c = codec.Codec(name, compress_threshold=0)
+            for value in self.values:
+                self.assertEqual(c.decode(c.encode(value)), value, (name, value))
+
+    def test_json_is_stored_plain(self):
+        c = codec.Codec('json', compress_threshold=0)
+        self.assertEqual(c.encode({'a': 1}), b'{"a": 1}')
+        # As stored by older versions, as bytes (redis) or text (sqlite).
+        self.assertEqual(c.decode(b'{"a": 1}'), {'a': 1})
+        self.assertEqual(c.decode('{"a": 1}'), {'a': 1})
+
+    def test_integers_are_stored_plain(self):
+        c = codec.Codec('pickle', compress_threshold=0)
+        self.assertEqual(c.encode(42), b'42')
+        self.assertTrue(c.encode(True).startswith(codec.MAGIC))
+
+    def test_reads_any_codec(self):
+        value = {'set': [1, 2], 'text': 'x' * 100}
+        encoded = [codec.Codec(name, compress_threshold=0).encode(value)
+                   for name in codec.CODECS]
+        c = codec.Codec('json')
+        for raw in encoded:
+            self.assertEqual(c.decode(raw), value)
+
+    def test_compression(self):
+        c = codec.Codec('json', compress_threshold=100)
+        small = c.encode('x' * 10)
+        large = c.encode('x' * 1000)
+
+        self.assertEqual(small, json.dumps('x' * 10).encode('utf-8'))
+        self.assertEqual(large[:3], codec.MAGIC + b'j' + codec.ZLIB)
+        self.assertLess(len(large), 100)
+        self.assertEqual(c.decode(large), 'x' * 1000)
+
+    def test_default_and_undecodable(self):
+        c = codec.Codec()
+        self.assertEqual(c.decode(None, '5'), '5')
+        self.assertEqual(c.decode(b'not json'), b'not json')
+
+    def test_config_from_environment(self):
+        env = {'MEMORY_CODEC': 'marshal', 'MEMORY_COMPRESS_THRESHOLD': '0'}
+        with mock.patch.dict('os.environ', env):
+            c = codec.Codec()
+        self.assertEqual((c.name, c.compress_threshold), ('marshal', 0))
+        self.assertRaises(ValueError, codec.Codec, 'yaml')
@@ -0,0 +1,57 @@
+import unittest
+
+from alphabot.directory import Directory
+
+
+class TestDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = Directory([
+            {'id': 'C1', 'name': 'general', 'is_archived': False},
+            {'id': 'C2', 'name': 'random', 'is_archived': False},
+            {'id': 'G1', 'name': 'secret', 'is_archived': True},
+        ])
+
+    def test_get(self):
+        self.assertEqual(self.directory.get('C2')['name'], 'random')
+        self.assertEqual(self.directory.get('C9'), None)
+        self.assertIn('G1', self.directory)
+        self.assertEqual(len(self.directory), 3)
+
+    def test_find_by_index(self):
+        self.assertEqual(self.directory.find(name='general'), [self.directory.get('C1')])
+        self.assertEqual(self.directory.find(id='C1', name='random'), [])
+        self.assertEqual(self.directory.find(name='missing'), [])
+
+    def test_find_by_other_fields(self):
+        found = self.directory.find(is_archived=False)
+        self.assertEqual([c['id'] for c in found], ['C1', 'C2'])
+        self.assertEqual(self.directory.find(members=[]), [])
+
+    def test_add_replaces_and_reindexes(self):
+        self.directory.add({'id': 'C1', 'name': 'renamed'})
+
+        self.assertEqual(self.directory.find(name='general'), [])
+        self.assertEqual(self.directory.find(name='renamed')[0]['id'], 'C1')
+        self.assertEqual(len(self.directory), 3)
+
+    def test_remove(self):
+        removed = self.directory.remove('C2')
+
+        self.assertEqual(removed['name'], 'random')
+        self.assertEqual(self.directory.find(name='random'), [])
+        self.assertEqual(self.directory.remove('C2'), None)
+        self.assertEqual([c['id'] for c in self.directory], ['C1', 'G1'])
+
+    def test_unhashable_fields(self):
+        self.directory.add({'id': 'C3', 'name': ['odd']})
+        self.assertEqual(self.directory.find(name=['odd'])[0]['id'], 'C3')
+        self.directory.remove('C3')
+
+    def test_update(self):
+        updated = self.directory.update('C2', name='renamed', is_archived=True)
+
+        self.assertEqual(updated, {'id': 'C2', 'name': 'renamed', 'is_archived': True})
+        self.assertEqual(self.directory.find(name='renamed'), [updated])
+        self.assertEqual(self.directory.find(name='random'), [])
+        self.assertEqual(self.directory.update('C9', name='missing'), None)
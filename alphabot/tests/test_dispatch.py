@@ -0,0 +1,210 @@
+import unittest
+
+from tornado import gen
+from tornado import testing
+
+from alphabot import dispatch
+
+
+def _listener(name):
+    def function(event):
+        pass
+    function.__name__ = name
+    return function
+
+
+class TestListenerIndex(unittest.TestCase):
+
+    def test_match_keeps_subset_semantics(self):
+        index = dispatch.ListenerIndex()
+        message = ({'type': 'message'}, _listener('message'))
+        hello = ({'type': 'message', 'text': 'hello'}, _listener('hello'))
+        button = ({'type': 'message-action', 'callback_id': '42'}, _listener('button'))
+        throttle = ({'ok': False, 'error': {'code': -1}}, _listener('throttle'))
+        for listener in (message, hello, button, throttle):
+            index.append(listener)
+
+        self.assertEqual(index.match({'type': 'message', 'text': 'hello'}),
+                         [message, hello])
+        self.assertEqual(index.match({'type': 'message', 'text': 'bye'}), [message])
+        self.assertEqual(index.match({'type': 'message-action', 'callback_id': '42'}),
+                         [button])
+        self.assertEqual(index.match({'type': 'message-action', 'callback_id': '7'}), [])
+        self.assertEqual(index.match({'ok': False, 'error': {'code': -1}, 'reply_to': 1}),
+                         [throttle])
+
+    def test_match_preserves_registration_order(self):
+        index = dispatch.ListenerIndex()
+        listeners = [
+            ({'type': 'message'}, _listener('first')),
+            ({}, _listener('catch_all')),
+            ({'channel': 'C1'}, _listener('channel')),
+            ({'type': 'message', 'channel': 'C1'}, _listener('last')),
+        ]
+        for listener in listeners:
+            index.append(listener)
+
+        self.assertEqual(index.match({'type': 'message', 'channel': 'C1'}), listeners)
+        self.assertEqual(list(index), listeners)
+
+    def test_remove(self):
+        index = dispatch.ListenerIndex()
+        listener = ({'type': 'message'}, _listener('message'))
+        index.append(listener)
+        self.assertEqual(len(index), 1)
+
+        index.remove(listener)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.match({'type': 'message'}), [])
+        self.assertRaises(ValueError, index.remove, listener)
+
+    def test_unhashable_values(self):
+        index = dispatch.ListenerIndex()
+        listener = ({'type': ['a', 'b']}, _listener('list'))
+        index.append(listener)
+
+        self.assertEqual(index.match({'type': ['a', 'b']}), [listener])
+        self.assertEqual(index.match({'type': 'a'}), [])
+
+    def test_wants_type(self):
+        index = dispatch.ListenerIndex()
+        message = ({'type': 'message'}, _listener('message'))
+        button = ({'callback_id': '42'}, _listener('button'))
+        index.append(message)
+        index.append(message)
+        self.assertTrue(index.wants_type('message'))
+        self.assertFalse(index.wants_type('user_typing'))
+
+        index.append(button)
+        self.assertTrue(index.wants_type('user_typing'))
+        index.remove(button)
+        index.remove(message)
+        self.assertTrue(index.wants_type('message'))
+        index.remove(message)
+        self.assertFalse(index.wants_type('message'))
+
+
+class TestDedupWindow(unittest.TestCase):
+
+    def test_window(self):
+        dedup = dispatch.DedupWindow(size=10, window=60)
+        self.assertFalse(dedup.seen('a', now=100))
+        self.assertTrue(dedup.seen('a', now=159))
+        self.assertFalse(dedup.seen('b', now=159))
+        self.assertFalse(dedup.seen('a', now=161))
+        self.assertEqual(len(dedup), 2)
+
+    def test_size(self):
+        dedup = dispatch.DedupWindow(size=2, window=60)
+        for key in ('a', 'b', 'c'):
+            dedup.seen(key, now=100)
+        self.assertEqual(len(dedup), 2)
+        self.assertTrue(dedup.seen('c', now=100))
+        self.assertFalse(dedup.seen('a', now=100))
+
+    def test_event_key(self):
+        message = {'type': 'message', 'channel': 'C1', 'ts': '1.2'}
+        self.assertEqual(dispatch.event_key(message), ('message', 'C1', '1.2'))
+        self.assertEqual(dispatch.event_key(dict(message, client_msg_id='abc')), 'abc')
+        self.assertEqual(dispatch.event_key({'type': 'x', 'event_id': 'Ev1'}), 'Ev1')
+        self.assertEqual(dispatch.event_key({'type': 'user_typing', 'channel': 'C1'}), None)
+        self.assertEqual(dispatch.event_key({'channel': {'id': 'C1'}, 'ts': '1'}), None)
+
+
+class TestCommandRouter(unittest.TestCase):
+
+    def test_literal_prefix(self):
+        self.assertEqual(dispatch.literal_prefix('!help$'), '!help')
+        self.assertEqual(dispatch.literal_prefix('!help (.*)'), '!help ')
+        self.assertEqual(dispatch.literal_prefix('random number'), 'random number')
+        self.assertEqual(dispatch.literal_prefix('hel+o'), 'hel')
+        self.assertEqual(dispatch.literal_prefix('hello?'), 'hell')
+        self.assertEqual(dispatch.literal_prefix('ab{2}'), 'a')
+        self.assertEqual(dispatch.literal_prefix(r'\!deploy \d+'), '!deploy ')
+        self.assertEqual(dispatch.literal_prefix('<@U123>.*'), '<@U123>')
+        self.assertEqual(dispatch.literal_prefix('hi|hello'), '')
+        self.assertEqual(dispatch.literal_prefix('h(i|ello)'), 'h')
+        self.assertEqual(dispatch.literal_prefix('[|]x'), '')
+        self.assertEqual(dispatch.literal_prefix('(?i)hi'), '')
+        self.assertEqual(dispatch.literal_prefix(r'\w+'), '')
+
+    def test_route(self):
+        router = dispatch.CommandRouter()
+        help_cmd = router.add('!help$', _listener('help'))
+        query_cmd = router.add('!help (?P<query>.*)', _listener('help_query'))
+        any_cmd = router.add('.*lunch.*', _listener('lunch'))
+        either_cmd = router.add('hi|hello', _listener('hi'))
+
+        self.assertEqual([c for c, _ in router.route('!help')], [help_cmd])
+        routed = router.route('!help me')
+        self.assertEqual([c for c, _ in routed], [query_cmd])
+        self.assertEqual(routed[0][1].groupdict(), {'query': 'me'})
+
+        self.assertEqual([c for c, _ in router.route('!help$')], [])
+        self.assertEqual([c for c, _ in router.route('time for lunch')], [any_cmd])
+        self.assertEqual([c for c, _ in router.route('hello')], [either_cmd])
+        self.assertEqual(router.route(''), [])
+        self.assertEqual(router.route(None), [])
+
+        router.remove(help_cmd)
+        self.assertEqual(len(router), 3)
+        self.assertRaises(ValueError, router.remove, help_cmd)
+
+    def test_route_matches_chat_semantics(self):
+        from alphabot.bot import Chat
+        regexes = ['!help$', 'hello', 'hel+o', 'a|b', r'\d+ items?', 'x.*', '(a)?b']
+        texts = ['!help', 'hello', 'helllo', 'a', 'b', '3 items', '1 item',
+                 'xyz', 'ab', 'hello\n', '']
+
+        router = dispatch.CommandRouter()
+        for regex in regexes:
+            router.add(regex, _listener(regex))
+
+        for text in texts:
+            expected = [r for r in regexes
+                        if Chat(text, None, None, {}, None).matches_regex(r)]
+            routed = [c.regex for c, _ in router.route(text)]
+            self.assertEqual(routed, expected, text)
+
+
+class TestWaiterRegistry(testing.AsyncTestCase):
+
+    @testing.gen_test
+    def test_dispatch_resolves_matching_waiter(self):
+        registry = dispatch.WaiterRegistry()
+        button = registry.wait({'type': 'message-action', 'callback_id': '1'})
+        other = registry.wait({'type': 'message-action', 'callback_id': '2'})
+
+        event = {'type': 'message-action', 'callback_id': '1'}
+        self.assertEqual(registry.dispatch(event), 1)
+        self.assertEqual((yield button), event)
+        self.assertFalse(other.done())
+        self.assertEqual(len(registry), 1)
+
+    @testing.gen_test
+    def test_predicate(self):
+        registry = dispatch.WaiterRegistry()
+        waiter = registry.wait({'type': 'message'},
+                               predicate=lambda e: e.get('user') == 'U1')
+
+        self.assertEqual(registry.dispatch({'type': 'message', 'user': 'U2'}), 0)
+        self.assertEqual(registry.dispatch({'type': 'message', 'user': 'U1'}), 1)
+        self.assertEqual((yield waiter)['user'], 'U1')
+
+    @testing.gen_test
+    def test_timeout(self):
+        registry = dispatch.WaiterRegistry()
+        waiter = registry.wait({'type': 'message'}, timeout=0.01)
+        with self.assertRaises(gen.TimeoutError):
+            yield waiter
+        self.assertEqual(len(registry), 0)
+
+    @testing.gen_test
+    def test_cancel(self):
+        registry = dispatch.WaiterRegistry()
+        waiter = registry.wait({'type': 'message'})
+        registry.cancel(waiter)
+
+        self.assertTrue(waiter.cancelled())
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(registry.dispatch({'type': 'message'}), 0)
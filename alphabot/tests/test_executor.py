@@ -0,0 +1,164 @@
+import threading
+
+import mock
+from tornado import gen
+from tornado import testing
+from tornado.concurrent import Future
+
+from alphabot import executor
+
+
+class TestHandlerExecutor(testing.AsyncTestCase):
+
+    def make_executor(self, **kwargs):
+        self.errors = []
+        return executor.HandlerExecutor(
+            error_handler=lambda future, chat: self.errors.append(chat), **kwargs)
+
+    def make_handler(self, name='handler'):
+        """Returns a handler whose calls stay in flight until resolved."""
+        calls = []
+
+        def handler(**kwargs):
+            future = Future()
+            calls.append((kwargs, future))
+            return future
+        handler.__name__ = name
+        return handler, calls
+
+    @testing.gen_test
+    def test_global_cap_queues_in_order(self):
+        pool = self.make_executor(max_concurrency=2)
+        handler, calls = self.make_handler()
+        for n in range(4):
+            pool.submit(handler, {'n': n})
+
+        self.assertEqual(pool.in_flight, 2)
+        self.assertEqual(pool.queued, 2)
+
+        calls[0][1].set_result(None)
+        yield gen.moment
+        self.assertEqual([kwargs['n'] for kwargs, _ in calls], [0, 1, 2])
+        self.assertEqual(pool.queued, 1)
+
+    @testing.gen_test
+    def test_per_handler_limit(self):
+        pool = self.make_executor(max_concurrency=10)
+        slow, slow_calls = self.make_handler('slow')
+        fast, fast_calls = self.make_handler('fast')
+        pool.limit(concurrency=1)(slow)
+
+        pool.submit(slow, {})
+        pool.submit(slow, {})
+        pool.submit(fast, {})
+        self.assertEqual(len(slow_calls), 1)
+        self.assertEqual(len(fast_calls), 1)
+        self.assertEqual(pool.queued, 1)
+
+        slow_calls[0][1].set_result(None)
+        yield gen.moment
+        self.assertEqual(len(slow_calls), 2)
+        self.assertEqual(pool.queued, 0)
+
+    @testing.gen_test
+    def test_waiting_frees_the_slot(self):
+        pool = self.make_executor(max_concurrency=1)
+        replies = [Future(), Future()]
+        ran = []
+
+        @gen.coroutine
+        def ask(n):
+            yield pool.waiting(replies[n])
+            ran.append(n)
+
+        pool.submit(ask, {'n': 0})
+        pool.submit(ask, {'n': 1})
+        self.assertEqual((pool.in_flight, pool.queued), (0, 0))
+
+        replies[0].set_result(None)
+        yield gen.moment
+        self.assertEqual(pool.in_flight, 1)
+        yield gen.moment
+        self.assertEqual(ran, [0])
+        self.assertEqual(pool.in_flight, 0)
+
+        # Outside of a handler nothing is freed.
+        pool.waiting(replies[1])
+        self.assertEqual(pool.in_flight, 0)
+
+    def test_drop_oldest(self):
+        pool = self.make_executor()
+        handler, calls = self.make_handler()
+        pool.limit(concurrency=1, policy=executor.DROP_OLDEST, queue_size=1)(handler)
+
+        for n in range(3):
+            pool.submit(handler, {'n': n})
+
+        self.assertEqual(pool.queued, 1)
+        self.assertEqual(list(pool._pending.values())[0].kwargs, {'n': 2})
+
+    def test_queue_full_drops_newest(self):
+        pool = self.make_executor(max_concurrency=1, queue_size=1)
+        handler, calls = self.make_handler()
+
+        for n in range(3):
+            pool.submit(handler, {'n': n})
+
+        self.assertEqual(pool.queued, 1)
+        self.assertEqual(list(pool._pending.values())[0].kwargs, {'n': 1})
+
+    def test_reject_replies(self):
+        pool = self.make_executor()
+        handler, calls = self.make_handler('report')
+        pool.limit(concurrency=1, policy=executor.REJECT)(handler)
+        chat = mock.Mock()
+
+        pool.submit(handler, {}, chat)
+        pool.submit(handler, {}, chat)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(pool.queued, 0)
+        chat.reply.assert_called_once_with(executor.BUSY_REPLY % 'report')
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, executor.Limit, 1, 'wait-forever')
+
+
+class TestBlockingPool(testing.AsyncTestCase):
+
+    @testing.gen_test
+    def test_runs_off_the_ioloop_thread(self):
+        pool = executor.BlockingPool(max_workers=2, name='test-pool')
+        started = threading.Event()
+        release = threading.Event()
+
+        @pool.blocking
+        def slow(value):
+            started.set()
+            release.wait(5)
+            return (value, threading.current_thread().name)
+
+        future = slow(42)
+        started.wait(5)
+        self.assertEqual(pool.active, 1)
+        self.assertEqual(pool.utilization(), 0.5)
+
+        release.set()
+        value, thread_name = yield future
+        self.assertEqual(value, 42)
+        self.assertNotEqual(thread_name, threading.current_thread().name)
+        self.assertEqual(pool.active, 0)
+
+    @testing.gen_test
+    def test_exceptions_propagate(self):
+        pool = executor.BlockingPool(max_workers=1, name='test-pool')
+        with self.assertRaises(PoolError):
+            yield pool.submit(_raise)
+
+
+class PoolError(Exception):
+    """Unique exception to be used during testing."""
+
+
+def _raise():
+    raise PoolError()
@@ -0,0 +1,498 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+from tornado import gen
+from tornado import testing
+
+from alphabot import codec
+from alphabot import memory
+from alphabot import redis_client
+from alphabot import stats
+from alphabot.tests.helper import FakeRedisServer
+
+
+class TestMemoryDict(testing.AsyncTestCase):
+
+    @testing.gen_test
+    def test_save_and_get(self):
+        m = memory.MemoryDict()
+        yield m.setup()
+        yield m.save('key', {'a': 1})
+
+        value = yield m.get('key')
+        self.assertEqual(value, {'a': 1})
+        missing = yield m.get('missing', 'default')
+        self.assertEqual(missing, 'default')
+
+    @testing.gen_test
+    def test_lru_eviction(self):
+        m = memory.MemoryDict(max_entries=2)
+        yield m.save('a', 1)
+        yield m.save('b', 2)
+        yield m.get('a')  # 'b' is now the least recently used.
+        yield m.save('c', 3)
+
+        self.assertEqual(list(m.values), ['a', 'c'])
+        self.assertEqual(m.evictions, 1)
+
+    @testing.gen_test
+    def test_lfu_eviction(self):
+        m = memory.MemoryDict(max_entries=2, eviction='lfu')
+        yield m.save('a', 1)
+        yield m.save('b', 2)
+        for _ in range(3):
+            yield m.get('b')
+        yield m.save('c', 3)  # Evicts 'a', never the value just saved.
+        yield m.save('d', 4)  # 'c' and 'd' have one use each; 'c' is older.
+
+        self.assertEqual(sorted(m.values), ['b', 'd'])
+        self.assertEqual(m.evictions, 2)
+
+    @testing.gen_test
+    def test_byte_budget(self):
+        m = memory.MemoryDict(max_bytes=10000)
+        for n in range(20):
+            yield m.save('key-%d' % n, 'x' * 1000)
+
+        self.assertLessEqual(m.bytes, 10000)
+        self.assertLess(len(m.values), 10)
+        self.assertIn('key-19', m.values)
+        yield m.delete('key-19')
+        self.assertEqual(m.bytes, sum(m._sizes.values()))
+
+    @testing.gen_test
+    def test_ttl(self):
+        m = memory.MemoryDict(ttl=60)
+        yield m.save('key', 'value')
+        yield m.save('forever', 'value')
+        self.assertTrue(m.expire('forever', None))
+        self.assertFalse(m.expire('missing', 10))
+
+        with mock.patch('time.time', return_value=time.time() + 30):
+            value = yield m.get('key')
+        self.assertEqual(value, 'value')
+
+        with mock.patch('time.time', return_value=time.time() + 90):
+            value = yield m.get('key')
+            forever = yield m.get('forever')
+        self.assertEqual((value, forever), (None, 'value'))
+        self.assertEqual(m.expirations, 1)
+        m._sweeper.stop()
+
+    @testing.gen_test
+    def test_expired_keys_are_swept(self):
+        m = memory.MemoryDict()
+        yield m.save_many({'a': 1, 'b': 2, 'c': 3})
+        m.expire('a', 5)
+        m.expire('b', 500)
+
+        with mock.patch('time.time', return_value=time.time() + 10):
+            m._expire_due()
+        self.assertEqual(sorted(m.values), ['b', 'c'])
+        self.assertEqual(m.expirations, 1)
+        m._sweeper.stop()
+
+    def test_config_from_environment(self):
+        env = {'MEMORY_MAX_ENTRIES': '100', 'MEMORY_TTL': '1.5', 'MEMORY_EVICTION': 'lfu'}
+        with mock.patch.dict('os.environ', env):
+            m = memory.MemoryDict()
+        self.assertEqual((m.max_entries, m.max_bytes, m.ttl, m.eviction),
+                         (100, None, 1.5, 'lfu'))
+        self.assertRaises(ValueError, memory.MemoryDict, eviction='random')
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_expired(self):
+        wheel = memory.TimerWheel(resolution=1.0, slots=8)
+        now = wheel._tick * 1.0
+        wheel.schedule('soon', now + 2.5)
+        wheel.schedule('later', now + 20)  # Shares a bucket with 'soon' + 16.
+        wheel.schedule('cancelled', now + 1)
+        wheel.cancel('cancelled')
+
+        self.assertEqual(wheel.expired(now + 2), [])
+        self.assertEqual(wheel.expired(now + 3), ['soon'])
+        self.assertEqual(wheel.expired(now + 18.6), [])
+        self.assertEqual(wheel.expired(now + 100), ['later'])
+        self.assertEqual(wheel.deadlines, {})
+
+
+class TestMemoryRedisAsync(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestMemoryRedisAsync, self).setUp()
+        self.server = FakeRedisServer()
+        port = self.server.listen_any()
+        with mock.patch.dict('os.environ', {'REDIS_PORT': str(port), 'REDIS_POOL_SIZE': '2'}):
+            self.memory = memory.MemoryRedisAsync()
+
+    def tearDown(self):
+        self.memory.r.close()
+        self.server.stop()
+        super(TestMemoryRedisAsync, self).tearDown()
+
+    @testing.gen_test
+    def test_save_and_get(self):
+        yield self.memory.setup()
+        yield self.memory.save('key', {'a': [1, 2]})
+
+        value = yield self.memory.get('key')
+        self.assertEqual(value, {'a': [1, 2]})
+        missing = yield self.memory.get('missing')
+        self.assertEqual(missing, None)
+
+    @testing.gen_test
+    def test_reads_values_written_by_memory_redis(self):
+        yield self.memory.setup()
+        # What MemoryRedis._save stores for the same value.
+        self.server.data[b'random_number'] = json.dumps(7).encode('utf-8')
+
+        value = yield self.memory.get('random_number')
+        self.assertEqual(value, 7)
+
+    @testing.gen_test
+    def test_commands_in_one_tick_are_pipelined(self):
+        yield self.memory.setup()
+        batches = stats.registry.get('redis.batches')
+
+        values = yield [self.memory.get('key-%d' % n, n) for n in range(20)]
+        self.assertEqual(values, list(range(20)))
+        self.assertEqual(stats.registry.get('redis.batches'), batches + 1)
+
+    @testing.gen_test
+    def test_bad_reply_closes_the_connection(self):
+        yield self.memory.setup()
+        reply = self.server._reply
+        self.server._reply = mock.Mock(return_value=b'?garbage\r\n')
+
+        with self.assertRaises(redis_client.RedisError):
+            yield self.memory.r.execute('PING')
+        self.assertEqual(len([c for c in self.memory.r._connections if c.closed]), 1)
+
+        self.server._reply = reply
+        value = yield self.memory.r.execute('PING')
+        self.assertEqual(value, 'PONG')
+
+
+class TestMemoryCache(testing.AsyncTestCase):
+
+    def make_cache(self, **kwargs):
+        self.backend = memory.MemoryDict()
+        self.backend._get = mock.Mock(wraps=self.backend._get)
+        return memory.MemoryCache(self.backend, **kwargs)
+
+    @testing.gen_test
+    def test_read_through(self):
+        cache = self.make_cache()
+        yield cache.setup()
+        yield self.backend.save('key', 'value')
+
+        for _ in range(3):
+            value = yield cache.get('key')
+            self.assertEqual(value, 'value')
+        missing = yield cache.get('missing', 'default')
+        missing = yield cache.get('missing', 'default')
+
+        self.assertEqual(missing, 'default')
+        self.assertEqual(self.backend._get.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+    @testing.gen_test
+    def test_lru_eviction(self):
+        cache = self.make_cache(max_entries=2)
+        yield cache.setup()
+        yield cache.save('a', 1)
+        yield cache.save('b', 2)
+        yield cache.get('a')  # 'b' is now the least recently used.
+        yield cache.save('c', 3)
+
+        self.assertEqual(list(cache._entries), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+        value = yield cache.get('b')
+        self.assertEqual(value, 2)  # Written through, so still in the backend.
+
+    @testing.gen_test
+    def test_ttl(self):
+        cache = self.make_cache(ttl=60)
+        yield cache.setup()
+        yield cache.save('key', 'old')
+        yield self.backend.save('key', 'new')
+
+        with mock.patch('time.time', return_value=time.time() + 30):
+            value = yield cache.get('key')
+        self.assertEqual(value, 'old')
+
+        with mock.patch('time.time', return_value=time.time() + 90):
+            value = yield cache.get('key')
+        self.assertEqual(value, 'new')
+
+    @testing.gen_test
+    def test_write_behind(self):
+        cache = self.make_cache(write_mode='behind', flush_interval=60)
+        yield cache.setup()
+        yield cache.save('key', 'value')
+
+        self.assertEqual(self.backend.values, {})
+        value = yield cache.get('key')
+        self.assertEqual(value, 'value')
+
+        yield cache.flush()
+        self.assertEqual(self.backend.values, {'key': 'value'})
+        cache._flusher.stop()
+
+    @testing.gen_test
+    def test_failed_flush_keeps_values(self):
+        cache = self.make_cache(write_mode='behind', flush_interval=60)
+        yield cache.setup()
+        cache._flusher.stop()
+        yield cache.save_many({'a': 1, 'b': 2})
+
+        save_many = self.backend._save_many
+        self.backend._save_many = mock.Mock(side_effect=IOError('backend down'))
+        with self.assertRaises(IOError):
+            yield cache.flush()
+        self.assertEqual(cache._dirty, {'a': 1, 'b': 2})
+
+        save_many = self.backend._save_many = mock.Mock(wraps=save_many)
+        yield cache.save('b', 3)
+        yield cache.flush()
+        self.assertEqual(self.backend.values, {'a': 1, 'b': 3})
+        self.assertEqual(cache._dirty, {})
+        self.assertEqual(save_many.call_count, 1)
+
+    @testing.gen_test
+    def test_evicted_values_stay_pending_until_saved(self):
+        cache = self.make_cache(max_entries=1, write_mode='behind', flush_interval=60)
+        yield cache.setup()
+        cache._flusher.stop()
+        save = self.backend._save
+        self.backend._save = mock.Mock(side_effect=IOError('backend down'))
+
+        yield cache.save('a', 1)
+        yield cache.save('b', 2)  # Evicts 'a', whose save fails.
+        yield gen.moment
+        self.assertEqual(list(cache._entries), ['b'])
+        self.assertEqual(cache._dirty, {'a': 1, 'b': 2})
+        value = yield cache.get('a')
+        self.assertEqual(value, 1)
+
+        self.backend._save = save
+        yield cache.flush()
+        self.assertEqual(self.backend.values, {'a': 1, 'b': 2})
+        self.assertEqual(cache._dirty, {})
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, memory.MemoryCache, memory.MemoryDict(),
+                          write_mode='sideways')
+
+
+def fake_cas_script(data, keys, argv):
+    """Python version of memory.REDIS_CAS_SCRIPT."""
+    exists, expected, value = argv
+    current = data.get(keys[0])
+    if (exists == b'0' and current is None) or (exists == b'1' and current == expected):
+        data[keys[0]] = value
+        return 1
+    return current
+
+
+class MemoryAPITests(object):
+    """Batch and atomic operations every engine must support."""
+
+    @gen.coroutine
+    def make_memory(self):
+        raise NotImplementedError()
+
+    @testing.gen_test
+    def test_get_many_and_save_many(self):
+        m = yield self.make_memory()
+        yield m.save_many({'a': 1, 'b': {'nested': [1, 2]}})
+
+        values = yield m.get_many(['a', 'b', 'missing'], default='x')
+        self.assertEqual(values, {'a': 1, 'b': {'nested': [1, 2]}, 'missing': 'x'})
+        values = yield m.get_many([])
+        self.assertEqual(values, {})
+
+    @testing.gen_test
+    def test_default_is_returned_as_is(self):
+        m = yield self.make_memory()
+        value = yield m.get('missing', '5')
+        self.assertEqual(value, '5')
+        values = yield m.get_many(['missing'], default='5')
+        self.assertEqual(values, {'missing': '5'})
+
+    @testing.gen_test
+    def test_delete(self):
+        m = yield self.make_memory()
+        yield m.save('key', 'value')
+
+        existed = yield m.delete('key')
+        self.assertTrue(existed)
+        existed = yield m.delete('key')
+        self.assertFalse(existed)
+        value = yield m.get('key')
+        self.assertEqual(value, None)
+
+    @testing.gen_test
+    def test_incr(self):
+        m = yield self.make_memory()
+        values = []
+        for amount in (1, 1, 5):
+            value = yield m.incr('counter', amount)
+            values.append(value)
+        self.assertEqual(values, [1, 2, 7])
+
+        value = yield m.get('counter')
+        self.assertEqual(value, 7)
+
+    @testing.gen_test
+    def test_compare_and_set(self):
+        m = yield self.make_memory()
+
+        swapped = yield m.compare_and_set('key', None, {'v': 1})
+        self.assertTrue(swapped)
+        swapped = yield m.compare_and_set('key', None, {'v': 2})
+        self.assertFalse(swapped)
+        swapped = yield m.compare_and_set('key', {'v': 0}, {'v': 2})
+        self.assertFalse(swapped)
+        swapped = yield m.compare_and_set('key', {'v': 1}, {'v': 2})
+        self.assertTrue(swapped)
+
+        value = yield m.get('key')
+        self.assertEqual(value, {'v': 2})
+
+
+class TestMemoryDictAPI(MemoryAPITests, testing.AsyncTestCase):
+
+    @gen.coroutine
+    def make_memory(self):
+        m = memory.MemoryDict()
+        yield m.setup()
+        raise gen.Return(m)
+
+
+class TestMemoryCacheAPI(MemoryAPITests, testing.AsyncTestCase):
+
+    @gen.coroutine
+    def make_memory(self):
+        m = memory.MemoryCache(memory.MemoryDict(), write_mode='behind', flush_interval=60)
+        yield m.setup()
+        m._flusher.stop()
+        raise gen.Return(m)
+
+
+class RedisAPITests(MemoryAPITests):
+
+    def setUp(self):
+        super(RedisAPITests, self).setUp()
+        self.server = FakeRedisServer()
+        self.server.scripts[memory.REDIS_CAS_SCRIPT] = fake_cas_script
+        self.port = self.server.listen_any()
+
+    def tearDown(self):
+        self.server.stop()
+        super(RedisAPITests, self).tearDown()
+
+    @testing.gen_test
+    def test_codec(self):
+        m = yield self.make_memory()
+        m.codec = codec.Codec('pickle', compress_threshold=100)
+        value = {'set': set([1, 2]), 'history': ['message'] * 100}
+        yield m.save_many({'value': value, 'count': 1})
+        yield m.incr('count')
+
+        self.assertTrue(self.server.data[b'value'].startswith(codec.MAGIC + b'pz'))
+        values = yield m.get_many(['value', 'count'])
+        self.assertEqual(values, {'value': value, 'count': 2})
+
+    @testing.gen_test
+    def test_compare_and_set_is_one_round_trip(self):
+        m = yield self.make_memory()
+        yield m.save('key', {'v': 1})
+        del self.server.commands[:]
+
+        swapped = yield m.compare_and_set('key', {'v': 1}, {'v': 2})
+        self.assertTrue(swapped)
+        self.assertEqual([c[0] for c in self.server.commands], [b'EVAL'])
+
+        # Equal, but stored with another codec: compared once more as stored.
+        m.codec = codec.Codec('pickle')
+        del self.server.commands[:]
+        swapped = yield m.compare_and_set('key', {'v': 2}, {'v': 3})
+        self.assertTrue(swapped)
+        self.assertEqual([c[0] for c in self.server.commands], [b'EVAL', b'EVAL'])
+        value = yield m.get('key')
+        self.assertEqual(value, {'v': 3})
+
+
+class TestMemoryRedisAPI(RedisAPITests, testing.AsyncTestCase):
+
+    @gen.coroutine
+    def make_memory(self):
+        with mock.patch.dict('os.environ', {'REDIS_PORT': str(self.port)}):
+            m = memory.MemoryRedis()
+        yield m.setup()
+        raise gen.Return(m)
+
+
+class TestMemoryRedisAsyncAPI(RedisAPITests, testing.AsyncTestCase):
+
+    @gen.coroutine
+    def make_memory(self):
+        with mock.patch.dict('os.environ', {'REDIS_PORT': str(self.port)}):
+            m = memory.MemoryRedisAsync()
+        yield m.setup()
+        raise gen.Return(m)
+
+    @testing.gen_test
+    def test_incr_is_one_round_trip(self):
+        m = yield self.make_memory()
+        batches = stats.registry.get('redis.batches')
+        yield [m.incr('counter') for _ in range(10)]
+
+        value = yield m.get('counter')
+        self.assertEqual(value, 10)
+        self.assertEqual(stats.registry.get('redis.batches'), batches + 2)
+
+
+class TestMemoryFileAPI(MemoryAPITests, testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestMemoryFileAPI, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'memory.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestMemoryFileAPI, self).tearDown()
+
+    @gen.coroutine
+    def make_memory(self):
+        with mock.patch.dict('os.environ', {'MEMORY_FILE': self.path}):
+            m = memory.MemoryFile()
+        yield m.setup()
+        raise gen.Return(m)
+
+    @testing.gen_test
+    def test_values_survive_restart(self):
+        m = yield self.make_memory()
+        yield m.save_many({'a': {'list': [1, 2]}, 'b': 'two', 'c': 3})
+        yield m.delete('c')
+        yield m.incr('counter', 5)
+
+        restarted = yield self.make_memory()
+        self.assertEqual(restarted.values, {'a': {'list': [1, 2]}, 'b': 'two', 'counter': 5})
+
+    @testing.gen_test
+    def test_concurrent_writes_share_a_commit(self):
+        m = yield self.make_memory()
+        commits = stats.registry.get('memory.file.commits')
+
+        yield [m.save('key-%d' % n, n) for n in range(50)]
+        self.assertEqual(stats.registry.get('memory.file.commits'), commits + 1)
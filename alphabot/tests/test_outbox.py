@@ -0,0 +1,118 @@
+from tornado import gen
+from tornado import testing
+
+from alphabot import outbox
+from alphabot import stats
+
+
+class TestOutbox(testing.AsyncTestCase):
+
+    def make_outbox(self, rate=1000.0, burst=100):
+        self.written = []
+
+        @gen.coroutine
+        def write(payload):
+            if payload == 'fail':
+                raise IOError('socket closed')
+            self.written.append(payload)
+        return outbox.Outbox(write, rate=rate, burst=burst, name='test.send')
+
+    @testing.gen_test
+    def test_channels_take_turns_in_order(self):
+        box = self.make_outbox()
+        futures = [box.send('busy', 'busy-%d' % n) for n in range(3)]
+        futures.append(box.send('quiet', 'quiet-0'))
+        self.assertEqual(box.queued, 4)
+
+        yield futures
+        self.assertEqual(self.written, ['busy-0', 'quiet-0', 'busy-1', 'busy-2'])
+        self.assertEqual(box.queued, 0)
+        self.assertEqual(box._channels, {})
+
+    @testing.gen_test
+    def test_rate(self):
+        box = self.make_outbox(rate=20.0, burst=1)
+        yield [box.send('C1', n) for n in range(3)]
+        start = self.io_loop.time()
+        yield box.send('C1', 3)
+        self.assertGreaterEqual(self.io_loop.time() - start, 0.04)
+
+    @testing.gen_test
+    def test_slow_down_and_recover(self):
+        box = self.make_outbox(rate=1000.0)
+        throttled = stats.registry.get('test.send.throttled')
+        box.slow_down()
+        box.slow_down()
+        self.assertEqual(box.bucket.rate, 250.0)
+        self.assertEqual(stats.registry.get('test.send.throttled'), throttled + 2)
+
+        yield [box.send('C1', n) for n in range(5)]
+        self.assertEqual(box.bucket.rate, 500.0)
+        yield [box.send('C1', n) for n in range(20)]
+        self.assertEqual(box.bucket.rate, 1000.0)
+
+        for _ in range(10):
+            box.slow_down()
+        self.assertEqual(box.bucket.rate, box.min_rate)
+
+    @testing.gen_test
+    def test_errors(self):
+        box = self.make_outbox()
+        failed = box.send('C1', 'fail')
+        sent = box.send('C1', 'after')
+
+        with self.assertRaises(IOError):
+            yield failed
+        yield sent
+        self.assertEqual(self.written, ['after'])
+
+    @testing.gen_test
+    def test_latency_histogram(self):
+        box = self.make_outbox()
+        yield box.send('C1', 'hello')
+        histogram = stats.registry.histogram('test.send.latency_ms')
+        self.assertGreaterEqual(histogram.count, 1)
+
+
+class TestAckTable(testing.AsyncTestCase):
+
+    @testing.gen_test
+    def test_resolve(self):
+        acks = outbox.AckTable(timeout=10, name='test.acks')
+        reply = acks.expect(1)
+        acks.written(1)
+        self.assertEqual(len(acks), 1)
+
+        self.assertFalse(acks.resolve({'ok': True, 'reply_to': 2}))
+        self.assertTrue(acks.resolve({'ok': True, 'reply_to': 1, 'ts': '1.0'}))
+        self.assertEqual((yield reply)['ts'], '1.0')
+        self.assertEqual(len(acks), 0)
+        self.assertGreaterEqual(stats.registry.histogram('test.acks.rtt_ms').count, 1)
+
+    @testing.gen_test
+    def test_ack_before_written(self):
+        acks = outbox.AckTable(timeout=0.01, name='test.acks')
+        reply = acks.expect(1)
+        acks.resolve({'ok': False, 'reply_to': 1, 'error': {'code': 2}})
+        acks.written(1)
+
+        yield gen.sleep(0.02)
+        self.assertEqual((yield reply)['error'], {'code': 2})
+
+    @testing.gen_test
+    def test_timeout_starts_when_written(self):
+        acks = outbox.AckTable(timeout=0.01, name='test.acks')
+        reply = acks.expect(1)
+        yield gen.sleep(0.02)
+        self.assertFalse(reply.done())
+
+        acks.written(1)
+        self.assertEqual((yield reply)['ok'], False)
+        self.assertFalse(acks.resolve({'ok': True, 'reply_to': 1}))
+
+    def test_discard(self):
+        acks = outbox.AckTable(timeout=10, name='test.acks')
+        acks.expect(1)
+        acks.discard(1)
+        acks.discard(1)
+        self.assertEqual(len(acks), 0)
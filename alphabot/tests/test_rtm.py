@@ -0,0 +1,266 @@
+import json
+import os
+import unittest
+
+import mock
+
+from tornado import gen
+from tornado import testing
+from tornado.concurrent import Future
+
+from alphabot import bot as AB
+from alphabot import rtm
+from alphabot import slack_client
+from alphabot import stats
+from alphabot.tests.helper import FakeSlack
+
+
+class TestRTMSession(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.slack = FakeSlack()
+        return self.slack.make_app()
+
+    def setUp(self):
+        super(TestRTMSession, self).setUp()
+        self.events = []
+        self.starts = 0
+        self.reconnects = 0
+        self.session = rtm.RTMSession(self.start, self.on_event, self.on_reconnect,
+                                      ping_interval=0.02, pong_timeout=0.05)
+        self.session.backoff = 0.01
+
+    def tearDown(self):
+        self.session.close()
+        super(TestRTMSession, self).tearDown()
+
+    @gen.coroutine
+    def start(self):
+        self.starts += 1
+        raise gen.Return(self.get_url('/rtm').replace('http', 'ws', 1))
+
+    @gen.coroutine
+    def on_event(self, event):
+        self.events.append(event)
+
+    @gen.coroutine
+    def on_reconnect(self):
+        self.reconnects += 1
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        while not condition():
+            yield gen.sleep(0.01)
+
+    def ping_count(self):
+        histogram = stats.registry.histogram('slack.rtm.ping_ms')
+        return histogram.count if histogram else 0
+
+    @testing.gen_test
+    def test_events_and_pings(self):
+        yield self.session.connect()
+        self.session.run()
+        pings = self.ping_count()
+
+        yield self.wait_for(lambda: self.events)
+        self.slack.emit({'type': 'message', 'text': 'hi'})
+        yield self.wait_for(lambda: len(self.events) == 2)
+        yield self.wait_for(lambda: self.ping_count() > pings)
+
+        self.assertEqual([e['type'] for e in self.events], ['hello', 'message'])
+        self.assertIn('ping', [e['type'] for e in self.slack.received])
+        self.assertEqual(self.starts, 1)
+
+    @testing.gen_test
+    def test_unwanted_events_are_dropped(self):
+        self.session.accepts = lambda event_type: event_type != 'user_typing'
+        yield self.session.connect()
+        self.session.run()
+
+        self.slack.emit({'type': 'user_typing', 'channel': 'C1'})
+        self.slack.emit({'reply_to': 1, 'ok': True, 'type': 'user_typing'})
+        self.slack.emit({'type': 'message', 'text': 'hi'})
+        yield self.wait_for(lambda: len(self.events) == 3)
+        self.assertEqual([e['type'] for e in self.events], ['hello', 'user_typing', 'message'])
+        self.assertIn('reply_to', self.events[1])
+
+    @testing.gen_test
+    def test_reconnect_after_close(self):
+        yield self.session.connect()
+        self.session.run()
+        yield self.wait_for(lambda: self.slack.sockets)
+
+        self.slack.sockets[0].close()
+        yield self.wait_for(lambda: self.reconnects)
+        yield self.wait_for(lambda: self.slack.sockets)
+        self.slack.emit({'type': 'message', 'text': 'back'})
+        yield self.wait_for(lambda: self.events[-1].get('text') == 'back')
+
+        self.assertEqual(self.starts, 2)
+        self.assertEqual(len(self.slack.sockets), 1)
+
+    @testing.gen_test
+    def test_events_are_read_while_catching_up(self):
+        caught_up = []
+
+        @gen.coroutine
+        def on_reconnect():
+            self.reconnects += 1
+            yield gen.sleep(5)
+            caught_up.append(1)
+        self.session.on_reconnect = on_reconnect
+        yield self.session.connect()
+        self.session.run()
+        yield self.wait_for(lambda: self.slack.sockets)
+
+        self.slack.sockets[0].close()
+        yield self.wait_for(lambda: self.reconnects)
+        yield self.wait_for(lambda: self.slack.sockets)
+        self.slack.emit({'type': 'message', 'text': 'back'})
+        yield self.wait_for(lambda: self.events[-1].get('text') == 'back')
+        self.assertFalse(caught_up)
+
+    @testing.gen_test
+    def test_missed_pong_reconnects(self):
+        self.slack.pongs = False
+        missed = stats.registry.get('slack.rtm.missed_pongs')
+
+        @gen.coroutine
+        def on_reconnect():
+            self.slack.pongs = True
+            self.reconnects += 1
+        self.session.on_reconnect = on_reconnect
+        yield self.session.connect()
+        self.session.run()
+
+        yield self.wait_for(lambda: self.reconnects)
+        self.assertEqual(stats.registry.get('slack.rtm.missed_pongs'), missed + 1)
+        self.assertEqual(self.starts, 2)
+
+    @testing.gen_test
+    def test_busy_delivery_excuses_missed_pongs_for_a_while(self):
+        self.slack.pongs = False
+        self.session.max_busy = 0.2
+        stuck = Future()
+
+        @gen.coroutine
+        def on_event(event):
+            yield stuck  # E.g. a full event queue.
+        self.session.on_event = on_event
+        yield self.session.connect()
+        self.session.run()
+
+        yield gen.sleep(0.15)
+        self.assertEqual(self.reconnects, 0)
+        yield self.wait_for(lambda: self.reconnects)
+        self.assertEqual(self.starts, 2)
+
+    @testing.gen_test
+    def test_heartbeat_errors_reconnect(self):
+        errors = stats.registry.get('slack.rtm.heartbeat_errors')
+
+        def ids():
+            raise ValueError('no more ids')
+            yield
+        self.session.ids = ids()
+        yield self.session.connect()
+        self.session.run()
+
+        yield self.wait_for(lambda: self.reconnects)
+        self.assertEqual(stats.registry.get('slack.rtm.heartbeat_errors'), errors + 1)
+
+    @testing.gen_test
+    def test_reconnect_backoff(self):
+        failures = []
+
+        @gen.coroutine
+        def start():
+            if len(failures) < 2:
+                failures.append(1)
+                raise IOError('rtm.start failed')
+            url = yield self.start()
+            raise gen.Return(url)
+        self.session.start = start
+        errors = stats.registry.get('slack.rtm.reconnect_errors')
+
+        self.session.run()
+        yield self.wait_for(lambda: self.reconnects)
+        self.assertEqual(stats.registry.get('slack.rtm.reconnect_errors'), errors + 2)
+
+    @testing.gen_test
+    def test_write_waits_for_the_connection(self):
+        written = self.session.write(json.dumps({'id': 1, 'type': 'message', 'text': 'hi'}))
+        yield gen.sleep(0.02)
+        self.assertFalse(written.done())
+
+        yield self.session.connect()
+        yield written
+        yield self.wait_for(lambda: self.slack.received)
+        self.assertEqual(self.slack.received[0]['text'], 'hi')
+
+
+class TestFrameType(unittest.TestCase):
+
+    def test_frame_type(self):
+        self.assertEqual(rtm.frame_type('{"type": "user_typing", "channel": "C1"}'),
+                         'user_typing')
+        self.assertEqual(rtm.frame_type(' {"type":"message","blocks":[]}'), 'message')
+        # Not the first key: the type could be that of a nested object.
+        self.assertEqual(rtm.frame_type('{"blocks": [{"type": "section"}], "type": "x"}'),
+                         None)
+        self.assertEqual(rtm.frame_type('{"ok": true, "reply_to": 1}'), None)
+
+
+class TestBotSlackSession(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.slack = FakeSlack()
+        self.slack.responses['rtm.start'] = lambda params: {
+            'ok': True, 'url': self.get_url('/rtm').replace('http', 'ws', 1),
+            'self': {'id': 'UBOT', 'name': 'alphabot'}}
+        self.slack.responses['users.list'] = {'ok': True, 'members': [{'id': 'U1', 'name': 'al'}]}
+        self.slack.responses['conversations.list'] = {
+            'ok': True, 'channels': [{'id': 'C1', 'name': 'general'}]}
+        return self.slack.make_app()
+
+    @testing.gen_test
+    def test_send_and_reconnect(self):
+        bot = AB.BotSlack()
+        with mock.patch.dict(os.environ, {'SLACK_TOKEN': 'xoxb-token'}), \
+                mock.patch.object(slack_client, 'SLACK_API_URL', self.get_url('/api/')):
+            yield bot._setup()
+        bot.start()
+        bot._resync_callback.stop()
+
+        reply = yield bot.send('hello', 'C1')
+        self.assertEqual((reply['ok'], reply['ts']), (True, '1.000'))
+
+        self.slack.sockets[0].close()
+        while len([c for c in self.slack.calls if c[0] == 'rtm.start']) < 2:
+            yield gen.sleep(0.01)
+        reply = yield bot.send('again', 'C1')
+        self.assertEqual(reply['ts'], '2.000')
+        while len([c for c in self.slack.calls if c[0] == 'users.list']) < 2:
+            yield gen.sleep(0.01)
+        bot._rtm.close()
+
+    @testing.gen_test
+    def test_start_scripts_get_their_acks(self):
+        bot = AB.BotSlack()
+        with mock.patch.dict(os.environ, {'SLACK_TOKEN': 'xoxb-token'}), \
+                mock.patch.object(slack_client, 'SLACK_API_URL', self.get_url('/api/')):
+            yield bot._setup()
+        replies = []
+
+        @gen.coroutine
+        def greet():
+            reply = yield bot.send('hello', 'C1')
+            replies.append(reply)
+        bot._on_start.append(greet)
+        bot.start()
+
+        while not replies:
+            yield gen.sleep(0.01)
+        bot._resync_callback.stop()
+        self.assertEqual((replies[0]['ok'], replies[0]['ts']), (True, '1.000'))
+        bot._rtm.close()
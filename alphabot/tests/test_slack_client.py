@@ -0,0 +1,190 @@
+import json
+import time
+import unittest
+
+from tornado import gen
+from tornado import httpclient
+from tornado import testing
+from tornado import web
+from tornado.concurrent import Future
+
+from alphabot import slack_client
+from alphabot import stats
+from alphabot.tests.helper import FakeSlack
+
+
+class TestSlackClient(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.slack = FakeSlack()
+        return self.slack.make_app()
+
+    def setUp(self):
+        super(TestSlackClient, self).setUp()
+        self.client = slack_client.SlackClient('xoxb-token', url=self.get_url('/api/'))
+        self.client.backoff = 0.01
+
+    def tearDown(self):
+        self.client.close()
+        super(TestSlackClient, self).tearDown()
+
+    @testing.gen_test
+    def test_form_post(self):
+        attachments = json.dumps([{'text': 'x' * 10000}])
+        self.slack.responses['chat.postMessage'] = {'ok': True, 'ts': '1.2'}
+
+        response = yield self.client.call('chat.postMessage', {
+            'channel': 'C1', 'attachments': attachments})
+
+        self.assertEqual(response, {'ok': True, 'ts': '1.2'})
+        method, params, headers = self.slack.calls[0]
+        self.assertEqual(method, 'chat.postMessage')
+        self.assertEqual(params, {'channel': 'C1', 'attachments': attachments})
+        self.assertEqual(headers['Authorization'], 'Bearer xoxb-token')
+
+    @testing.gen_test
+    def test_json_post(self):
+        blocks = [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'hi'}}]
+        yield self.client.call('chat.postMessage', {'channel': 'C1', 'blocks': blocks},
+                               json_body=True)
+
+        method, params, headers = self.slack.calls[0]
+        self.assertEqual(params, {'channel': 'C1', 'blocks': blocks})
+        self.assertTrue(headers['Content-Type'].startswith('application/json'))
+
+    @testing.gen_test
+    def test_identical_reads_are_coalesced(self):
+        release = Future()
+
+        @gen.coroutine
+        def users_info(params):
+            yield release
+            raise gen.Return({'ok': True, 'user': {'id': params['user']}})
+        self.slack.responses['users.info'] = users_info
+
+        futures = [self.client.call('users.info', {'user': user})
+                   for user in ('U1', 'U1', 'U2', 'U1')]
+        self.assertIs(futures[0], futures[1])
+        while len(self.slack.calls) < 2:
+            yield gen.sleep(0.01)
+        release.set_result(None)
+        responses = yield futures
+
+        self.assertEqual([r['user']['id'] for r in responses], ['U1', 'U1', 'U2', 'U1'])
+        self.assertEqual(len(self.slack.calls), 2)
+        self.assertEqual(self.client._in_flight, {})
+
+        yield self.client.call('users.info', {'user': 'U1'})
+        self.assertEqual(len(self.slack.calls), 3)
+
+    @testing.gen_test
+    def test_writes_are_not_coalesced(self):
+        yield [self.client.call('chat.postMessage', {'channel': 'C1', 'text': 'hi'})
+               for _ in range(2)]
+        self.assertEqual(len(self.slack.calls), 2)
+
+    @testing.gen_test
+    def test_latency_histogram(self):
+        yield self.client.call('team.info')
+        histogram = stats.registry.histogram('slack.api.team.info.ms')
+        count = histogram.count
+        yield self.client.call('team.info')
+        self.assertEqual(histogram.count, count + 1)
+
+    @testing.gen_test
+    def test_http_errors_raise(self):
+        def fail(params):
+            raise web.HTTPError(500)
+        self.slack.responses['chat.delete'] = fail
+        errors = stats.registry.get('slack.api.errors')
+
+        with self.assertRaises(httpclient.HTTPClientError):
+            yield self.client.call('chat.delete', {'channel': 'C1', 'ts': '1.2'})
+        # Writes are never retried, they may have gone through.
+        self.assertEqual(len(self.slack.calls), 1)
+        self.assertEqual(stats.registry.get('slack.api.errors'), errors + 1)
+
+    @testing.gen_test
+    def test_reads_are_retried(self):
+        replies = [(500, {}, {}), (503, {}, {}), {'ok': True}]
+        self.slack.responses['auth.test'] = lambda params: replies.pop(0)
+
+        response = yield self.client.call('auth.test')
+        self.assertEqual(response, {'ok': True})
+        self.assertEqual(len(self.slack.calls), 3)
+
+    @testing.gen_test
+    def test_connections_are_kept_alive(self):
+        for _ in range(3):
+            yield self.client.call('chat.postMessage', {'channel': 'C1', 'text': 'hi'})
+        self.assertEqual(len(self.slack.calls), 3)
+        self.assertEqual(len(self.slack.connections), 1)
+
+    @testing.gen_test
+    def test_retry_after(self):
+        received = {}
+
+        def reactions_add(params):
+            received.setdefault(params['name'], time.time())
+            if len(self.slack.calls) == 1:
+                return (429, {'Retry-After': '0.2'}, {})
+            return {'ok': True}
+        self.slack.responses['reactions.add'] = reactions_add
+        throttled = stats.registry.get('slack.api.reactions.add.throttled')
+        bucket = self.client.bucket('reactions.add')
+        bucket.rate = 100.0  # Refill fast after the pause.
+
+        start = time.time()
+        first = self.client.call('reactions.add', {'name': 'one'})
+        while not bucket._paused_until:
+            yield gen.sleep(0.01)
+        # Held back until the pause is over, instead of hitting the limit.
+        second = self.client.call('reactions.add', {'name': 'two'})
+        responses = yield [first, second]
+
+        self.assertEqual(responses, [{'ok': True}, {'ok': True}])
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        # The retry and the second call race once the pause is over.
+        self.assertEqual(sorted(c[1]['name'] for c in self.slack.calls), ['one', 'one', 'two'])
+        self.assertGreaterEqual(received['two'] - start, 0.2)
+        self.assertEqual(stats.registry.get('slack.api.reactions.add.throttled'),
+                         throttled + 1)
+
+    @testing.gen_test
+    def test_calls_queue_for_tokens(self):
+        bucket = self.client.bucket('chat.update')
+        bucket.tokens, bucket.rate = 1, 20.0
+        futures = [self.client.call('chat.update', {'n': n}) for n in range(3)]
+        yield gen.moment
+
+        self.assertEqual(stats.snapshot()['slack.api.chat.update.queued'], 2)
+        yield futures
+        self.assertEqual([c[1]['n'] for c in self.slack.calls], ['0', '1', '2'])
+        self.assertEqual(bucket.queued, 0)
+
+
+class TestIsRead(unittest.TestCase):
+
+    def test_is_read(self):
+        for method in ('users.info', 'conversations.list', 'auth.test'):
+            self.assertTrue(slack_client.is_read(method), method)
+        for method in ('chat.postMessage', 'reactions.add', 'rtm.connect'):
+            self.assertFalse(slack_client.is_read(method), method)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_take(self):
+        bucket = slack_client.TokenBucket('test', per_minute=60, burst=2)
+        now = bucket._updated
+
+        self.assertEqual(bucket._take(now), 0)
+        self.assertEqual(bucket._take(now), 0)
+        self.assertAlmostEqual(bucket._take(now), 1)
+        self.assertAlmostEqual(bucket._take(now + 0.5), 0.5)
+        self.assertEqual(bucket._take(now + 1), 0)
+
+    def test_pause(self):
+        bucket = slack_client.TokenBucket('test', per_minute=60, burst=10)
+        bucket.pause(30)
+        self.assertAlmostEqual(bucket._take(time.time()), 30, places=1)
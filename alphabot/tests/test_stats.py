@@ -0,0 +1,29 @@
+import unittest
+
+from alphabot import stats
+
+
+class TestStats(unittest.TestCase):
+
+    def test_counters_and_gauges(self):
+        registry = stats.Stats()
+        registry.incr('events')
+        registry.incr('events', 2)
+        registry.gauge('depth', lambda: 7)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['events'], 3)
+        self.assertEqual(snapshot['depth'], 7)
+        self.assertEqual(registry.get('missing'), 0)
+
+    def test_histogram(self):
+        registry = stats.Stats()
+        for value in range(1, 101):
+            registry.observe('latency', value)
+
+        snapshot = registry.snapshot()['latency']
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['max'], 100)
+        self.assertEqual(snapshot['p50'], 50)
+        self.assertEqual(snapshot['p99'], 100)
+        self.assertAlmostEqual(snapshot['mean'], 50.5)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""Encode/decode cost and encoded size of each memory codec.
+
+Usage: python benchmarks/bench_codec.py [iterations]
+"""
+import sys
+import timeit
+
+from alphabot import codec
+
+SAMPLES = {
+    'counter': 12345,
+    'small dict': {'user': 'U024BE7LH', 'score': 12, 'tags': ['a', 'b']},
+    'channel history': [
+        {'type': 'message', 'user': 'U%06d' % n, 'ts': '1500000000.%06d' % n,
+         'text': 'Message number %d about the deploy of build %d' % (n, n % 7)}
+        for n in range(500)],
+}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print('%-16s %-10s %-5s %10s %12s %12s' % (
+        'value', 'codec', 'zlib', 'bytes', 'encode us', 'decode us'))
+    for sample_name, value in SAMPLES.items():
+        for name in sorted(codec.CODECS):
+            for threshold in (0, 1024):
+                c = codec.Codec(name, compress_threshold=threshold)
+                encoded = c.encode(value)
+                encode = timeit.timeit(lambda: c.encode(value), number=iterations)
+                decode = timeit.timeit(lambda: c.decode(encoded), number=iterations)
+                print('%-16s %-10s %-5s %10d %12.1f %12.1f' % (
+                    sample_name, name, 'yes' if threshold else 'no', len(encoded),
+                    encode / iterations * 1e6, decode / iterations * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Compare the precompiled command router with per-command regex matching.
+
+Usage: python benchmarks/bench_commands.py [commands] [messages]
+"""
+import random
+import sys
+import time
+
+from alphabot import dispatch
+from alphabot.bot import Chat
+
+WORDS = ['deploy', 'status', 'lunch', 'help', 'oncall', 'page', 'release',
+         'weather', 'joke', 'karma', 'remind', 'standup']
+
+
+def make_regexes(count):
+    regexes = []
+    for i in range(count):
+        word = WORDS[i % len(WORDS)]
+        roll = i % 5
+        if roll == 0:
+            regexes.append('!%s%d (?P<target>.*)' % (word, i))
+        elif roll == 1:
+            regexes.append('%s%d$' % (word, i))
+        elif roll == 2:
+            regexes.append(r'!%s%d \d+' % (word, i))
+        elif roll == 3:
+            regexes.append('@alphabot %s%d.*' % (word, i))
+        else:
+            regexes.append('.*%s%d.*' % (word, i))
+    return regexes
+
+
+def make_texts(count, regex_count):
+    texts = []
+    for i in range(count):
+        if i % 10 == 0:
+            n = random.randrange(regex_count)
+            texts.append('!%s%d prod' % (WORDS[n % len(WORDS)], n))
+        else:
+            texts.append(' '.join(random.choice(WORDS + ['the', 'a', 'is'])
+                                  for _ in range(8)))
+    return texts
+
+
+def linear(regexes, texts):
+    """The pre-router behavior: one Chat and one regex match per command."""
+    matched = 0
+    for text in texts:
+        for regex in regexes:
+            chat = Chat(text=text, user='U1', channel=None, raw={}, bot=None)
+            if chat.matches_regex(regex):
+                matched += 1
+    return matched
+
+
+def routed(router, texts):
+    matched = 0
+    for text in texts:
+        matched += len(router.route(text))
+    return matched
+
+
+def timed(label, texts, function, *args):
+    start = time.time()
+    matched = function(*args)
+    elapsed = time.time() - start
+    print('%-8s %8.1f us/message  (%d matches)' % (
+        label, elapsed / len(texts) * 1e6, matched))
+    return elapsed
+
+
+def main():
+    command_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(0)
+
+    regexes = make_regexes(command_count)
+    texts = make_texts(message_count, command_count)
+    router = dispatch.CommandRouter()
+    for regex in regexes:
+        router.add(regex, lambda message: None)
+
+    print('%d commands, %d messages' % (command_count, message_count))
+    slow = timed('linear', texts, linear, regexes, texts)
+    fast = timed('router', texts, routed, router, texts)
+    print('speedup  %8.1fx' % (slow / fast))
+
+
+if __name__ == '__main__':
+    main()
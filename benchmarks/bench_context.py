@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Count per-event allocations with and without the shared EventContext.
+
+The "legacy" numbers emulate the old dispatch, where Bot.start and every
+add_command wrapper each built their own Chat (and Slack Channel).
+
+Usage: python benchmarks/bench_context.py [listeners] [commands] [events]
+"""
+import sys
+import time
+
+from tornado import gen, ioloop
+
+from alphabot import bot as AB
+from alphabot import directory
+
+COUNTS = {}
+
+
+def counting(cls, name):
+    original = cls.__init__
+
+    def __init__(self, *args, **kwargs):
+        COUNTS[name] = COUNTS.get(name, 0) + 1
+        original(self, *args, **kwargs)
+    cls.__init__ = __init__
+
+
+def make_bot(listener_count, command_count, channel_count):
+    bot = AB.BotSlack()
+    bot.module_path = 'benchmarks/context'
+    bot._channels = directory.Directory({'id': 'C%05d' % i, 'name': 'channel-%d' % i}
+                                        for i in range(channel_count))
+    bot._users = directory.Directory()
+
+    original_get_channel = bot.get_channel
+
+    def get_channel(**kwargs):
+        COUNTS['channel lookups'] = COUNTS.get('channel lookups', 0) + 1
+        return original_get_channel(**kwargs)
+    bot.get_channel = get_channel
+
+    @gen.coroutine
+    def listener(event):
+        pass
+
+    for i in range(listener_count):
+        bot.on(type='message')(listener)
+
+    @gen.coroutine
+    def command(message):
+        pass
+
+    for i in range(command_count):
+        bot.add_command('.*word%d.*' % (i % 3))(command)
+    return bot
+
+
+def legacy_event_to_chat(bot, event):
+    channel = bot.get_channel(id=event.get('channel'))
+    return AB.Chat(text=event.get('text'), user=event.get('user'),
+                   channel=channel, raw=event, bot=bot)
+
+
+@gen.coroutine
+def legacy(bot, events):
+    for event in events:
+        for kwargs, function in bot.event_listeners.match(event):
+            if function == bot._dispatch_commands:
+                for command in bot._commands:
+                    legacy_event_to_chat(bot, event)  # Bot.start
+                    chat = legacy_event_to_chat(bot, event)  # add_command wrapper
+                    chat.matches_regex(command.regex)
+            else:
+                legacy_event_to_chat(bot, event)
+        yield gen.moment
+
+
+@gen.coroutine
+def shared(bot, events):
+    for event in events:
+        yield bot._dispatch(event)
+
+
+def run(label, function, bot, events):
+    COUNTS.clear()
+    start = time.time()
+    ioloop.IOLoop.current().run_sync(lambda: function(bot, events))
+    elapsed = time.time() - start
+    per_event = ', '.join('%s %.1f' % (name, float(count) / len(events))
+                          for name, count in sorted(COUNTS.items()))
+    print('%-7s %7.1f us/event  per event: %s' % (
+        label, elapsed / len(events) * 1e6, per_event))
+
+
+def main():
+    listener_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    command_count = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    event_count = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    counting(AB.Chat, 'Chat')
+    counting(AB.Channel, 'Channel')
+    bot = make_bot(listener_count, command_count, channel_count=500)
+    events = [{'type': 'message', 'channel': 'C%05d' % (i % 500), 'user': 'U1',
+               'text': 'some word%d here' % (i % 5)} for i in range(event_count)]
+
+    print('%d listeners, %d commands, %d events' % (
+        listener_count, command_count, event_count))
+    run('legacy', legacy, bot, events)
+    run('shared', shared, bot, events)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""User and channel lookups: Directory vs the old list scans.
+
+Usage: python benchmarks/bench_directory.py [users] [channels] [lookups]
+"""
+import random
+import sys
+import time
+
+from alphabot.directory import Directory
+from alphabot.dispatch import dict_subset
+
+
+def make_users(count):
+    return [{'id': 'U%07d' % i, 'name': 'user%d' % i, 'deleted': False,
+             'profile': {'real_name': 'User %d' % i}} for i in range(count)]
+
+
+def make_channels(count):
+    return [{'id': 'C%07d' % i, 'name': 'channel-%d' % i, 'is_archived': i % 10 == 0,
+             'members': []} for i in range(count)]
+
+
+def timed(label, function, queries):
+    start = time.time()
+    for query in queries:
+        function(query)
+    elapsed = time.time() - start
+    print('%-36s %10.2f us/lookup' % (label, elapsed / len(queries) * 1e6))
+
+
+def main():
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    channel_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    lookups = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+
+    users, channels = make_users(user_count), make_channels(channel_count)
+    user_ids = [random.choice(users)['id'] for _ in range(lookups)]
+    channel_ids = [{'id': random.choice(channels)['id']} for _ in range(lookups)]
+    channel_names = [{'name': random.choice(channels)['name']} for _ in range(lookups)]
+    archived = [{'is_archived': True}] * (lookups // 100 or 1)
+
+    start = time.time()
+    user_directory, channel_directory = Directory(users), Directory(channels)
+    print('%d users, %d channels. Indexed in %.1f ms' % (
+        user_count, channel_count, (time.time() - start) * 1000))
+
+    timed('user by id (scan)', lambda uid: [u for u in users if u['id'] == uid], user_ids)
+    timed('user by id (directory)', user_directory.get, user_ids)
+    for label, queries in (('channel by id', channel_ids),
+                           ('channel by name', channel_names),
+                           ('channels by other field', archived)):
+        timed(label + ' (scan)',
+              lambda kwargs: [c for c in channels if dict_subset(c, kwargs)], queries)
+        timed(label + ' (directory)', lambda kwargs: channel_directory.find(**kwargs), queries)
+
+
+if __name__ == '__main__':
+    main()
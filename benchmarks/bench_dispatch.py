@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Compare the indexed listener dispatch with the old linear scan.
+
+Usage: python benchmarks/bench_dispatch.py [listeners] [events]
+"""
+import random
+import sys
+import time
+
+from tornado import gen, ioloop
+
+from alphabot import dispatch
+
+EVENT_TYPES = ['message', 'presence_change', 'user_typing', 'reaction_added',
+               'channel_created', 'message-action', 'im_open', 'pong']
+
+
+def make_listeners(count):
+    listeners = []
+    for i in range(count):
+        roll = i % 10
+        if roll < 6:
+            kwargs = {'type': 'message'}
+        elif roll < 8:
+            kwargs = {'type': random.choice(EVENT_TYPES[3:])}
+        elif roll < 9:
+            kwargs = {'type': 'message', 'channel': 'C%04d' % (i % 50)}
+        else:
+            kwargs = {'type': 'message-action', 'callback_id': str(i)}
+        listeners.append((kwargs, lambda event: None))
+    return listeners
+
+
+def make_events(count):
+    events = []
+    for i in range(count):
+        event_type = random.choice(EVENT_TYPES)
+        event = {'type': event_type, 'channel': 'C%04d' % (i % 50), 'ts': str(i)}
+        if event_type == 'message-action':
+            event['callback_id'] = str(i)
+        events.append(event)
+    return events
+
+
+@gen.coroutine
+def linear(listeners, events):
+    """The pre-index Bot.start loop: subset check and IOLoop yield per listener."""
+    matched = 0
+    for event in events:
+        for kwargs, function in list(listeners):
+            if dispatch.dict_subset(event, kwargs):
+                matched += 1
+            yield gen.moment
+    raise gen.Return(matched)
+
+
+@gen.coroutine
+def indexed(index, events):
+    matched = 0
+    for event in events:
+        matched += len(index.match(event))
+        yield gen.moment
+    raise gen.Return(matched)
+
+
+def timed(label, events, function, *args):
+    start = time.time()
+    matched = ioloop.IOLoop.current().run_sync(lambda: function(*args))
+    elapsed = time.time() - start
+    print('%-8s %8.1f us/event  (%d matches)' % (
+        label, elapsed / len(events) * 1e6, matched))
+    return elapsed
+
+
+def main():
+    listener_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    event_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(0)
+
+    listeners = make_listeners(listener_count)
+    events = make_events(event_count)
+    index = dispatch.ListenerIndex()
+    for listener in listeners:
+        index.append(listener)
+
+    print('%d listeners, %d events' % (listener_count, event_count))
+    slow = timed('linear', events, linear, listeners, events)
+    fast = timed('indexed', events, indexed, index, events)
+    print('speedup  %8.1fx' % (slow / fast))
+
+
+if __name__ == '__main__':
+    main()
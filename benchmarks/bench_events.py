@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Load test of the Events API engine with a local HTTP client.
+
+Serves BotSlackEvents' web app on a local port, with the Web API stubbed
+out, and posts signed message events to it from concurrent clients. Every
+tenth delivery is repeated, like Slack's retries. Reports requests per
+second, the latency of the answers, and how many events reached dispatch.
+The bot listens to messages, or it would drop every event as unwanted.
+
+Usage: python benchmarks/bench_events.py [requests] [concurrency]
+"""
+import json
+import logging
+import sys
+import time
+
+import mock
+from tornado import gen, httpclient, httpserver, ioloop, testing
+
+from alphabot import bot as AB
+
+
+@gen.coroutine
+def stub_api(method, params=None, json_body=False):
+    raise gen.Return({
+        'auth.test': {'ok': True, 'user_id': 'UBOT', 'user': 'alphabot'},
+        'users.list': {'ok': True, 'members': []},
+        'conversations.list': {'ok': True, 'channels': []},
+    }.get(method, {'ok': True}))
+
+
+@gen.coroutine
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    logging.disable(logging.ERROR)
+
+    bot = AB.BotSlackEvents(start_web_app=True)
+    bot.api = stub_api
+    with mock.patch.dict('os.environ', {'SLACK_TOKEN': 'x', 'SLACK_SIGNING_SECRET': 'secret'}):
+        yield bot._setup()
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(bot._web_app)
+    server.add_sockets([sock])
+
+    @gen.coroutine
+    def listener(event):
+        pass
+    bot._register_function({'type': 'message'}, listener)
+
+    dispatched = [0]
+
+    @gen.coroutine
+    def consume():
+        while True:
+            event = yield bot._get_next_event()
+            yield bot._dispatch(event)
+            dispatched[0] += 1
+    consume()
+
+    url = 'http://127.0.0.1:%d%s' % (port, AB.SLACK_EVENTS_PATH)
+    client = httpclient.AsyncHTTPClient(max_clients=concurrency)
+    deliveries = [n - n % 10 if n % 10 == 9 else n for n in range(requests)]
+    latencies = []
+
+    @gen.coroutine
+    def worker():
+        while deliveries:
+            n = deliveries.pop()
+            body = json.dumps({'type': 'event_callback', 'event_id': 'Ev%d' % n, 'event': {
+                'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'hi %d' % n}})
+            timestamp = str(int(time.time()))
+            start = time.time()
+            yield client.fetch(url, method='POST', body=body, headers={
+                'X-Slack-Request-Timestamp': timestamp,
+                'X-Slack-Signature': AB.slack_signature('secret', timestamp, body.encode())})
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - start
+    while bot._events.qsize():
+        yield gen.sleep(0.01)
+
+    latencies.sort()
+    print('%d requests, %d clients: %.0f requests/s' % (requests, concurrency, requests / elapsed))
+    print('answered in: p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+        latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+        latencies[-1] * 1000))
+    print('dispatched %d events, dropped %d retried deliveries' % (
+        dispatched[0], requests - dispatched[0]))
+    server.stop()
+
+
+if __name__ == '__main__':
+    ioloop.IOLoop.current().run_sync(main)
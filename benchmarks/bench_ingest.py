@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Cost of ingesting RTM frames nobody listens to: decode everything vs drop early.
+
+The frames mimic a busy workspace, where presence changes and typing
+notifications far outnumber messages. The bot has a few message listeners.
+"full" decodes, logs and dispatches every frame, as the Slack engine used to.
+"filtered" drops the frames of unwanted types before decoding them, as
+RTMSession does with Bot._accepts.
+
+Usage: python benchmarks/bench_ingest.py [frames]
+"""
+import json
+import logging
+import random
+import sys
+import time
+
+from tornado import gen, ioloop
+
+from alphabot import bot as AB
+from alphabot import rtm
+
+log = logging.getLogger('bench')
+
+# (weight, frame)
+FRAMES = [
+    (40, {'type': 'presence_change', 'user': 'U0001', 'presence': 'away'}),
+    (25, {'type': 'user_typing', 'channel': 'C0001', 'user': 'U0002'}),
+    (5, {'type': 'reconnect_url', 'url': 'wss://example.com/websocket/abc'}),
+    (5, {'type': 'dnd_updated_user', 'user': 'U0003', 'dnd_status': {
+        'dnd_enabled': True, 'next_dnd_start_ts': 1450387800}}),
+    (25, {'type': 'message', 'channel': 'C0001', 'user': 'U0004',
+          'text': 'nothing to see here', 'ts': '1355517523.000005'}),
+]
+
+
+def make_frames(count):
+    random.seed(0)
+    population = [json.dumps(frame) for weight, frame in FRAMES for _ in range(weight)]
+    return [random.choice(population) for _ in range(count)]
+
+
+@gen.coroutine
+def listener(event):
+    pass
+
+
+def make_bot():
+    bot = AB.Bot()
+    for _ in range(5):
+        bot._register_function({'type': 'message'}, listener)
+    return bot
+
+
+@gen.coroutine
+def full(bot, frames):
+    for frame in frames:
+        log.debug('Slack message: "%s"' % frame)
+        yield bot._dispatch(json.loads(frame))
+
+
+@gen.coroutine
+def filtered(bot, frames):
+    for frame in frames:
+        event_type = rtm.frame_type(frame)
+        if event_type is not None and not bot._accepts(event_type):
+            continue
+        log.debug('Slack message: "%s"', frame)
+        yield bot._dispatch(json.loads(frame))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    frames = make_frames(count)
+    print('%d frames, %d%% of them messages' % (
+        count, 100 * sum(1 for f in frames if '"message"' in f) // count))
+
+    results = {}
+    for label, function in (('full', full), ('filtered', filtered)):
+        bot = make_bot()
+        start = time.time()
+        ioloop.IOLoop.current().run_sync(lambda: function(bot, frames))
+        results[label] = time.time() - start
+        print('%-9s %7.1f us/frame' % (label, results[label] / count * 1e6))
+    print('speedup   %7.1fx' % (results['full'] / results['filtered']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Read/write throughput of the memory engines.
+
+Uses a real redis on REDIS_HOST/REDIS_PORT if one answers, otherwise the
+in-process fake redis server from the test helpers (which makes the redis
+numbers a measure of client overhead, not of redis).
+
+Usage: python benchmarks/bench_memory.py [operations]
+"""
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import mock
+from tornado import gen, ioloop
+
+from alphabot import memory
+from alphabot.tests.helper import FakeRedisServer
+
+
+def redis_env():
+    host = os.getenv('REDIS_HOST', 'localhost')
+    port = int(os.getenv('REDIS_PORT', 6379))
+    try:
+        socket.create_connection((host, port), timeout=0.5).close()
+        return {'REDIS_HOST': host, 'REDIS_PORT': str(port)}, 'redis at %s:%s' % (host, port)
+    except socket.error:
+        server = FakeRedisServer()
+        port = server.listen_any()
+        return ({'REDIS_HOST': '127.0.0.1', 'REDIS_PORT': str(port)},
+                'in-process fake redis')
+
+
+@gen.coroutine
+def measure(engine, operations):
+    results = []
+
+    start = time.time()
+    for n in range(operations):
+        yield engine.save('key-%d' % (n % 1000), {'n': n, 'text': 'x' * 100})
+    results.append(('write (sequential)', time.time() - start))
+
+    start = time.time()
+    yield [engine.save('key-%d' % (n % 1000), {'n': n, 'text': 'x' * 100})
+           for n in range(operations)]
+    results.append(('write (concurrent)', time.time() - start))
+
+    start = time.time()
+    for n in range(operations):
+        yield engine.get('key-%d' % (n % 1000))
+    results.append(('read (sequential)', time.time() - start))
+
+    start = time.time()
+    yield [engine.get('key-%d' % (n % 1000)) for n in range(operations)]
+    results.append(('read (concurrent)', time.time() - start))
+    raise gen.Return(results)
+
+
+@gen.coroutine
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    directory = tempfile.mkdtemp()
+    env, redis_label = redis_env()
+    env['MEMORY_FILE'] = os.path.join(directory, 'bench.db')
+
+    print('%d operations per test. Redis: %s' % (operations, redis_label))
+    try:
+        for name in ('dict', 'file', 'redis', 'redis-async'):
+            with mock.patch.dict('os.environ', env):
+                engine = memory.ENGINES[name]()
+            yield engine.setup()
+            results = yield measure(engine, operations)
+            for label, elapsed in results:
+                print('%-12s %-20s %10.0f ops/s' % (name, label, operations / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Recovery of the RTM session from lost connections, against a fake RTM server.
+
+The fake server streams numbered events at a steady rate. Every second, one
+of two faults hits the connection:
+
+  close   Slack closes the websocket.
+  silent  The connection goes half-open: nothing arrives, not even pongs.
+
+For each fault this measures the time until events arrive again, and how many
+events were lost meanwhile. Before RTMSession, the bot stopped reading at the
+first close, and waited forever on a half-open connection. The resync after
+each reconnect is stubbed to take a while, as loading a big workspace does;
+it must not hold up the events.
+
+Usage: python benchmarks/bench_rtm.py [faults] [events/s] [ping interval] [resync seconds]
+"""
+import json
+import logging
+import sys
+import time
+
+from tornado import gen, httpserver, ioloop, testing
+
+from alphabot import rtm
+from alphabot.tests.helper import FakeSlack
+
+
+@gen.coroutine
+def measure(mode, faults, rate, ping_interval, resync):
+    slack = FakeSlack()
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(slack.make_app())
+    server.add_sockets([sock])
+
+    received = set()
+    arrivals = []  # (time, seq)
+
+    @gen.coroutine
+    def start():
+        raise gen.Return('ws://127.0.0.1:%d/rtm' % port)
+
+    @gen.coroutine
+    def on_event(event):
+        if 'seq' in event:
+            received.add(event['seq'])
+            arrivals.append((time.time(), event['seq']))
+
+    @gen.coroutine
+    def on_reconnect():
+        slack.pongs = True
+        yield gen.sleep(resync)
+
+    session = rtm.RTMSession(start, on_event, on_reconnect, ping_interval=ping_interval,
+                             pong_timeout=ping_interval)
+    session.backoff = 0.1
+    yield session.connect()
+    session.run()
+
+    silent = set()
+    state = {'seq': 0}
+
+    def emit():
+        state['seq'] += 1
+        for socket in slack.sockets:
+            if socket not in silent:
+                socket.write_message(json.dumps({'type': 'message', 'seq': state['seq']}))
+    emitter = ioloop.PeriodicCallback(emit, 1000.0 / rate)
+    emitter.start()
+
+    recoveries = []
+    for _ in range(faults):
+        yield gen.sleep(1)
+        faulted_at, faulted_seq = time.time(), state['seq']
+        if mode == 'close':
+            slack.sockets[0].close()
+        else:
+            slack.pongs = False
+            silent.update(slack.sockets)
+        while not received or max(received) <= faulted_seq + 1:
+            yield gen.sleep(0.005)
+        # First event delivered over the new connection.
+        back = min(t for t, seq in arrivals if seq > faulted_seq + 1 and t > faulted_at)
+        recoveries.append(back - faulted_at)
+
+    emitter.stop()
+    session.close()
+    server.stop()
+    lost = state['seq'] - len(received) - 1  # The last one may be in flight.
+    raise gen.Return((recoveries, max(0, lost)))
+
+
+@gen.coroutine
+def main():
+    faults = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+    ping_interval = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    resync = float(sys.argv[4]) if len(sys.argv) > 4 else 3.0
+    logging.basicConfig(level=logging.CRITICAL)
+
+    print('%d faults, %.0f events/s, pings every %.1fs (pong timeout %.1fs), '
+          'resync takes %.1fs' % (faults, rate, ping_interval, ping_interval, resync))
+    for mode in ('close', 'silent'):
+        recoveries, lost = yield measure(mode, faults, rate, ping_interval, resync)
+        recoveries.sort()
+        print('%-7s recovery: median %7.1f ms, max %7.1f ms. Lost %6.1f events per fault' % (
+            mode, recoveries[len(recoveries) // 2] * 1000, recoveries[-1] * 1000,
+            float(lost) / faults))
+
+
+if __name__ == '__main__':
+    ioloop.IOLoop.current().run_sync(main, timeout=120)
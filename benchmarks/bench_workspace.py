@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Resident memory of a loaded workspace: one-shot raw dicts vs paginated Users.
+
+"legacy" parses users.list as a single response and keeps the raw dicts, as
+the Slack engine used to. "paged" loads it with BotSlack._update_users, page
+by page into compact User records. Each runs in its own process, so RSS
+numbers do not interfere.
+
+Usage: python benchmarks/bench_workspace.py [users]
+"""
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from tornado import gen, ioloop
+
+from alphabot import bot as AB
+
+
+def make_user(n):
+    """A user as returned by users.list, with the usual profile fields."""
+    return {
+        'id': 'U%08d' % n, 'team_id': 'T0001', 'name': 'user%d' % n, 'deleted': False,
+        'color': '9f69e7', 'real_name': 'User Number %d' % n, 'tz': 'America/Los_Angeles',
+        'tz_label': 'Pacific Daylight Time', 'tz_offset': -25200, 'is_admin': False,
+        'is_owner': False, 'is_primary_owner': False, 'is_restricted': False,
+        'is_ultra_restricted': False, 'is_bot': False, 'updated': 1502138686,
+        'is_app_user': False, 'has_2fa': False,
+        'profile': {
+            'avatar_hash': 'ge3b51ca72de', 'status_text': 'Print is dead',
+            'status_emoji': ':books:', 'real_name': 'User Number %d' % n,
+            'display_name': 'user%d' % n, 'real_name_normalized': 'User Number %d' % n,
+            'display_name_normalized': 'user%d' % n, 'email': 'user%d@example.com' % n,
+            'title': 'Engineer', 'phone': '', 'skype': '', 'team': 'T0001',
+            'image_24': 'https://avatars.example.com/%d_24.jpg' % n,
+            'image_32': 'https://avatars.example.com/%d_32.jpg' % n,
+            'image_48': 'https://avatars.example.com/%d_48.jpg' % n,
+            'image_72': 'https://avatars.example.com/%d_72.jpg' % n,
+            'image_192': 'https://avatars.example.com/%d_192.jpg' % n,
+            'image_512': 'https://avatars.example.com/%d_512.jpg' % n,
+        },
+    }
+
+
+def rss_mb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1024.0 / 1024
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def legacy(count):
+    before = rss_mb()
+    start = time.time()
+    # The whole response arrives, and is parsed, at once.
+    body = '{"ok": true, "members": [%s]}' % ', '.join(
+        json.dumps(make_user(n)) for n in range(count))
+    users = json.loads(body)['members']
+    del body
+    return users, before, time.time() - start
+
+
+def paged(count):
+    bot = AB.BotSlack()
+    page_size = AB.SLACK_PAGE_SIZE
+
+    @gen.coroutine
+    def api(method, params):
+        # Pages are built on demand, like responses arriving from Slack.
+        offset = int(params.get('cursor') or 0)
+        end = min(offset + page_size, count)
+        body = json.dumps({'ok': True, 'members': [make_user(n) for n in range(offset, end)],
+                           'response_metadata': {'next_cursor': str(end) if end < count else ''}})
+        raise gen.Return(json.loads(body))
+    bot.api = api
+
+    before = rss_mb()
+    start = time.time()
+    ioloop.IOLoop.current().run_sync(bot._update_users)
+    return bot._users, before, time.time() - start
+
+
+def run(mode, count):
+    users, before, elapsed = {'legacy': legacy, 'paged': paged}[mode](count)
+    print('%-7s %6d users loaded in %5.2fs. RSS %6.1f MB -> %6.1f MB (+%.1f), peak %6.1f MB' % (
+        mode, len(users), elapsed, before, rss_mb(), rss_mb() - before, peak_rss_mb()))
+
+
+def main():
+    if len(sys.argv) > 2:
+        run(sys.argv[2], int(sys.argv[1]))
+        return
+
+    count = sys.argv[1] if len(sys.argv) > 1 else '50000'
+    for mode in ('legacy', 'paged'):
+        subprocess.check_call([sys.executable, __file__, count, mode])
+
+
+if __name__ == '__main__':
+    main()
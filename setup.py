@@ -13,6 +13,7 @@ setup(
     keywords = "slack, chat, irc, hubot",
     url = "https://github.com/Nextdoor/alphabot",
     packages=find_packages(),
+    python_requires='>=3.7',
     long_description=open('%s/README.rst' % DIR).read(),
     install_requires=open('%s/requirements.txt' % DIR).readlines(),
     entry_points={
@@ -26,6 +27,8 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Intended Audience :: Developers',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Operating System :: POSIX',
         'Natural Language :: English',
     ],